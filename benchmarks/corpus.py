@@ -0,0 +1,159 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Synthetic corpus of users, media entries, tags and comments.
+
+Words are drawn from a generated vocabulary following a Zipf distribution,
+as words in natural text do, so that the index has a realistic mix of very
+common and rare terms. Description and comment lengths follow long-tailed
+distributions, and a few users upload most of the media. Everything is
+derived from a seed, so a corpus can be generated again identically.
+"""
+import random
+import datetime
+from bisect import bisect_left
+
+SYLLABLES = ('ba', 'be', 'bo', 'da', 'di', 'du', 'ga', 'go', 'ka', 'ki',
+             'la', 'le', 'lo', 'ma', 'mi', 'na', 'no', 'pa', 'pe', 'ra',
+             'ri', 'ro', 'sa', 'se', 'ta', 'to', 'va', 'vi', 'za', 'zo')
+
+# Dates media entries were created between
+START_DATE = datetime.datetime(2012, 1, 1)
+END_DATE = datetime.datetime(2017, 1, 1)
+
+
+class ZipfSampler(object):
+    """Samples items so that the n-th most common is drawn 1/n as often."""
+
+    def __init__(self, items, rng, exponent=1.0):
+        self.items = list(items)
+        self.rng = rng
+        self._cumulative = []
+        total = 0.0
+        for rank in range(1, len(self.items) + 1):
+            total += 1.0 / rank ** exponent
+            self._cumulative.append(total)
+        self._total = total
+
+    def sample(self, rng=None):
+        rng = rng or self.rng
+        index = bisect_left(self._cumulative, rng.random() * self._total)
+        return self.items[min(index, len(self.items) - 1)]
+
+    def sample_many(self, count, rng=None):
+        return [self.sample(rng) for _ in range(count)]
+
+
+def make_vocabulary(size, rng):
+    """Return size distinct pseudo-words of two to four syllables."""
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES)
+                          for _ in range(rng.randint(2, 4))))
+    # Shuffle, so that word frequency doesn't follow word length
+    words = sorted(words)
+    rng.shuffle(words)
+    return words
+
+
+class Corpus(object):
+    """Generates the contents of a MediaGoblin library of a given size.
+
+    Each generated entry is a dict with the 'title', 'description',
+    'tags', 'comments', 'user' (an index into usernames) and 'created' of a
+    media entry.
+    """
+
+    def __init__(self, entries, seed=0, vocabulary_size=20000,
+                 tag_count=2000):
+        """
+        Args:
+            entries: the number of media entries.
+            seed: the seed of the random number generator.
+            vocabulary_size: the number of distinct words in text.
+            tag_count: the number of distinct tags.
+        """
+        self.entries = entries
+        self.seed = seed
+        rng = random.Random(seed)
+        self.rng = rng
+        self.words = ZipfSampler(make_vocabulary(vocabulary_size, rng), rng)
+        self.tags = ZipfSampler(make_vocabulary(tag_count, rng), rng)
+        self.usernames = ['user%d' % number
+                          for number in range(max(1, entries // 100))]
+        self.users = ZipfSampler(range(len(self.usernames)), rng,
+                                 exponent=1.2)
+
+    def text(self, median_words, sigma, maximum):
+        """Return text with a log-normally distributed number of words."""
+        count = min(maximum,
+                    max(1, int(self.rng.lognormvariate(0, sigma) *
+                               median_words)))
+        return ' '.join(self.words.sample_many(count))
+
+    def entry(self):
+        rng = self.rng
+        comments = []
+        # Most media have no comments, a few have many
+        while rng.random() < 0.4 and len(comments) < 50:
+            comments.append((self.users.sample(), self.text(12, 0.8, 200)))
+
+        offset = rng.random() * (END_DATE - START_DATE).total_seconds()
+        return {
+            'title': self.text(4, 0.5, 15).capitalize(),
+            'description': (self.text(30, 1.0, 1000)
+                            if rng.random() < 0.7 else u''),
+            'tags': sorted(set(self.tags.sample_many(
+                min(12, int(rng.expovariate(1.0 / 3)))))),
+            'comments': comments,
+            'user': self.users.sample(),
+            'created': START_DATE + datetime.timedelta(seconds=offset)}
+
+    def __iter__(self):
+        for _ in range(self.entries):
+            yield self.entry()
+
+    def queries(self, kind, count):
+        """Return count queries of a kind, made of the corpus's words.
+
+        Queries are drawn independently of the entries, so the same queries
+        are made whether or not the entries were generated first.
+
+        Args:
+            kind: 'term', 'phrase', 'prefix' or 'field'.
+            count: the number of queries.
+        """
+        rng = random.Random('%s-%s' % (self.seed, kind))
+        queries = []
+        for _ in range(count):
+            if kind == 'term':
+                queries.append(self.words.sample(rng))
+            elif kind == 'phrase':
+                queries.append('"%s"' % ' '.join(
+                    self.words.sample_many(2, rng)))
+            elif kind == 'prefix':
+                queries.append(self.words.sample(rng)[:3] + '*')
+            elif kind == 'field':
+                field = rng.choice(('title', 'tag', 'user'))
+                if field == 'tag':
+                    value = self.tags.sample(rng)
+                elif field == 'user':
+                    value = self.usernames[self.users.sample(rng)]
+                else:
+                    value = self.words.sample(rng)
+                queries.append('%s:%s' % (field, value))
+            else:
+                raise ValueError('Unknown query kind: %r' % kind)
+        return queries
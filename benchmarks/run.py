@@ -0,0 +1,498 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Benchmarks indexing and searching a synthetic MediaGoblin library.
+
+A MediaGoblin app is set up in a working directory with an SQLite database,
+which is filled with a synthetic corpus (see corpus.py). The benchmark then
+measures:
+
+- a full update_index of an empty index,
+- an incremental update_index after a share of the entries changed,
+- the time and peak memory of comparing every indexed document with the
+  database, as a full sync does,
+- the latency of committing a new media entry with and without the plugin's
+  database event hooks indexing it,
+- the latency of term, phrase, prefix and field searches.
+
+Results are written as JSON, and can be compared with an earlier run:
+
+    python benchmarks/run.py --entries 100000 --output new.json \\
+        --compare old.json
+
+Runs with ``--backend indexedsearch.backends.sqlite_fts`` and without it
+can be compared the same way, as can runs with ``--backend
+indexedsearch.backends.sharded`` and different ``--shards``.
+"""
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+# Benchmark the plugin in this tree, rather than an installed one
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from corpus import Corpus  # noqa
+
+CONFIG_FILE = os.path.join(BENCHMARK_DIR, 'benchmark_mediagoblin.ini')
+QUERY_KINDS = ('term', 'phrase', 'prefix', 'field')
+# Media entries added per database commit while generating the corpus
+GENERATE_BATCH_SIZE = 500
+# Searches run before timing, e.g. to open the index
+WARMUP_QUERIES = 10
+PAGE_LENGTH = 30
+
+
+def latency_stats(samples):
+    """Summarize latencies in seconds as milliseconds.
+
+    Percentiles use the nearest-rank method.
+    """
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+
+    def percentile(p):
+        rank = int(math.ceil(p / 100.0 * len(samples)))
+        return samples[max(0, rank - 1)] * 1000
+
+    return {'count': len(samples),
+            'mean_ms': sum(samples) / len(samples) * 1000,
+            'p50_ms': percentile(50),
+            'p95_ms': percentile(95),
+            'p99_ms': percentile(99),
+            'max_ms': samples[-1] * 1000}
+
+
+def setup_app(workdir, database=None, backend=None, shards=None):
+    """Set up a MediaGoblin app using an SQLite database in workdir.
+
+    Args:
+        workdir: the directory for the config, database and index.
+        database: a database file to start from, rather than an empty one.
+        backend: the module of the search backend, rather than the default.
+        shards: the number of shards, for the sharded backend.
+    """
+    from mediagoblin.app import MediaGoblinApp
+    from mediagoblin.init import setup_global_and_app_config
+    from mediagoblin.gmg_commands.dbupdate import run_dbupdate
+
+    config_path = os.path.join(workdir, 'mediagoblin.ini')
+    shutil.copyfile(CONFIG_FILE, config_path)
+    if backend:
+        # [[indexedsearch]] is the config's last section
+        with open(config_path, 'a') as config_file:
+            config_file.write('BACKEND = %s\n' % backend)
+            if shards:
+                config_file.write('INDEX_SHARDS = %d\n' % shards)
+    for directory in ('media/public', 'media/queue'):
+        os.makedirs(os.path.join(workdir, 'user_dev', directory))
+    if database:
+        shutil.copyfile(database, os.path.join(workdir, 'mediagoblin.db'))
+
+    global_config, app_config = setup_global_and_app_config(config_path)
+    run_dbupdate(app_config, global_config)
+    return MediaGoblinApp(config_path, setup_celery=False)
+
+
+class MediaFactory(object):
+    """Turns generated entries into MediaEntry rows."""
+
+    def __init__(self, corpus):
+        from mediagoblin.db.base import Session
+        from mediagoblin.db.models import LocalUser
+
+        self.corpus = corpus
+        self.user_ids = []
+        for username in corpus.usernames:
+            user = LocalUser.query.filter(
+                LocalUser.username == username).first()
+            if user is None:
+                user = LocalUser(username=username,
+                                 email=username + u'@example.com')
+                Session.add(user)
+                Session.flush()
+            self.user_ids.append(user.id)
+        Session.commit()
+        self._tags = {}
+        self._count = 0
+
+    def _tag_id(self, slug, session):
+        # Keep ids rather than Tags, as the session is cleared every batch
+        from mediagoblin.db.models import Tag
+
+        tag_id = self._tags.get(slug)
+        if tag_id is None:
+            tag = Tag.find_or_new(slug)
+            session.add(tag)
+            session.flush()
+            tag_id = self._tags[slug] = tag.id
+        return tag_id
+
+    def add(self, data, session):
+        """Add a media entry and its comments to a session.
+
+        Args:
+            data: an entry generated by Corpus.entry().
+            session: the database session.
+
+        Returns:
+            The media entry, flushed so that it has an id.
+        """
+        from mediagoblin.db.models import (MediaEntry, MediaTag, Comment,
+                                           TextComment)
+
+        self._count += 1
+        entry = MediaEntry()
+        entry.title = data['title']
+        entry.description = data['description']
+        entry.slug = u'media-%d-%d' % (os.getpid(), self._count)
+        entry.actor = self.user_ids[data['user']]
+        entry.media_type = u'mediagoblin.media_types.image'
+        entry.state = u'processed'
+        entry.created = entry.updated = data['created']
+        for slug in data['tags']:
+            media_tag = MediaTag(name=slug)
+            media_tag.tag = self._tag_id(slug, session)
+            entry.tags_helper.append(media_tag)
+        session.add(entry)
+        session.flush()
+
+        for user, content in data['comments']:
+            text_comment = TextComment(actor=self.user_ids[user],
+                                       content=content)
+            session.add(text_comment)
+            session.flush()
+            link = Comment()
+            link.target = entry
+            link.comment = text_comment
+            session.add(link)
+        return entry
+
+
+def generate(corpus):
+    """Fill the database with a corpus, returning figures about it."""
+    from mediagoblin.db.base import Session
+
+    start = time.time()
+    factory = MediaFactory(corpus)
+    comments = 0
+    for number, data in enumerate(corpus, 1):
+        factory.add(data, Session)
+        comments += len(data['comments'])
+        if number % GENERATE_BATCH_SIZE == 0 or number == corpus.entries:
+            Session.commit()
+            Session.expunge_all()
+            print('Generated %d of %d media entries' % (number,
+                                                        corpus.entries))
+            sys.stdout.flush()
+    return {'entries': corpus.entries,
+            'users': len(corpus.usernames),
+            'comments': comments,
+            'seconds': time.time() - start}
+
+
+def get_fresh_engine():
+    """Return the configured engine, for an empty index."""
+    from mediagoblin.tools import pluginapi
+    from indexedsearch import get_engine
+    from indexedsearch.registry import registry
+
+    index_dir = pluginapi.get_config('indexedsearch').get('INDEX_DIR')
+    if os.path.exists(index_dir):
+        shutil.rmtree(index_dir)
+    registry.clear()
+    return get_engine()
+
+
+def bench_full_index(engine):
+    start = time.time()
+    counts = engine.update_index()
+    elapsed = time.time() - start
+    return {'seconds': elapsed,
+            'documents': counts['added'],
+            'docs_per_sec': counts['added'] / elapsed if elapsed else 0.0}
+
+
+def bench_incremental_sync(engine, corpus, fraction, rng):
+    """Update and add a share of the media entries, then sync the index."""
+    from mediagoblin.db.base import Session
+    from mediagoblin.db.models import MediaEntry
+
+    media_ids = [media_id for media_id, in Session.query(MediaEntry.id)]
+    changed = rng.sample(media_ids, int(len(media_ids) * fraction))
+    now = datetime.datetime.utcnow()
+    for start in range(0, len(changed), GENERATE_BATCH_SIZE):
+        batch = changed[start:start + GENERATE_BATCH_SIZE]
+        for media in MediaEntry.query.filter(MediaEntry.id.in_(batch)):
+            media.description = u'%s %s' % (media.description,
+                                            corpus.words.sample(rng))
+            media.updated = now
+        Session.commit()
+
+    factory = MediaFactory(corpus)
+    for _ in range(len(changed) // 10):
+        factory.add(corpus.entry(), Session)
+    Session.commit()
+    Session.expunge_all()
+
+    start = time.time()
+    counts = engine.update_index()
+    elapsed = time.time() - start
+    documents = counts['added'] + counts['updated'] + counts['removed']
+    return dict(counts, seconds=elapsed,
+                docs_per_sec=documents / elapsed if elapsed else 0.0)
+
+
+def bench_reconciliation(engine):
+    """Time comparing the whole index with the database, and its memory use.
+
+    Memory is traced with tracemalloc, which slows the comparison down, so it
+    is timed separately first.
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        # Python 2
+        tracemalloc = None
+
+    documents = engine.get_index_stats()['documents']
+    start = time.time()
+    engine.check_index()
+    result = {'seconds': time.time() - start, 'documents': documents}
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            engine.check_index()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        result['peak_bytes'] = peak
+        result['bytes_per_document'] = peak / documents if documents else 0.0
+    return result
+
+
+def bench_event_hooks(engine, corpus, samples):
+    """Time committing new media entries, then with the hooks indexing them.
+    """
+    from mediagoblin.db.base import Session
+    from indexedsearch import add_event_hooks
+
+    factory = MediaFactory(corpus)
+
+    def commit_latencies():
+        latencies = []
+        for _ in range(samples):
+            data = corpus.entry()
+            start = time.time()
+            media_id = factory.add(data, Session).id
+            Session.commit()
+            latencies.append(time.time() - start)
+        Session.expunge_all()
+        return latencies, media_id
+
+    database_only, _ = commit_latencies()
+    add_event_hooks()
+    with_index, last_id = commit_latencies()
+    if not engine.is_indexed(last_id):
+        raise RuntimeError('Media entries added through the event hooks '
+                           'were not indexed')
+    return {'database_only': latency_stats(database_only),
+            'with_index': latency_stats(with_index)}
+
+
+def bench_searches(engine, corpus, count):
+    results = {}
+    for kind in QUERY_KINDS:
+        queries = corpus.queries(kind, count + WARMUP_QUERIES)
+        for query in queries[:WARMUP_QUERIES]:
+            engine.search_page(query, 1, PAGE_LENGTH)
+
+        latencies = []
+        hits = 0
+        errors = 0
+        for query in queries[WARMUP_QUERIES:]:
+            start = time.time()
+            try:
+                page = engine.search_page(query, 1, PAGE_LENGTH)
+            except Exception as error:
+                print('Search for %r failed: %s' % (query, error))
+                errors += 1
+                continue
+            latencies.append(time.time() - start)
+            hits += page['total']
+
+        results[kind] = latency_stats(latencies)
+        results[kind]['mean_hits'] = hits / len(latencies) if latencies else 0
+        results[kind]['errors'] = errors
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=BENCHMARK_DIR,
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args, workdir):
+    import whoosh
+    from indexedsearch import get_engine
+
+    corpus = Corpus(args.entries, seed=args.seed)
+    cached = None
+    if args.corpus_cache:
+        cached = os.path.join(args.corpus_cache, 'corpus-%d-%d.db' % (
+            args.entries, args.seed))
+    reuse = cached is not None and os.path.exists(cached)
+
+    setup_app(workdir, database=cached if reuse else None,
+              backend=args.backend, shards=args.shards)
+    if reuse:
+        corpus_stats = {'entries': args.entries, 'cached': True}
+        # Skip past the generated entries, as if they were just generated
+        for _ in corpus:
+            pass
+    else:
+        corpus_stats = generate(corpus)
+        if cached:
+            if not os.path.isdir(args.corpus_cache):
+                os.makedirs(args.corpus_cache)
+            shutil.copyfile(os.path.join(workdir, 'mediagoblin.db'), cached)
+
+    rng = random.Random(args.seed)
+    results = {}
+    print('Indexing the whole library')
+    results['full_index'] = bench_full_index(get_fresh_engine())
+    print('Syncing changes to %.1f%% of the library' % (args.changed * 100))
+    results['incremental_sync'] = bench_incremental_sync(
+        get_engine(), corpus, args.changed, rng)
+    print('Comparing the index with the database')
+    results['reconciliation'] = bench_reconciliation(get_engine())
+    print('Indexing through the event hooks')
+    results['event_hooks'] = bench_event_hooks(get_engine(), corpus,
+                                               args.samples)
+    print('Searching')
+    results['search'] = bench_searches(get_engine(), corpus, args.queries)
+    results['index'] = get_engine().get_index_stats()
+
+    return {'meta': {'entries': args.entries,
+                     'seed': args.seed,
+                     'date': datetime.datetime.utcnow().isoformat(),
+                     'revision': git_revision(),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'backend': get_engine().__module__,
+                     'shards': args.shards,
+                     'whoosh': '.'.join(map(str, whoosh.__version__)),
+                     'sqlite': sqlite3.sqlite_version},
+            'corpus': corpus_stats,
+            'results': results}
+
+
+def flatten(results, prefix=''):
+    """Yield (dotted name, value) pairs for the numbers in nested dicts."""
+    for key in sorted(results):
+        value = results[key]
+        name = prefix + key
+        if isinstance(value, dict):
+            for item in flatten(value, name + '.'):
+                yield item
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+
+def compare(baseline, current):
+    """Print each result of a run next to the one of a baseline run."""
+    old = dict(flatten(baseline['results']))
+    print('%-45s %12s %12s %8s' % ('result', 'baseline', 'current',
+                                   'change'))
+    for name, value in flatten(current['results']):
+        if name not in old:
+            continue
+        change = ('%+7.1f%%' % ((value - old[name]) / old[name] * 100)
+                  if old[name] else '')
+        print('%-45s %12.2f %12.2f %8s' % (name, old[name], value, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--entries', type=int, default=10000,
+                        help='Number of media entries to generate')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the corpus and of the changes made')
+    parser.add_argument('--queries', type=int, default=200,
+                        help='Number of timed searches of each kind')
+    parser.add_argument('--samples', type=int, default=50,
+                        help='Number of media entries added to time the '
+                             'event hooks')
+    parser.add_argument('--changed', type=float, default=0.01,
+                        help='Share of the media entries updated before '
+                             'the incremental sync')
+    parser.add_argument('--backend', default=None,
+                        help='Module of the search backend to benchmark, '
+                             'e.g. indexedsearch.backends.sqlite_fts')
+    parser.add_argument('--shards', type=int, default=None,
+                        help='Number of index shards, with --backend '
+                             'indexedsearch.backends.sharded')
+    parser.add_argument('--corpus-cache', default=None,
+                        help='Directory to keep generated databases in, and '
+                             'reuse them from')
+    parser.add_argument('--workdir', default=None,
+                        help='Directory to set up the app in, kept after '
+                             'the run. Defaults to a temporary directory')
+    parser.add_argument('--output', default=None,
+                        help='File to write the results to as JSON')
+    parser.add_argument('--compare', default=None,
+                        help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='indexedsearch-bench-')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    try:
+        report = run(args, workdir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            results_file.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(json.load(baseline_file), report)
+
+
+if __name__ == '__main__':
+    main()
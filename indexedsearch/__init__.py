@@ -15,13 +15,20 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import logging
-import importlib
 
 from sqlalchemy import event
+from sqlalchemy.orm import object_session
 
-from mediagoblin.db.models import MediaEntry, Comment
+from mediagoblin.db.base import Session
+from mediagoblin.db.models import (MediaEntry, MediaFile, Comment,
+                                   TextComment)
 from mediagoblin.tools import pluginapi
 
+from indexedsearch import daemon, indexing, maintenance
+from indexedsearch.metrics import metrics, COUNTER, GAUGE
+from indexedsearch.backends import can_share_database
+from indexedsearch.registry import registry
+
 _log = logging.getLogger(__name__)
 PLUGIN_DIR = os.path.dirname(__file__)
 
@@ -34,13 +41,22 @@ def setup_plugin():
 
     if config.get('USERS_ONLY'):
         view = 'user_search_results_view'
+        suggest_view = 'user_suggest_view'
     else:
         view = 'search_results_view'
+        suggest_view = 'suggest_view'
 
     routes = [
         ('indexedsearch',
          '/search/',
-         'indexedsearch.views:' + view)]
+         'indexedsearch.views:' + view),
+        ('indexedsearch.suggest',
+         '/search/suggest/',
+         'indexedsearch.views:' + suggest_view)]
+    if config.get('METRICS_ENDPOINT'):
+        routes.append(('indexedsearch.metrics',
+                       '/search/metrics/',
+                       'indexedsearch.views:metrics_view'))
 
     pluginapi.register_routes(routes)
     pluginapi.register_template_path(os.path.join(PLUGIN_DIR, 'templates'))
@@ -61,8 +77,23 @@ def setup_plugin():
 def setup_engine(mediagoblin_app):
     """Setup engine by updating the index and adding database hook."""
     _log.info('Setting up engine')
-    get_engine().update_index()
+    # The app may have been (re)configured, so don't hand out engines that
+    # were opened against a previous configuration.
+    registry.clear()
+    # Observers and collectors are registered again below, so that each one
+    # only gets every value once however often the app is set up.
+    metrics.reset()
+    indexer = daemon.setup_client(pluginapi.get_config('indexedsearch'))
+    if indexer is not None and indexer.ping():
+        _log.info('The indexer daemon keeps the index in sync')
+    else:
+        get_engine().update_index()
     add_event_hooks()
+    maintenance.setup_merge_scheduler(
+        get_engine, pluginapi.get_config('indexedsearch'))
+    metrics.add_collector('indexedsearch', collect_metrics)
+    # Let other plugins observe metrics, or add their own collectors
+    pluginapi.hook_runall('indexedsearch_metrics', metrics)
     return mediagoblin_app
 
 
@@ -73,31 +104,119 @@ hooks = {
 
 
 def get_engine():
+    """Return this process's engine for the configured backend.
+
+    Engines are cached, so the index is opened once per process rather than
+    on every search request or database event.
+    """
     config = pluginapi.get_config('indexedsearch')
-    backend_module = importlib.import_module(config.get('BACKEND'))
-    return backend_module.Engine(**config)
+    if maintenance.merge_scheduler is not None:
+        # e.g. after the server forked worker processes
+        maintenance.merge_scheduler.ensure_running()
+    return registry.get(config)
+
+
+def collect_metrics():
+    """Return the index's size and the process's counters as metrics."""
+    index_stats = get_engine().get_index_stats()
+    collected = [(GAUGE, 'index_segments', index_stats['segments']),
+                 (GAUGE, 'index_documents', index_stats['documents']),
+                 (GAUGE, 'index_deleted_documents',
+                  index_stats['deleted_documents']),
+                 (GAUGE, 'index_size_bytes', index_stats['size'])]
+    sources = [('engine_', registry.get_stats())]
+    if indexing.index_queue is not None:
+        sources.append(('queue_', indexing.index_queue.stats))
+    if daemon.indexer_client is not None:
+        sources.append(('indexer_', daemon.indexer_client.stats))
+    if maintenance.merge_scheduler is not None:
+        sources.append(('merge_', maintenance.merge_scheduler.stats))
+    for prefix, stats in sources:
+        collected.extend((COUNTER, prefix + key, value)
+                         for key, value in stats.items())
+    return collected
+
+
+def comment_link_change(mapper, connection, link):
+    """Index a text comment that has been linked to a media entry."""
+    if isinstance(link.target(), MediaEntry):
+        text_comment = link.comment()
+        if isinstance(text_comment, TextComment):
+            indexing.defer_change(object_session(link), text_comment.id,
+                                  indexing.INDEX, kind=indexing.COMMENT)
+
+
+def comment_link_deleted(mapper, connection, link):
+    """Remove the text comment of a deleted comment link from the index."""
+    reference = link.comment_helper
+    if (reference is not None and
+            reference.model_type == TextComment.__tablename__):
+        indexing.defer_change(object_session(link), reference.obj_pk,
+                              indexing.REMOVE, kind=indexing.COMMENT)
+
+
+def text_comment_updated(mapper, connection, text_comment):
+    """Reindex an edited comment. Comments not on media aren't indexed."""
+    indexing.defer_change(object_session(text_comment), text_comment.id,
+                          indexing.INDEX, kind=indexing.COMMENT)
+
+
+def text_comment_deleted(mapper, connection, text_comment):
+    """Remove a deleted comment from the index."""
+    indexing.defer_change(object_session(text_comment), text_comment.id,
+                          indexing.REMOVE, kind=indexing.COMMENT)
 
 
-def comment_change(mapper, connection, comment):
+def media_entry_updated(mapper, connection, media_entry):
     """If a comment on a media entry has been removed, reindex the entry."""
-    if isinstance(comment.target(), MediaEntry):
-        get_engine().add_media_entry(comment.target())
+    indexing.defer_change(object_session(media_entry), media_entry.id,
+                          indexing.INDEX)
 
 
-def media_entry_updated(mapper, connection, media_entry):
-    """If a comment on a media entry has been removed, reindex the entry."""
-    get_engine().add_media_entry(media_entry)
+def media_file_change(mapper, connection, media_file):
+    """Reindex a media entry whose files changed, e.g. by reprocessing.
+
+    The entry's row may not change, but the thumbnail URL stored with the
+    STORE_RESULT_FIELDS option does.
+    """
+    indexing.defer_change(object_session(media_file), media_file.media_entry,
+                          indexing.INDEX)
 
 
 def media_entry_deleted(mapper, connection, media_entry):
     """Delete a media entry"""
-    get_engine().remove_media_entry(media_entry.id)
+    indexing.defer_change(object_session(media_entry), media_entry.id,
+                          indexing.REMOVE)
 
 
 def add_event_hooks():
-    for event_type in 'after_delete', 'after_update', 'after_insert':
-        event.listen(Comment, event_type, comment_change)
+    """Queue changes to media entries, and index them once committed."""
+    config = pluginapi.get_config('indexedsearch')
+    threaded = can_share_database()
+    if not threaded:
+        _log.warning("Can't index from a background thread with an "
+                     "in-memory database, indexing as transactions commit")
+    indexing.setup_queue(get_engine, config, threaded=threaded,
+                         indexer=daemon.indexer_client)
+
+    # Comments are indexed as documents of their own, so commenting doesn't
+    # reindex the media entry. A new text comment is indexed once its link
+    # to the media entry is inserted.
+    event.listen(Comment, 'after_insert', comment_link_change)
+    event.listen(Comment, 'after_update', comment_link_change)
+    event.listen(Comment, 'after_delete', comment_link_deleted)
+    event.listen(TextComment, 'after_update', text_comment_updated)
+    event.listen(TextComment, 'after_delete', text_comment_deleted)
 
     event.listen(MediaEntry, 'after_delete', media_entry_deleted)
     event.listen(MediaEntry, 'after_update', media_entry_updated)
     event.listen(MediaEntry, 'after_insert', media_entry_updated)
+    # Documents whose content is unchanged aren't rewritten, so this only
+    # costs a write when result fields are stored
+    for event_name in 'after_insert', 'after_update', 'after_delete':
+        event.listen(MediaFile, event_name, media_file_change)
+
+    event.listen(Session, 'after_commit', indexing.session_after_commit)
+    event.listen(Session, 'after_rollback', indexing.session_after_rollback)
+    event.listen(Session, 'after_transaction_end',
+                 indexing.session_after_transaction_end)
@@ -14,26 +14,690 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import hashlib
 import logging
+import datetime
+import multiprocessing
+from array import array
+
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm import aliased
+
+from mediagoblin.db.base import Session
+from mediagoblin.db.models import (MediaEntry, Comment, TextComment,
+                                   GenericModelReference)
+from mediagoblin.media_types import FileTypeNotSupported
+
+from indexedsearch.idsets import TYPECODE, UNKNOWN_TIME, sorted_ids
 
 _log = logging.getLogger(__name__)
 
+# Keep IN (...) clauses below SQLite's default limit of 999 variables
+ID_BATCH_SIZE = 500
+# How many rows to fetch at a time while streaming media entries
+YIELD_PER = 100
+# How many (id, updated) pairs to fetch per query when comparing every entry
+TIMES_BATCH_SIZE = 10000
+
+# Ids per range whose counts and checksums are compared to find media entries
+# deleted without the index noticing
+ID_RANGE_SIZE = 10000
+# How far before a sync the next one looks for updated entries again, to
+# catch transactions that committed after the sync with an older timestamp
+WATERMARK_OVERLAP = datetime.timedelta(minutes=5)
+# Changed entries beyond which comparing every entry is quicker than
+# looking each one up in the index
+MAX_WATERMARK_CHANGES = 5000
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Facets that search results are counted by, and can be filtered by
+FACETS = ('tag', 'user', 'media_type')
+# Orders search results can be sorted in
+SORT_ORDERS = ('relevance', 'newest', 'oldest')
+
+# The engine whose documents are built by rebuild worker processes, the
+# rows of the media entries it indexes, and what the workers do with the
+# documents. Workers are forked, so they inherit them from the process
+# starting the rebuild.
+_rebuild_engine = None
+_rebuild_rows = None
+_rebuild_finish = None
+
 
 class MediaNotProcessedError(Exception):
     """Error indicating that a media entry is not marked as processed."""
     pass
 
 
+def time_value(time):
+    """Return a time as an integer, comparable with other time values.
+
+    Times are counted in microseconds since datetime.min, like whoosh's
+    DATETIME fields. None, e.g. for documents indexed without a time, is
+    older than any time.
+    """
+    if time is None:
+        return UNKNOWN_TIME
+    delta = time.replace(tzinfo=None) - datetime.datetime.min
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+class IndexedRows(object):
+    """The database rows one kind of document in the index is built from.
+
+    Media entries and comments are synced with the index the same way, from
+    the ids and update times of their rows.
+    """
+
+    def __init__(self, id_column, updated_column, query, indexable=None):
+        """
+        Args:
+            id_column: the column of the ids documents are keyed by.
+            updated_column: the column of the rows' update times.
+            query: a callable returning a query of the columns it's given,
+                over every row that may have a document.
+            indexable: a condition met by the rows that get a document, or
+                None if every row does.
+        """
+        self.id_column = id_column
+        self.updated_column = updated_column
+        self.query = query
+        self.indexable = indexable
+
+    def indexable_query(self, *columns):
+        query = self.query(*columns)
+        if self.indexable is not None:
+            query = query.filter(self.indexable)
+        return query
+
+    def shard(self, number, count):
+        """Return the rows belonging to one of count shards of the index.
+
+        Media entries are split between shards by id, and comments go to
+        the shard of the media entry they are on. The rows' query must
+        include MediaEntry, as those of media entries and comments do.
+
+        Args:
+            number: the number of the shard, from 0 to count - 1.
+            count: the number of shards.
+        """
+        query = self.query
+        condition = MediaEntry.id % count == number
+        return IndexedRows(self.id_column, self.updated_column,
+                           lambda *columns: query(*columns).filter(condition),
+                           self.indexable)
+
+
+# The references from a comment link to the comment and to what it's on
+_comment_object = aliased(GenericModelReference)
+_comment_target = aliased(GenericModelReference)
+
+
+def comment_query(*columns):
+    """Query columns of the text comments on existing media entries.
+
+    Columns of TextComment and MediaEntry can be queried, the media entry
+    being the one the comment is on.
+    """
+    return Session.query(*columns).select_from(TextComment).join(
+        _comment_object,
+        and_(_comment_object.obj_pk == TextComment.id,
+             _comment_object.model_type == TextComment.__tablename__)).join(
+        Comment, Comment.comment_id == _comment_object.id).join(
+        _comment_target,
+        and_(_comment_target.id == Comment.target_id,
+             _comment_target.model_type == MediaEntry.__tablename__)).join(
+        MediaEntry, MediaEntry.id == _comment_target.obj_pk)
+
+
+MEDIA_ROWS = IndexedRows(MediaEntry.id, MediaEntry.updated, Session.query,
+                         MediaEntry.state == u'processed')
+COMMENT_ROWS = IndexedRows(TextComment.id, TextComment.updated,
+                           comment_query)
+
+
+def iter_media_entries(media_ids, batch_size=ID_BATCH_SIZE):
+    """Yield the media entries with the given ids, loading them in batches.
+
+    Entries are yielded in ascending id order.
+
+    Args:
+        media_ids: an iterable of media entry ids.
+        batch_size: how many entries to load per query.
+    """
+    media_ids = sorted_ids(media_ids)
+    for start in range(0, len(media_ids), batch_size):
+        batch = list(media_ids[start:start + batch_size])
+        for media in MediaEntry.query.filter(
+                MediaEntry.id.in_(batch)).order_by(MediaEntry.id):
+            yield media
+
+
+def iter_database_times(processed_only=False, batch_size=TIMES_BATCH_SIZE,
+                        rows=MEDIA_ROWS):
+    """Yield the (id, updated) pairs of media entries in ascending id order.
+
+    Pairs are fetched a batch at a time, continuing after the last id of the
+    previous batch, so that neither the database driver nor the caller holds
+    every pair at once.
+
+    Args:
+        processed_only: only yield processed media entries.
+        batch_size: how many pairs to fetch per query.
+        rows: the IndexedRows to yield pairs of, e.g. COMMENT_ROWS.
+    """
+    last_id = 0
+    query_rows = rows.indexable_query if processed_only else rows.query
+    while True:
+        query = query_rows(rows.id_column, rows.updated_column).filter(
+            rows.id_column > last_id)
+        batch = query.order_by(rows.id_column).limit(batch_size).all()
+        for pair in batch:
+            yield pair
+        if len(batch) < batch_size:
+            return
+        last_id = batch[-1][0]
+
+
+def document_fingerprint(doc):
+    """Return a short hash identifying a document's content.
+
+    Args:
+        doc: a document built by BaseEngine.get_doc_for_media_entry.
+    """
+    content = repr(sorted(doc.items())).encode('utf-8')
+    return hashlib.sha1(content).hexdigest()[:16]
+
+
+def can_share_database():
+    """Return False if other processes or threads can't use the database.
+
+    An in-memory SQLite database only exists inside the connection that
+    created it, so worker processes and threads would see an empty database.
+    """
+    url = Session.get_bind().url
+    return not (url.get_backend_name() == 'sqlite' and
+                url.database in (None, '', ':memory:'))
+
+
+def _fork_pool(procs):
+    """Return a pool of processes forked from this one.
+
+    Workers read the engine and rows to build documents for from globals,
+    which only forked processes inherit, so spawned ones can't be used.
+
+    Returns:
+        The pool, or None if processes can't be forked on this platform.
+    """
+    try:
+        context = multiprocessing.get_context('fork')
+    except AttributeError:
+        # Python 2 always forks on platforms that can
+        context = multiprocessing
+    except ValueError:
+        return None
+    return context.Pool(procs)
+
+
+def _documents_for_range(id_range):
+    """Build the documents for the media entries in an id range.
+
+    Args:
+        id_range: a (start, stop) tuple, stop being excluded.
+    """
+    start, stop = id_range
+    documents = []
+    query = _rebuild_rows.query(MediaEntry).filter(
+        MediaEntry.id >= start, MediaEntry.id < stop).order_by(MediaEntry.id)
+    for media in query.yield_per(YIELD_PER):
+        try:
+            documents.append(_rebuild_engine.get_doc_for_media_entry(media))
+        except MediaNotProcessedError:
+            pass
+    # Don't keep every loaded entry in the session's identity map
+    Session.expunge_all()
+    return documents
+
+
+def _finished_range(id_range):
+    """Build the documents for an id range and finish them, in a worker."""
+    return _rebuild_finish(_documents_for_range(id_range))
+
+
+def _keyset_batches(after_id, batch_size):
+    while True:
+        documents = []
+        last_id = None
+        query = _rebuild_rows.query(MediaEntry).filter(
+            MediaEntry.id > after_id).order_by(MediaEntry.id).limit(
+                batch_size)
+        for media in query.yield_per(YIELD_PER):
+            last_id = media.id
+            try:
+                documents.append(
+                    _rebuild_engine.get_doc_for_media_entry(media))
+            except MediaNotProcessedError:
+                pass
+        Session.expunge_all()
+
+        if last_id is None:
+            return
+        yield last_id, documents
+        after_id = last_id
+
+
+def _parallel_batches(pool, procs, after_id, batch_size):
+    max_id = _rebuild_rows.query(func.max(MediaEntry.id)).scalar() or 0
+    # Don't let the workers inherit (and share) open connections.
+    Session.remove()
+    Session.get_bind().dispose()
+
+    while after_id < max_id:
+        last_id = min(after_id + batch_size, max_id)
+        step = max(1, -(-(last_id - after_id) // procs))
+        ranges = [(start, min(start + step, last_id + 1))
+                  for start in range(after_id + 1, last_id + 1, step)]
+        # Only one batch is in flight at a time, which bounds memory use
+        if _rebuild_finish is not None:
+            yield last_id, pool.map(_finished_range, ranges)
+        else:
+            documents = []
+            for range_documents in pool.map(_documents_for_range, ranges):
+                documents.extend(range_documents)
+            yield last_id, documents
+        after_id = last_id
+
+
+def _serial_batches(after_id, batch_size):
+    for last_id, documents in _keyset_batches(after_id, batch_size):
+        if _rebuild_finish is not None:
+            yield last_id, [_rebuild_finish(documents)]
+        else:
+            yield last_id, documents
+
+
+def iter_document_batches(engine, after_id=0, batch_size=1000, procs=1,
+                          rows=MEDIA_ROWS, finish=None):
+    """Yield documents for the media entries after an id, in batches.
+
+    Media entries are walked in id order using keyset pagination, so memory
+    use depends on the batch size rather than on the number of entries. With
+    more than one process, each batch's id range is split between a pool of
+    forked worker processes, each with its own database connection. Where
+    processes can't be forked, documents are built in this process.
+
+    Args:
+        engine: the engine whose get_doc_for_media_entry builds documents.
+        after_id: only media entries with a greater id are included.
+        batch_size: how many media entries (or, with several processes, how
+            many ids) make up a batch.
+        procs: the number of worker processes to use.
+        rows: the media entries to walk, e.g. the rows of one shard.
+        finish: if given, a callable called with the documents of each part
+            of a batch in the process that built them, e.g. to index them
+            there. Its picklable results are yielded instead of documents.
+
+    Yields:
+        (last_id, documents) tuples, where documents holds the documents for
+        the processed entries with an id in (previous last_id, last_id], or
+        (last_id, results) tuples with a list of finish's results.
+    """
+    global _rebuild_engine, _rebuild_rows, _rebuild_finish
+
+    if procs > 1 and not can_share_database():
+        _log.warning('Can\'t share an in-memory database with worker '
+                     'processes, building documents in this process')
+        procs = 1
+
+    _rebuild_engine = engine
+    _rebuild_rows = rows
+    _rebuild_finish = finish
+    try:
+        if procs == 1:
+            for batch in _serial_batches(after_id, batch_size):
+                yield batch
+            return
+
+        pool = _fork_pool(procs)
+        if pool is None:
+            _log.warning('Can\'t fork worker processes, building documents '
+                         'in this process')
+            for batch in _serial_batches(after_id, batch_size):
+                yield batch
+            return
+        try:
+            for batch in _parallel_batches(pool, procs, after_id, batch_size):
+                yield batch
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        _rebuild_engine = None
+        _rebuild_rows = None
+        _rebuild_finish = None
+
+
+def database_watermark(rows=MEDIA_ROWS):
+    """Return how far the database has got, for syncing from later on.
+
+    Returns:
+        A dict with the time of the 'sync' (UTC, like update times), the
+        latest 'updated' time of media entries (or other rows), None without
+        any, and their 'max_id'.
+    """
+    sync = datetime.datetime.utcnow()
+    updated, max_id = rows.query(func.max(rows.updated_column),
+                                 func.max(rows.id_column)).one()
+    return {'sync': sync, 'updated': updated, 'max_id': max_id or 0}
+
+
+def dump_watermark(watermark):
+    def dump_time(value):
+        return value.strftime(DATETIME_FORMAT) if value else None
+    return json.dumps({'sync': dump_time(watermark['sync']),
+                       'updated': dump_time(watermark['updated']),
+                       'max_id': watermark['max_id']})
+
+
+def load_watermark(text):
+    """Parse a watermark written by dump_watermark.
+
+    Raises:
+        ValueError: the text isn't a watermark.
+        KeyError: the watermark lacks a value.
+    """
+    def load_time(value):
+        if value is None:
+            return None
+        return datetime.datetime.strptime(value, DATETIME_FORMAT)
+    watermark = json.loads(text)
+    return {'sync': load_time(watermark['sync']),
+            'updated': load_time(watermark['updated']),
+            'max_id': int(watermark['max_id'])}
+
+
+def changed_since(watermark, rows=MEDIA_ROWS):
+    """Query (id, updated) pairs of media entries changed since a watermark.
+
+    These are the entries added or updated after the watermark, and those
+    updated up to WATERMARK_OVERLAP before its sync.
+    """
+    conditions = [rows.id_column > watermark['max_id'],
+                  rows.updated_column >=
+                  watermark['sync'] - WATERMARK_OVERLAP]
+    if watermark['updated'] is not None:
+        conditions.append(rows.updated_column > watermark['updated'])
+    return rows.query(rows.id_column, rows.updated_column).filter(
+        or_(*conditions))
+
+
+def processed_count(rows=MEDIA_ROWS):
+    """Return the number of processed media entries, which get indexed."""
+    return rows.indexable_query(func.count(rows.id_column)).scalar()
+
+
+def id_range_checksums(range_size=ID_RANGE_SIZE, rows=MEDIA_ROWS):
+    """Return the count and sum of processed media entry ids, per id range.
+
+    Returns:
+        A dict mapping the number of each id range (id // range_size)
+        holding processed media entries to a (count, sum) tuple.
+    """
+    # Grouped by the first id of each range, as '/' is true division with
+    # SQLAlchemy 2 and older versions don't have '//'
+    start = rows.id_column - rows.id_column % range_size
+    query = rows.indexable_query(start, func.count(rows.id_column),
+                                 func.sum(rows.id_column)).group_by(start)
+    return dict((int(first_id) // range_size, (count, int(total)))
+                for first_id, count, total in query)
+
+
+def processed_ids_in_ranges(numbers, range_size=ID_RANGE_SIZE,
+                            rows=MEDIA_ROWS):
+    """Return the ids of processed media entries in some id ranges.
+
+    Returns:
+        A sorted array of ids.
+    """
+    ids = array(TYPECODE)
+    for number in sorted(numbers):
+        ids.extend(row_id for row_id, in rows.indexable_query(
+            rows.id_column).filter(
+                rows.id_column >= number * range_size,
+                rows.id_column < (number + 1) * range_size).order_by(
+                    rows.id_column))
+    return ids
+
+
+def comment_document(comment_id, media_id, content, updated):
+    """Return the document of a comment on a media entry."""
+    return {'comment_id': comment_id,
+            'media_id': media_id,
+            'comment': content,
+            'time': updated}
+
+
+# The columns comment documents are built from
+COMMENT_DOCUMENT_COLUMNS = (TextComment.id, MediaEntry.id,
+                            TextComment.content, TextComment.updated)
+
+
+def iter_comment_documents(comment_ids, batch_size=ID_BATCH_SIZE):
+    """Yield the documents of the comments with the given ids, in id order.
+
+    Comments that no longer exist, or aren't on a media entry, are skipped.
+    """
+    comment_ids = sorted_ids(comment_ids)
+    for start in range(0, len(comment_ids), batch_size):
+        batch = list(comment_ids[start:start + batch_size])
+        query = comment_query(*COMMENT_DOCUMENT_COLUMNS).filter(
+            TextComment.id.in_(batch)).order_by(TextComment.id)
+        for row in query:
+            yield comment_document(*row)
+
+
+def comment_media_ids(comment_ids, batch_size=ID_BATCH_SIZE):
+    """Return the ids of the media entries some comments are on.
+
+    Returns:
+        A dict mapping text comment ids to media entry ids. Comments that no
+        longer exist, or aren't on a media entry, are left out.
+    """
+    comment_ids = sorted_ids(comment_ids)
+    media_ids = {}
+    for start in range(0, len(comment_ids), batch_size):
+        batch = list(comment_ids[start:start + batch_size])
+        media_ids.update(comment_query(TextComment.id, MediaEntry.id).filter(
+            TextComment.id.in_(batch)))
+    return media_ids
+
+
+def iter_comment_batches(after_id=0, batch_size=1000, rows=COMMENT_ROWS):
+    """Yield the documents of the comments after an id, in batches.
+
+    Args:
+        after_id: only comments with a greater id are included.
+        batch_size: how many comments make up a batch.
+        rows: the comments to walk, e.g. the rows of one shard.
+
+    Yields:
+        (last_id, documents) tuples, like iter_document_batches.
+    """
+    while True:
+        batch = rows.query(*COMMENT_DOCUMENT_COLUMNS).filter(
+            TextComment.id > after_id).order_by(TextComment.id).limit(
+                batch_size).all()
+        if not batch:
+            return
+        after_id = batch[-1][0]
+        yield after_id, [comment_document(*row) for row in batch]
+
+
 class BaseEngine(object):
 
+    # Whether documents include the fields needed to render search results
+    store_result_fields = False
+
     def add_media_entry(self, media):
         raise NotImplementedError
 
     def remove_media_entry(self, media_entry_id):
         raise NotImplementedError
 
-    def update_index(self):
-        """Update the index to make it consistent with the database."""
+    def rebuild_index(self, procs=None, batch_size=None, progress=None):
+        """Replace the index with one built from scratch from the database.
+
+        Args:
+            procs: the number of processes to use.
+            batch_size: how many media entries to index per commit.
+            progress: a callable called with the number of media entries
+                indexed so far and the last indexed id, after each commit.
+
+        Returns:
+            The number of media entries indexed.
+        """
+        raise NotImplementedError
+
+    def apply_changes(self, to_index, to_remove, comments_to_index=(),
+                      comments_to_remove=()):
+        """Apply a batch of media entry and comment changes to the index.
+
+        Args:
+            to_index: ids of media entries to (re)index. Entries that no
+                longer exist or aren't processed are removed from the index.
+            to_remove: ids of media entries to remove from the index.
+            comments_to_index: ids of text comments to (re)index. Comments
+                that no longer exist are removed from the index.
+            comments_to_remove: ids of text comments to remove from the
+                index.
+        """
+        raise NotImplementedError
+
+    def update_index(self, full=False):
+        """Update the index to make it consistent with the database.
+
+        Comments are synced too, but only media entries are counted.
+
+        Args:
+            full: compare every media entry and comment with the index,
+                rather than only those changed since the last sync.
+
+        Returns:
+            A dict with the number of media entries 'added', 'updated' and
+            'removed'.
+        """
+        raise NotImplementedError
+
+    def is_indexed(self, media_id):
+        """Return whether the index holds a document for a media entry."""
+        raise NotImplementedError
+
+    def check_index(self):
+        """Compare the index with the database without writing to it.
+
+        Returns:
+            A dict of sorted lists of media entry ids, for what update_index
+            would do: processed entries that would be 'added' or 'updated',
+            and indexed entries that would be 'removed' as they no longer
+            exist or aren't processed.
+        """
+        raise NotImplementedError
+
+    def get_stats(self):
+        """Return this engine's counters, e.g. of searcher reuse."""
+        return dict(getattr(self, 'stats', {}))
+
+    def search(self, query):
+        """Return the ids of the media entries matching a query."""
+        raise NotImplementedError
+
+    def search_page(self, query, page, pagelen, filters=None, sort=None,
+                    date_range=None):
+        """Return one page of the media entries matching a query.
+
+        Args:
+            query: the query string.
+            page: the page number, starting at 1.
+            pagelen: the number of media entries per page.
+            filters: a dict mapping names in FACETS to the value matching
+                media entries must have.
+            sort: one of SORT_ORDERS, defaults to 'relevance'.
+            date_range: a (start, end) tuple of datetimes the media entries
+                must have been created between. Either may be None.
+
+        Returns:
+            A dict with the page's media entry 'ids' in sort order, the
+            'total' number of matching media entries, the 'pagecount' and
+            the 'facets', a dict mapping each name in FACETS to a list of
+            (value, count) tuples for the most common values. It may also
+            hold a 'correction', a query string with misspelled words
+            corrected, 'fields', listing for each id the fields stored
+            by get_result_fields, or None if they weren't stored, and
+            'partial', True if the search ran out of its SEARCH_TIME_LIMIT
+            and only holds the hits found until then.
+        """
+        raise NotImplementedError
+
+    def suggest(self, prefix, limit):
+        """Return up to limit completions of a prefix.
+
+        Args:
+            prefix: the start of a word typed by a user.
+            limit: the maximum number of completions.
+
+        Returns:
+            A list of (kind, term) tuples, kind being one of
+            indexedsearch.suggest.SUGGESTION_KINDS.
+        """
+        raise NotImplementedError
+
+    def get_result_fields(self, media):
+        """Return what search results are rendered from, for storing.
+
+        Args:
+            media: a processed MediaEntry.
+
+        Returns:
+            A dict with the media entry's 'title', 'slug', 'user',
+            'media_type', 'thumb_url' and 'icon_url', or None if the URLs
+            can't be worked out.
+        """
+        try:
+            thumb_url = media.thumb_url
+            icon_url = media.icon_url
+        except (AttributeError, FileTypeNotSupported):
+            # The entry isn't bound to the app, or its media type is
+            # disabled. Results will be rendered from the database instead.
+            return None
+
+        return {'title': media.title,
+                'slug': media.slug,
+                'user': media.get_actor.username,
+                'media_type': media.media_type,
+                'thumb_url': thumb_url,
+                'icon_url': icon_url}
+
+    def optimize(self, wait=True):
+        """Merge the index into as few parts as possible.
+
+        Args:
+            wait: whether to wait for other writers to finish.
+
+        Returns:
+            False if wait is False and the index is being written to.
+        """
+        raise NotImplementedError
+
+    def get_index_stats(self):
+        """Return figures for telling whether the index needs merging.
+
+        Returns:
+            A dict with the number of 'segments', of live 'documents' and of
+            'deleted_documents' still taking up space, the 'deleted_ratio'
+            of deleted to all documents, the 'size' of the index in bytes,
+            and the number of indexed 'comment_documents'.
+        """
         raise NotImplementedError
 
     def get_doc_for_media_entry(self, media):
@@ -53,17 +717,24 @@ class BaseEngine(object):
             raise MediaNotProcessedError()
 
         tags = ' '.join([tag['name'] for tag in media.tags])
-        comments = '\n'.join([comment.content
-                             for comment in media.get_comments()])
         # collections = u','.join([col.title for col in media.collections])
         doc = {'title': media.title,
                'description': media.description,
                'media_id': media.id,
                'time': media.updated,
+               'created': media.created,
                'tag': tags,
-               'comment': comments}
+               # Tag names may contain spaces, so facets use commas
+               'facet_tag': ','.join([tag['name'] for tag in media.tags]),
+               'facet_media_type': media.media_type}
 
         if media.get_actor:
             doc['user'] = media.get_actor.username
+            doc['facet_user'] = media.get_actor.username
+
+            if self.store_result_fields:
+                result = self.get_result_fields(media)
+                if result is not None:
+                    doc['result'] = result
 
         return doc
@@ -0,0 +1,956 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Search engine keeping the index in the memory of the process.
+
+Documents are numbered in the order they are added, and each term of a field
+has postings: arrays of the numbers of the documents using it, how often,
+and at which positions. Updating a document adds it again under a new number
+and marks the old one as deleted. Deleted documents are dropped by optimize(),
+or after a write once they make up COMPACT_DELETED_RATIO of the index. Words
+are analyzed by the whoosh backend's schema and documents scored with BM25,
+like whoosh does, so both backends find the same media entries.
+
+Nothing has to be opened when the engine is created, which suits test suites
+and small instances. As each process has an index of its own, changes are
+only seen by the process that indexed them, so it only works with a single
+process. With the MEMORY_SNAPSHOT option, the index is saved to a single file
+in INDEX_DIR after syncs, rebuilds and merges, and loaded from it when the
+engine is created, so that the sync at startup only indexes what changed.
+"""
+import os
+import math
+import time
+import heapq
+import pickle
+import logging
+import threading
+from array import array
+from bisect import bisect_left
+
+from indexedsearch.cache import QueryCache, normalize_query
+from indexedsearch.idsets import (IdTimeTable, TYPECODE, difference,
+                                  intersection, sorted_ids, union)
+from indexedsearch.metrics import metrics
+from indexedsearch.querysyntax import And, Not, Or, Words, parse_query
+from indexedsearch.suggest import PrefixIndex
+from indexedsearch.backends import (BaseEngine, MediaNotProcessedError,
+                                    FACETS, SORT_ORDERS, MEDIA_ROWS,
+                                    COMMENT_ROWS, document_fingerprint,
+                                    iter_comment_batches,
+                                    iter_comment_documents,
+                                    iter_database_times,
+                                    iter_document_batches,
+                                    iter_media_entries, time_value)
+from indexedsearch.backends.whoosh import (CommentSchema, MediaEntrySchema,
+                                           DEFAULT_SEARCH_FIELDS)
+
+_log = logging.getLogger(__name__)
+SNAPSHOT_NAME = 'memory_index.pickle'
+# Bumped whenever what snapshots hold changes, older ones are ignored
+SNAPSHOT_VERSION = 1
+MEDIA_FIELDS = ('title', 'description', 'tag', 'user')
+COMMENT_FIELDS = ('comment',)
+SEARCH_FIELDS = MEDIA_FIELDS + COMMENT_FIELDS
+# Words are analyzed like the whoosh backend analyzes them
+ANALYZERS = dict(
+    [(field, MediaEntrySchema()[field].analyzer) for field in MEDIA_FIELDS] +
+    [(field, CommentSchema()[field].analyzer) for field in COMMENT_FIELDS])
+# Share of deleted documents above which writes compact an index, like the
+# default INDEX_MERGE_DELETED_RATIO
+COMPACT_DELETED_RATIO = 0.2
+# BM25 parameters, whoosh's defaults
+B = 0.75
+K1 = 1.2
+# The order of hits for each sort order
+SORT_KEYS = {'relevance': lambda hit: (-hit[1], hit[2]),
+             'newest': lambda hit: (-hit[3], -hit[2]),
+             'oldest': lambda hit: (hit[3], hit[2])}
+
+
+def analyze(field, text, prefix=False):
+    """Return the terms of a text in a field, with their positions.
+
+    Args:
+        field: the name of the field.
+        text: the text to analyze.
+        prefix: whether the text is the start of a word, which is only
+            lowercased, and kept even if it's a stop word.
+
+    Returns:
+        A list of (term, position) tuples.
+    """
+    return [(token.text, token.pos) for token in
+            ANALYZERS[field](text, positions=True, removestops=not prefix)]
+
+
+def bm25(idf, frequency, length, average_length):
+    return idf * ((frequency * (K1 + 1)) /
+                  (frequency + K1 * ((1 - B) + B * length / average_length)))
+
+
+class Postings(object):
+    """Which documents use a term, how often and where, in arrays.
+
+    The positions of the ith document are positions[starts[i]:starts[i] +
+    frequencies[i]].
+    """
+    __slots__ = ('docnums', 'frequencies', 'starts', 'positions')
+
+    def __init__(self):
+        self.docnums = array('I')
+        self.frequencies = array('I')
+        self.starts = array('I')
+        self.positions = array('I')
+
+    def __getstate__(self):
+        return (self.docnums, self.frequencies, self.starts, self.positions)
+
+    def __setstate__(self, state):
+        (self.docnums, self.frequencies, self.starts,
+         self.positions) = state
+
+    def add(self, docnum, positions):
+        self.docnums.append(docnum)
+        self.frequencies.append(len(positions))
+        self.starts.append(len(self.positions))
+        self.positions.extend(positions)
+
+    def nbytes(self):
+        return sum(len(values) * values.itemsize
+                   for values in self.__getstate__())
+
+
+class InvertedIndex(object):
+    """The postings of the terms of some fields, for a kind of documents.
+
+    Each document has a key, a media entry or comment id, and values that
+    are kept along with it, e.g. its update time.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        # Each term is held once, as the key of its postings
+        self.postings = dict((field, {}) for field in fields)
+        self.keys = array(TYPECODE)
+        self.docnums = {}
+        self.values = []
+        self.lengths = dict((field, array('I')) for field in fields)
+        self.total_lengths = dict.fromkeys(fields, 0)
+        self.deleted = set()
+        # Sorted terms of each field, for expanding prefixes
+        self._sorted_terms = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_sorted_terms'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.docnums)
+
+    def get(self, key):
+        """Return the values of the document with a key, or None."""
+        docnum = self.docnums.get(key)
+        return None if docnum is None else self.values[docnum]
+
+    def items(self):
+        """Yield the (key, values) pairs of the documents."""
+        for key, docnum in self.docnums.items():
+            yield key, self.values[docnum]
+
+    def add(self, key, texts, values):
+        """Add a document, replacing the one with the same key.
+
+        Args:
+            key: the document's id.
+            texts: a dict mapping fields to the text indexed in them.
+            values: what get() returns for the document.
+        """
+        self.delete(key)
+        docnum = len(self.keys)
+        self.keys.append(key)
+        self.docnums[key] = docnum
+        self.values.append(values)
+        for field in self.fields:
+            positions = {}
+            terms = analyze(field, texts.get(field) or '')
+            for term, position in terms:
+                positions.setdefault(term, []).append(position)
+            field_postings = self.postings[field]
+            for term, term_positions in positions.items():
+                postings = field_postings.get(term)
+                if postings is None:
+                    postings = field_postings[term] = Postings()
+                    self._sorted_terms.pop(field, None)
+                postings.add(docnum, term_positions)
+            self.lengths[field].append(len(terms))
+            self.total_lengths[field] += len(terms)
+
+    def delete(self, key):
+        """Delete the document with a key.
+
+        Returns:
+            False if there is no such document.
+        """
+        docnum = self.docnums.pop(key, None)
+        if docnum is None:
+            return False
+        self.deleted.add(docnum)
+        self.values[docnum] = None
+        return True
+
+    def deleted_ratio(self):
+        """Return the share of the documents that are deleted."""
+        count = len(self.keys)
+        return float(len(self.deleted)) / count if count else 0.0
+
+    def compact(self):
+        """Drop deleted documents, and the terms only they used."""
+        live = [docnum for docnum in range(len(self.keys))
+                if docnum not in self.deleted]
+        renumbered = dict((docnum, i) for i, docnum in enumerate(live))
+
+        for field in self.fields:
+            lengths = self.lengths[field]
+            self.lengths[field] = array('I', (lengths[docnum]
+                                              for docnum in live))
+            self.total_lengths[field] = sum(self.lengths[field])
+            field_postings = {}
+            for term, postings in self.postings[field].items():
+                compacted = Postings()
+                for i, docnum in enumerate(postings.docnums):
+                    if docnum in renumbered:
+                        start = postings.starts[i]
+                        compacted.add(renumbered[docnum], postings.positions[
+                            start:start + postings.frequencies[i]])
+                if compacted.docnums:
+                    field_postings[term] = compacted
+            self.postings[field] = field_postings
+
+        self.keys = array(TYPECODE, (self.keys[docnum] for docnum in live))
+        self.values = [self.values[docnum] for docnum in live]
+        self.docnums = dict((key, docnum)
+                            for docnum, key in enumerate(self.keys))
+        self.deleted = set()
+        self._sorted_terms = {}
+
+    def terms(self, field):
+        """Return the terms of a field in sorted order."""
+        terms = self._sorted_terms.get(field)
+        if terms is None:
+            terms = self._sorted_terms[field] = sorted(self.postings[field])
+        return terms
+
+    def expand(self, field, prefix):
+        """Return the terms of a field starting with a prefix."""
+        terms = self.terms(field)
+        start = stop = bisect_left(terms, prefix)
+        while stop < len(terms) and terms[stop].startswith(prefix):
+            stop += 1
+        return terms[start:stop]
+
+    def score(self, field, terms, prefix=False):
+        """Score the documents with some terms next to each other in a field.
+
+        Args:
+            field: the name of the field.
+            terms: a list of terms.
+            prefix: whether the last term is the start of a word.
+
+        Returns:
+            A dict mapping the number of each matching document to its
+            score, the sum of the BM25 scores of its matching terms.
+        """
+        field_postings = self.postings[field]
+        count = len(self.keys)
+        if not count:
+            return {}
+        average_length = float(self.total_lengths[field]) / count or 1.0
+        lengths = self.lengths[field]
+
+        # The positions and score of each word in each document using it
+        words = []
+        for i, term in enumerate(terms):
+            if prefix and i == len(terms) - 1:
+                expanded = self.expand(field, term)
+            else:
+                expanded = [term] if term in field_postings else []
+            matches = {}
+            for postings in (field_postings[term] for term in expanded):
+                idf = math.log(float(count) / (len(postings.docnums) + 1)) + 1
+                for j, docnum in enumerate(postings.docnums):
+                    if docnum in self.deleted:
+                        continue
+                    frequency = postings.frequencies[j]
+                    start = postings.starts[j]
+                    positions, score = matches.get(docnum, ((), 0.0))
+                    matches[docnum] = (
+                        positions + tuple(
+                            postings.positions[start:start + frequency]),
+                        score + bm25(idf, frequency, lengths[docnum],
+                                     average_length))
+            if not matches:
+                return {}
+            words.append(matches)
+
+        if len(words) == 1:
+            return dict((docnum, score)
+                        for docnum, (_, score) in words[0].items())
+
+        scores = {}
+        for docnum in set(words[0]).intersection(*words[1:]):
+            followers = [set(word[docnum][0]) for word in words[1:]]
+            if any(all(position + i + 1 in positions
+                       for i, positions in enumerate(followers))
+                   for position in words[0][docnum][0]):
+                scores[docnum] = sum(word[docnum][1] for word in words)
+        return scores
+
+    def nbytes(self):
+        """Return roughly how many bytes the postings and arrays take."""
+        return (sum(postings.nbytes()
+                    for field_postings in self.postings.values()
+                    for postings in field_postings.values()) +
+                len(self.keys) * self.keys.itemsize +
+                sum(len(lengths) * lengths.itemsize
+                    for lengths in self.lengths.values()))
+
+
+def _media_values(doc):
+    return {'time': time_value(doc.get('time')),
+            'created': time_value(doc.get('created')),
+            'tag': [tag for tag in doc.get('facet_tag', '').split(',') if tag],
+            'user': doc.get('facet_user'),
+            'media_type': doc.get('facet_media_type'),
+            'fingerprint': document_fingerprint(doc),
+            'result': doc.get('result')}
+
+
+def _comment_values(doc):
+    return {'time': time_value(doc.get('time')),
+            'media_id': doc['media_id'],
+            'fingerprint': document_fingerprint(doc)}
+
+
+class Engine(BaseEngine):
+
+    def __init__(self, **connection_options):
+        self.index_dir = connection_options.get('INDEX_DIR')
+        self.snapshot = bool(connection_options.get('MEMORY_SNAPSHOT'))
+        self.procs = connection_options.get('INDEX_PROCESSES') or 1
+        self.batch_size = connection_options.get('INDEX_BATCH_SIZE') or 1000
+        self.store_result_fields = bool(
+            connection_options.get('STORE_RESULT_FIELDS'))
+        self.facet_limit = connection_options.get('FACET_LIMIT', 10)
+        self.stats = {'documents_written': 0, 'documents_unchanged': 0,
+                      'prefix_index_builds': 0, 'optimizations': 0,
+                      'compactions': 0, 'snapshots_loaded': 0,
+                      'snapshots_saved': 0}
+        cache_size = connection_options.get('QUERY_CACHE_SIZE', 256)
+        cache_ttl = connection_options.get('QUERY_CACHE_TTL', 300.0)
+        self.query_cache = QueryCache(cache_size, cache_ttl)
+        self.parsed_query_cache = QueryCache(cache_size, cache_ttl)
+        # Held by searches and writes, as the index can't be read while
+        # another thread changes it
+        self._lock = threading.RLock()
+        # Increased by every change, for invalidating cached results
+        self.generation = 0
+        self._prefix_index = (None, None)
+        self.media = InvertedIndex(MEDIA_FIELDS)
+        self.comments = InvertedIndex(COMMENT_FIELDS)
+        if self.snapshot:
+            self.load_snapshot()
+
+    def snapshot_path(self):
+        return os.path.join(self.index_dir, SNAPSHOT_NAME)
+
+    def load_snapshot(self):
+        """Replace the index with the one saved by save_snapshot.
+
+        Returns:
+            False if there is no snapshot, or it can't be read.
+        """
+        path = self.snapshot_path()
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path, 'rb') as snapshot_file:
+                snapshot = pickle.load(snapshot_file)
+        except Exception:
+            _log.exception("Can't read the index snapshot " + path)
+            return False
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            _log.info("Ignoring a snapshot of an older version: " + path)
+            return False
+
+        with self._lock:
+            self.media = snapshot['media']
+            self.comments = snapshot['comments']
+            self.generation += 1
+        self.stats['snapshots_loaded'] += 1
+        _log.info("Loaded %d media entries from the index snapshot" %
+                  len(self.media))
+        return True
+
+    def save_snapshot(self):
+        """Save the index to a single file in INDEX_DIR, if it's enabled."""
+        if not self.snapshot:
+            return
+        if not os.path.exists(self.index_dir):
+            _log.info("Index directory doesn't exist: " + self.index_dir)
+            os.mkdir(self.index_dir)
+
+        path = self.snapshot_path()
+        tmp_path = path + '.tmp'
+        with self._lock:
+            with open(tmp_path, 'wb') as snapshot_file:
+                pickle.dump({'version': SNAPSHOT_VERSION,
+                             'media': self.media,
+                             'comments': self.comments},
+                            snapshot_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+        self.stats['snapshots_saved'] += 1
+
+    def _write(self, index, key, texts, values):
+        """Add a document unless the index holds an identical one.
+
+        Returns:
+            True if the document was added.
+        """
+        with self._lock:
+            indexed = index.get(key)
+            if indexed and indexed['fingerprint'] == values['fingerprint']:
+                self.stats['documents_unchanged'] += 1
+                metrics.inc('documents_unchanged')
+                return False
+            index.add(key, texts, values)
+            self.generation += 1
+        self.stats['documents_written'] += 1
+        metrics.inc('documents_indexed')
+        return True
+
+    def _delete(self, index, key):
+        with self._lock:
+            if not index.delete(key):
+                return False
+            self.generation += 1
+        metrics.inc('documents_removed')
+        return True
+
+    def _compact_deleted(self):
+        """Compact the indexes in which too many documents are deleted.
+
+        Writes only mark replaced and removed documents as deleted, so
+        without this an index that is never optimized keeps growing.
+        """
+        with self._lock:
+            compacted = False
+            for index in self.media, self.comments:
+                if index.deleted_ratio() > COMPACT_DELETED_RATIO:
+                    index.compact()
+                    compacted = True
+                    self.stats['compactions'] += 1
+            if compacted:
+                self.generation += 1
+
+    def write_document(self, doc):
+        """Index a media entry's document, unless it hasn't changed.
+
+        Returns:
+            True if the document was written.
+        """
+        return self._write(self.media, doc['media_id'], doc,
+                           _media_values(doc))
+
+    def write_comment(self, doc):
+        """Index a comment's document, unless it hasn't changed.
+
+        Returns:
+            True if the document was written.
+        """
+        return self._write(self.comments, doc['comment_id'], doc,
+                           _comment_values(doc))
+
+    def add_media_entry(self, media):
+        """Index a media entry.
+
+        Returns:
+            True if a document was written, False if the media entry isn't
+            processed yet or its document hasn't changed.
+        """
+        with metrics.timer('add_media_entry_seconds'):
+            try:
+                doc = self.get_doc_for_media_entry(media)
+            except MediaNotProcessedError:
+                return False
+            return self.write_document(doc)
+
+    def remove_media_entry(self, media_entry_id):
+        """Remove a media entry from the index."""
+        with metrics.timer('remove_media_entry_seconds'):
+            _log.info("Deleting media entry with id: %d" % media_entry_id)
+            self._delete(self.media, media_entry_id)
+
+    def is_indexed(self, media_id):
+        return self.media.get(media_id) is not None
+
+    def rebuild_index(self, procs=None, batch_size=None, progress=None):
+        """Replace the index with one built from scratch from the database.
+
+        The new index is built on the side and replaces the current one once
+        it's complete, so searches keep working meanwhile. Changes indexed
+        during the rebuild may be lost, until the next sync.
+
+        Args:
+            procs: the number of processes building documents, defaults to
+                the INDEX_PROCESSES option.
+            batch_size: how many media entries to load at a time, defaults
+                to the INDEX_BATCH_SIZE option.
+            progress: a callable called with the number of media entries
+                indexed so far and the last indexed id, after each batch.
+
+        Returns:
+            The number of media entries indexed.
+        """
+        procs = procs or self.procs
+        batch_size = batch_size or self.batch_size
+        media = InvertedIndex(MEDIA_FIELDS)
+        count = 0
+        for last_id, documents in iter_document_batches(
+                self, 0, batch_size, procs):
+            for doc in documents:
+                media.add(doc['media_id'], doc, _media_values(doc))
+            count += len(documents)
+            metrics.inc('documents_indexed', len(documents))
+            if progress is not None:
+                progress(count, last_id)
+
+        comments = InvertedIndex(COMMENT_FIELDS)
+        for _, documents in iter_comment_batches(0, batch_size):
+            for doc in documents:
+                comments.add(doc['comment_id'], doc, _comment_values(doc))
+            metrics.inc('documents_indexed', len(documents))
+
+        with self._lock:
+            self.media = media
+            self.comments = comments
+            self.generation += 1
+        self.save_snapshot()
+        _log.info("Index rebuilt: %d media entries indexed" % count)
+        return count
+
+    def update_index(self, full=False):
+        """ Make the index consistent with the database.
+
+        Every media entry and comment is compared with the index, using only
+        their ids and update times.
+
+        Args:
+            full: ignored, every sync compares everything.
+
+        Returns:
+            A dict with the number of media entries 'added', 'updated' and
+            'removed'.
+        """
+        _log.info("Updating index ")
+        with metrics.timer('update_index_seconds'):
+            missing, added, updated = self._index_drift(self.media)
+            written, removed = self._write_changes(union(added, updated),
+                                                   missing)
+            comments_missing, comments_added, comments_updated = \
+                self._index_drift(self.comments)
+            self._write_comment_changes(
+                union(comments_added, comments_updated), comments_missing)
+            self._compact_deleted()
+        counts = {'added': len(intersection(written, added)),
+                  'updated': len(intersection(written, updated)),
+                  'removed': len(removed)}
+        self.save_snapshot()
+        _log.info("Index updated: %(added)d added, %(updated)d updated, "
+                  "%(removed)d removed" % counts)
+        return counts
+
+    def check_index(self):
+        """Compare the index with the database without changing it.
+
+        Returns:
+            A dict of sorted lists of media entry ids, for what update_index
+            would do: processed entries that would be 'added' or 'updated',
+            and indexed entries that would be 'removed' as they no longer
+            exist or aren't processed.
+        """
+        missing, added, updated = self._index_drift(self.media)
+        return {'added': list(added),
+                'updated': list(updated),
+                'removed': list(missing)}
+
+    def _index_drift(self, index):
+        """Return the (missing, added, updated) sorted arrays of ids.
+
+        As for whoosh.Engine._index_drift.
+        """
+        rows = COMMENT_ROWS if index is self.comments else MEDIA_ROWS
+        indexed = IdTimeTable()
+        with self._lock:
+            for key, values in index.items():
+                indexed.add(key, values['time'])
+        database_times = (
+            (row_id, time_value(updated)) for row_id, updated
+            in iter_database_times(processed_only=True, rows=rows))
+        return indexed.compare(database_times)
+
+    def apply_changes(self, to_index, to_remove, comments_to_index=(),
+                      comments_to_remove=()):
+        """Apply a batch of media entry and comment changes to the index.
+
+        Args:
+            to_index: ids of media entries to (re)index. Entries that no
+                longer exist or aren't processed are removed from the index.
+            to_remove: ids of media entries to remove from the index.
+            comments_to_index: ids of text comments to (re)index. Comments
+                that no longer exist are removed from the index.
+            comments_to_remove: ids of text comments to remove from the
+                index.
+        """
+        self._write_changes(to_index, to_remove)
+        self._write_comment_changes(comments_to_index, comments_to_remove)
+        self._compact_deleted()
+
+    def _write_changes(self, to_index, to_remove):
+        """(Re)index and remove media entries.
+
+        Returns:
+            A (written, removed) tuple of sorted arrays of media ids: the
+            entries whose document was written, and the indexed entries that
+            were removed because they were asked to be, no longer exist or
+            aren't processed.
+        """
+        to_index = sorted_ids(to_index)
+        written = array(TYPECODE)
+        indexable = array(TYPECODE)
+        for media in iter_media_entries(to_index):
+            with metrics.timer('add_media_entry_seconds'):
+                try:
+                    doc = self.get_doc_for_media_entry(media)
+                except MediaNotProcessedError:
+                    continue
+                indexable.append(media.id)
+                if self.write_document(doc):
+                    written.append(media.id)
+
+        # Entries that have been deleted or unprocessed since are removed
+        candidates = union(sorted_ids(to_remove),
+                           difference(to_index, indexable))
+        removed = array(TYPECODE, (media_id for media_id in candidates
+                                   if self._delete(self.media, media_id)))
+        return written, removed
+
+    def _write_comment_changes(self, to_index, to_remove):
+        """(Re)index and remove comments, like _write_changes."""
+        to_index = sorted_ids(to_index)
+        indexable = array(TYPECODE)
+        for doc in iter_comment_documents(to_index):
+            indexable.append(doc['comment_id'])
+            self.write_comment(doc)
+
+        # Comments that have been deleted since, or whose media entry has
+        for comment_id in union(sorted_ids(to_remove),
+                                difference(to_index, indexable)):
+            self._delete(self.comments, comment_id)
+
+    def optimize(self, wait=True):
+        """Drop deleted documents from the index, and save a snapshot.
+
+        Args:
+            wait: whether to wait for searches and writes to finish.
+
+        Returns:
+            False if wait is False and the index is in use.
+        """
+        if not self._lock.acquire(wait):
+            return False
+        try:
+            _log.info("Optimizing index")
+            self.media.compact()
+            self.comments.compact()
+            self.generation += 1
+        finally:
+            self._lock.release()
+        self.save_snapshot()
+        self.stats['optimizations'] += 1
+        return True
+
+    def get_index_stats(self):
+        """Return figures for telling whether the index needs compacting.
+
+        The index counts as a single segment, and its size is roughly that
+        of the postings and arrays in memory.
+        """
+        with self._lock:
+            return {'segments': 1,
+                    'documents': len(self.media),
+                    'deleted_documents': len(self.media.deleted),
+                    'deleted_ratio': self.media.deleted_ratio(),
+                    'size': self.media.nbytes() + self.comments.nbytes(),
+                    'comment_documents': len(self.comments)}
+
+    def get_stats(self):
+        stats = BaseEngine.get_stats(self)
+        for name in 'query_cache', 'parsed_query_cache':
+            for key, value in getattr(self, name).stats.items():
+                stats['%s_%s' % (name, key)] = value
+        return stats
+
+    def parse_query(self, query):
+        """Parse a normalized query string, reusing earlier parses."""
+        parsed = self.parsed_query_cache.get(query)
+        if parsed is None:
+            parsed = parse_query(query, DEFAULT_SEARCH_FIELDS, SEARCH_FIELDS)
+            self.parsed_query_cache.put(query, parsed)
+        return parsed
+
+    def _score_words(self, node):
+        """Return the scores of the media entries matching a Words node.
+
+        Returns:
+            A dict mapping document numbers to scores, or None if every word
+            is a stop word, which whoosh leaves out of queries.
+        """
+        scores = None
+        for field in node.fields:
+            terms = [term for i, word in enumerate(node.words)
+                     for term, _ in analyze(
+                         field, word,
+                         node.prefix and i == len(node.words) - 1)]
+            if not terms:
+                continue
+            if field == 'comment':
+                field_scores = self._score_comments(terms, node.prefix)
+            else:
+                field_scores = self.media.score(field, terms, node.prefix)
+            scores = scores or {}
+            for docnum, score in field_scores.items():
+                scores[docnum] = scores.get(docnum, 0.0) + score
+        return scores
+
+    def _score_comments(self, terms, prefix):
+        """Score media entries by their best comment matching some terms."""
+        scores = {}
+        for comment_docnum, score in self.comments.score(
+                'comment', terms, prefix).items():
+            media_id = self.comments.values[comment_docnum]['media_id']
+            docnum = self.media.docnums.get(media_id)
+            if docnum is not None and score > scores.get(docnum, 0.0):
+                scores[docnum] = score
+        return scores
+
+    def score(self, node):
+        """Return the scores of the media entries matching a parsed query.
+
+        Scores of the parts of a query add up, like whoosh's do.
+
+        Returns:
+            A dict mapping document numbers to scores, or None if the query
+            doesn't restrict what matches.
+        """
+        if node is None:
+            return None
+        if isinstance(node, Words):
+            return self._score_words(node)
+        if isinstance(node, Or):
+            scores = None
+            for child_scores in map(self.score, node.children):
+                if child_scores is None:
+                    continue
+                scores = scores or {}
+                for docnum, score in child_scores.items():
+                    scores[docnum] = scores.get(docnum, 0.0) + score
+            return scores
+
+        children = node.children if isinstance(node, And) else [node]
+        positives = [scores for scores in (
+            self.score(child) for child in children
+            if not isinstance(child, Not)) if scores is not None]
+        negatives = [scores for scores in (
+            self.score(child.child) for child in children
+            if isinstance(child, Not)) if scores is not None]
+        if not positives and not negatives:
+            return None
+        if positives:
+            positives.sort(key=len)
+            scores = positives[0]
+            for other in positives[1:]:
+                scores = dict((docnum, score + other[docnum])
+                              for docnum, score in scores.items()
+                              if docnum in other)
+        else:
+            scores = dict.fromkeys(self.media.docnums.values(), 0.0)
+        for negative in negatives:
+            scores = dict((docnum, score) for docnum, score in scores.items()
+                          if docnum not in negative)
+        return scores
+
+    def _hits(self, query, filters=None, date_range=None):
+        """Return the hits of a query, filtered.
+
+        Must be called with the lock held.
+
+        Returns:
+            A list of (values, score, media_id, created) tuples.
+        """
+        unknown = set(filters or {}).difference(FACETS)
+        if unknown:
+            raise ValueError('Unknown facets: %s' % ', '.join(sorted(unknown)))
+        start, end = date_range or (None, None)
+        start = None if start is None else time_value(start)
+        end = None if end is None else time_value(end)
+
+        hits = []
+        for docnum, score in (self.score(self.parse_query(query)) or
+                              {}).items():
+            values = self.media.values[docnum]
+            if start is not None and values['created'] < start:
+                continue
+            if end is not None and values['created'] > end:
+                continue
+            if any(value not in values['tag'] if name == 'tag'
+                   else values[name] != value
+                   for name, value in (filters or {}).items()):
+                continue
+            hits.append((values, score, self.media.keys[docnum],
+                         values['created']))
+        return hits
+
+    def search(self, query):
+        start = time.time()
+        query = normalize_query(query)
+        with self._lock:
+            generation = self.generation
+            key = ('search', query)
+            ids = self.query_cache.get(key, generation)
+            if ids is None:
+                # Only the top 10 hits, like whoosh.Engine.search
+                hits = heapq.nsmallest(10, self._hits(query),
+                                       key=SORT_KEYS['relevance'])
+                ids = tuple(media_id for _, _, media_id, _ in hits)
+                self.query_cache.put(key, ids, generation)
+        metrics.record_search(time.time() - start, len(ids))
+        return list(ids)
+
+    def _top_facet_values(self, hits):
+        facets = {}
+        for name in FACETS:
+            counts = {}
+            for values, _, _, _ in hits:
+                for value in (values['tag'] if name == 'tag'
+                              else [values[name]]):
+                    if value:
+                        counts[value] = counts.get(value, 0) + 1
+            counts = sorted(counts.items(),
+                            key=lambda item: (-item[1], item[0]))
+            facets[name] = counts[:self.facet_limit]
+        return facets
+
+    def search_page(self, query, page, pagelen, filters=None, sort=None,
+                    date_range=None):
+        """Return one page of the media entries matching a query.
+
+        Only the top page * pagelen hits are sorted. Pages are cached until
+        the index changes.
+
+        Args:
+            query: the query string.
+            page: the page number, starting at 1.
+            pagelen: the number of media entries per page.
+            filters: a dict mapping names in FACETS to the value matching
+                media entries must have.
+            sort: one of SORT_ORDERS, defaults to 'relevance'.
+            date_range: a (start, end) tuple of datetimes the media entries
+                must have been created between. Either may be None.
+
+        Returns:
+            A dict like the whoosh engine's, but without corrections of
+            misspelled words, whose 'correction' is always None.
+        """
+        sort = sort or 'relevance'
+        if sort not in SORT_ORDERS:
+            raise ValueError('Unknown sort order: %s' % sort)
+
+        start = time.time()
+        query = normalize_query(query)
+        filter_key = (tuple(sorted((filters or {}).items())), date_range)
+        with self._lock:
+            generation = self.generation
+            key = ('page', query, page, pagelen, filter_key, sort)
+            cached = self.query_cache.get(key, generation)
+            if cached is None:
+                hits = self._hits(query, filters, date_range)
+                top = heapq.nsmallest(page * pagelen, hits,
+                                      key=SORT_KEYS[sort])
+                top = top[(page - 1) * pagelen:]
+                facets_key = ('facets', query, filter_key)
+                facets = self.query_cache.get(facets_key, generation)
+                if facets is None:
+                    facets = self._top_facet_values(hits)
+                    self.query_cache.put(facets_key, facets, generation)
+                cached = {'ids': tuple(media_id
+                                       for _, _, media_id, _ in top),
+                          'total': len(hits),
+                          'pagecount': (len(hits) + pagelen - 1) // pagelen,
+                          'facets': facets,
+                          'correction': None}
+                if self.store_result_fields:
+                    cached['fields'] = tuple(values['result']
+                                             for values, _, _, _ in top)
+                self.query_cache.put(key, cached, generation)
+
+        page = dict(cached, ids=list(cached['ids']))
+        if 'fields' in cached:
+            page['fields'] = list(cached['fields'])
+        metrics.record_search(time.time() - start, page['total'])
+        return page
+
+    def get_prefix_index(self):
+        """Return the prefix index of the latest generation of the index.
+
+        Terms only used by deleted documents are kept until the index is
+        compacted.
+        """
+        with self._lock:
+            prefix_index, built_at = self._prefix_index
+            if prefix_index is None or built_at != self.generation:
+                tags = set()
+                users = set()
+                for _, values in self.media.items():
+                    tags.update(values['tag'])
+                    users.add(values['user'])
+                users.discard(None)
+                prefix_index = PrefixIndex({
+                    'tag': tags,
+                    'user': users,
+                    'title': self.media.terms('title')})
+                self._prefix_index = (prefix_index, self.generation)
+                self.stats['prefix_index_builds'] += 1
+            return prefix_index
+
+    def suggest(self, prefix, limit):
+        """Return up to limit completions of a prefix.
+
+        Returns:
+            A list of (kind, term) tuples, kind being 'tag', 'user' or
+            'title'.
+        """
+        return self.get_prefix_index().complete(prefix, limit)
@@ -0,0 +1,405 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""A search backend splitting the whoosh index into shards.
+
+Media entries are split between INDEX_SHARDS whoosh indexes by id, and each
+comment is indexed in the shard of the media entry it is on. A media entry
+is only ever written to its own shard, so writers of different shards don't
+wait for each other's locks and each commit rewrites a smaller index.
+Searches run on every shard at once, on a pool of threads, and the top hits
+of the shards are merged by score, or by creation date.
+
+Shard 0 lives in INDEX_DIR itself, so an existing index becomes the first
+shard, and the others in shard-<number> subdirectories. When INDEX_SHARDS
+changes, the next sync compares every shard with the database, which moves
+media entries to their new shard, and then removes the shards no longer
+used.
+"""
+import os
+import re
+import time
+import shutil
+import logging
+import threading
+from collections import Counter
+from multiprocessing.pool import ThreadPool
+
+import whoosh.reading
+
+from indexedsearch.cache import normalize_query
+from indexedsearch.metrics import metrics
+from indexedsearch.backends import (BaseEngine, SORT_ORDERS,
+                                    comment_media_ids)
+from indexedsearch.backends import whoosh as whoosh_backend
+
+_log = logging.getLogger(__name__)
+# The file in INDEX_DIR recording how many shards the index was split into
+SHARD_COUNT_NAME = 'shards'
+SHARD_DIR_PATTERN = re.compile(r'^shard-(\d+)$')
+
+# How the merged hits of each sort order are sorted. Hits are (score,
+# created, media_id, fields) tuples, see whoosh.Engine.search_hits.
+HIT_ORDERS = {'relevance': lambda hit: (-hit[0], hit[2]),
+              'newest': lambda hit: (-hit[1], -hit[2]),
+              'oldest': lambda hit: (hit[1], hit[2])}
+
+
+def shard_dir(index_dir, number):
+    """Return the directory of a shard of the index."""
+    if number == 0:
+        return index_dir
+    return os.path.join(index_dir, 'shard-%d' % number)
+
+
+class Engine(BaseEngine):
+
+    def __init__(self, **connection_options):
+        self.index_dir = connection_options.get('INDEX_DIR')
+        self.count = max(1, connection_options.get('INDEX_SHARDS') or 1)
+        self.facet_limit = connection_options.get('FACET_LIMIT', 10)
+        self.correction_threshold = connection_options.get(
+            'CORRECTION_THRESHOLD', 1)
+        self.store_result_fields = bool(
+            connection_options.get('STORE_RESULT_FIELDS'))
+        self.stats = {'shard_searches': 0, 'prefix_index_builds': 0,
+                      'corrector_builds': 0}
+        self.shards = []
+        for number in range(self.count):
+            options = dict(connection_options,
+                           INDEX_DIR=shard_dir(self.index_dir, number),
+                           INDEX_SHARD=(number, self.count))
+            self.shards.append(whoosh_backend.Engine(**options))
+        # Started on first use, as the threads don't survive a fork
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._generation_lock = threading.Lock()
+        self._generation_cache = {}
+
+    def shard_for(self, media_id):
+        """Return the shard a media entry is indexed in."""
+        return self.shards[media_id % self.count]
+
+    def _map(self, function):
+        """Call a function with each shard, on every shard at once.
+
+        Returns:
+            The list of what it returned for each shard.
+        """
+        if self.count == 1:
+            return [function(self.shards[0])]
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.count)
+        self.stats['shard_searches'] += self.count
+        return self._pool.map(function, self.shards)
+
+    def generation(self):
+        """Return the generations of every shard's indexes, as a tuple."""
+        return tuple((shard.index.latest_generation(),
+                      shard.comment_index.latest_generation())
+                     for shard in self.shards)
+
+    @property
+    def shard_count_path(self):
+        return os.path.join(self.index_dir, SHARD_COUNT_NAME)
+
+    def read_shard_count(self):
+        """Return the number of shards of the last sync or rebuild.
+
+        An index without the record was written by the whoosh backend, so
+        it has a single shard.
+        """
+        try:
+            with open(self.shard_count_path) as shard_count:
+                return int(shard_count.read())
+        except (IOError, OSError, ValueError):
+            return 1
+
+    def write_shard_count(self):
+        tmp_path = self.shard_count_path + '.tmp'
+        with open(tmp_path, 'w') as shard_count:
+            shard_count.write('%d' % self.count)
+        os.rename(tmp_path, self.shard_count_path)
+
+    def remove_unused_shards(self):
+        """Remove the shards left over from a greater INDEX_SHARDS."""
+        for name in os.listdir(self.index_dir):
+            match = SHARD_DIR_PATTERN.match(name)
+            if match and int(match.group(1)) >= self.count:
+                _log.info("Removing unused index shard %s" % name)
+                shutil.rmtree(os.path.join(self.index_dir, name))
+
+    def add_media_entry(self, media):
+        return self.shard_for(media.id).add_media_entry(media)
+
+    def remove_media_entry(self, media_entry_id):
+        self.shard_for(media_entry_id).remove_media_entry(media_entry_id)
+
+    def is_indexed(self, media_id):
+        return self.shard_for(media_id).is_indexed(media_id)
+
+    def rebuild_index(self, procs=None, batch_size=None, progress=None):
+        """Rebuild every shard from the database, one after the other.
+
+        Each shard only walks the media entries it holds, and resumes from
+        its own checkpoint if its rebuild was interrupted.
+
+        Args:
+            procs: as for whoosh.Engine.rebuild_index.
+            batch_size: as for whoosh.Engine.rebuild_index.
+            progress: a callable called with the number of media entries
+                indexed so far, in every shard, and the last indexed id of
+                the shard being rebuilt, after each commit.
+
+        Returns:
+            The number of media entries indexed.
+        """
+        count = 0
+        for shard in self.shards:
+            shard_progress = None
+            if progress is not None:
+                shard_progress = (lambda indexed, last_id, before=count:
+                                  progress(before + indexed, last_id))
+            count += shard.rebuild_index(procs, batch_size, shard_progress)
+        self.write_shard_count()
+        self.remove_unused_shards()
+        return count
+
+    def update_index(self, full=False):
+        """Make every shard consistent with the database.
+
+        After INDEX_SHARDS changed, every shard is compared with the
+        database in full, which removes the media entries that moved to
+        another shard and indexes those that moved in.
+
+        Args:
+            full: compare every media entry and comment with the index,
+                rather than only those changed since the last sync.
+
+        Returns:
+            A dict with the number of media entries 'added', 'updated' and
+            'removed', in every shard.
+        """
+        if self.read_shard_count() != self.count:
+            _log.info("Moving media entries to %d index shards" % self.count)
+            full = True
+        counts = Counter()
+        for shard in self.shards:
+            counts.update(shard.update_index(full))
+        self.write_shard_count()
+        self.remove_unused_shards()
+        return dict((key, counts[key])
+                    for key in ('added', 'updated', 'removed'))
+
+    def check_index(self):
+        report = {'added': [], 'updated': [], 'removed': []}
+        for shard in self.shards:
+            for key, ids in shard.check_index().items():
+                report[key].extend(ids)
+        return dict((key, sorted(ids)) for key, ids in report.items())
+
+    def apply_changes(self, to_index, to_remove, comments_to_index=(),
+                      comments_to_remove=()):
+        """Apply a batch of changes, with a commit per shard changed.
+
+        Media entries go to their shard, and comments to the shard of the
+        media entry they are on. Comments that no longer exist are removed
+        from the shards holding them.
+        """
+        changes = [([], [], [], []) for shard in self.shards]
+        for media_id in to_index:
+            changes[media_id % self.count][0].append(media_id)
+        for media_id in to_remove:
+            changes[media_id % self.count][1].append(media_id)
+
+        media_ids = comment_media_ids(
+            set(comments_to_index).union(comments_to_remove))
+        for position, comment_ids in ((2, comments_to_index),
+                                      (3, comments_to_remove)):
+            for comment_id in comment_ids:
+                if comment_id in media_ids:
+                    numbers = [media_ids[comment_id] % self.count]
+                else:
+                    numbers = [
+                        number for number, shard in enumerate(self.shards)
+                        if shard.get_comment_searcher().document_number(
+                            comment_id=comment_id) is not None]
+                for number in numbers:
+                    changes[number][position].append(comment_id)
+
+        for shard, shard_changes in zip(self.shards, changes):
+            if any(shard_changes):
+                shard.apply_changes(*shard_changes)
+
+    def optimize(self, wait=True):
+        """Merge each shard into a single segment.
+
+        Returns:
+            False if wait is False and another writer held the lock of a
+            shard, which is then left as it was.
+        """
+        merged = [shard.optimize(wait) for shard in self.shards]
+        return all(merged)
+
+    def get_index_stats(self):
+        """Return figures for telling whether the index needs merging.
+
+        Shards are merged separately, so 'segments' is the number of
+        segments of the shard with the most. The other figures are added up.
+        """
+        stats = [shard.get_index_stats() for shard in self.shards]
+        count = sum(shard_stats['documents'] +
+                    shard_stats['deleted_documents'] for shard_stats in stats)
+        deleted = sum(shard_stats['deleted_documents']
+                      for shard_stats in stats)
+        return {'segments': max(shard_stats['segments']
+                                for shard_stats in stats),
+                'documents': count - deleted,
+                'deleted_documents': deleted,
+                'deleted_ratio': float(deleted) / count if count else 0.0,
+                'size': sum(shard_stats['size'] for shard_stats in stats),
+                'comment_documents': sum(shard_stats['comment_documents']
+                                         for shard_stats in stats)}
+
+    def get_stats(self):
+        stats = Counter(BaseEngine.get_stats(self))
+        for shard in self.shards:
+            stats.update(shard.get_stats())
+        return dict(stats)
+
+    def _merged_hits(self, query, limit, filters=None, sort=None,
+                     date_range=None):
+        """Search every shard, and merge their top hits.
+
+        Returns:
+            A (hits, total, facets, partial) tuple: the top limit hits of
+            every shard in sort order, as returned by
+            whoosh.Engine.search_hits, the total number of hits, a Counter of
+            the hits with each value, per facet, and whether any shard ran
+            out of time.
+        """
+        sort = sort or 'relevance'
+        if sort not in SORT_ORDERS:
+            raise ValueError('Unknown sort order: %s' % sort)
+        results = self._map(lambda shard: shard.search_hits(
+            query, limit, filters, sort, date_range))
+
+        hits = [hit for result in results for hit in result['hits']]
+        hits.sort(key=HIT_ORDERS[sort])
+        facets = {}
+        for result in results:
+            for name, counts in result['facets'].items():
+                facets.setdefault(name, Counter()).update(counts)
+        return (hits[:limit], sum(result['total'] for result in results),
+                facets, any(result['partial'] for result in results))
+
+    def search(self, query):
+        start = time.time()
+        # Only the top 10 hits, like whoosh.Engine.search
+        hits, total, facets, partial = self._merged_hits(query, 10)
+        metrics.record_search(time.time() - start, total)
+        return [hit[2] for hit in hits]
+
+    def search_page(self, query, page, pagelen, filters=None, sort=None,
+                    date_range=None):
+        """Return one page of the media entries matching a query.
+
+        Each shard is asked for its top page * pagelen hits, which are
+        merged. Relevance scores are computed from each shard's own term
+        statistics, which barely differ between shards, as media entries are
+        spread evenly between them. Every shard caches its hits until its
+        index generation changes. Shards are searched at once, so the
+        SEARCH_TIME_LIMIT applies to each of them and to the whole search
+        alike; the page is partial if any shard ran out of time.
+
+        Args:
+            query: as for whoosh.Engine.search_page.
+            page: as for whoosh.Engine.search_page.
+            pagelen: as for whoosh.Engine.search_page.
+            filters: as for whoosh.Engine.search_page.
+            sort: as for whoosh.Engine.search_page.
+            date_range: as for whoosh.Engine.search_page.
+
+        Returns:
+            A dict like whoosh.Engine.search_page's.
+        """
+        start = time.time()
+        query = normalize_query(query)
+        if page < 1:
+            raise ValueError('Page numbers start at 1')
+        hits, total, facets, partial = self._merged_hits(
+            query, page * pagelen, filters, sort, date_range)
+        hits = hits[(page - 1) * pagelen:]
+        results = {'ids': [hit[2] for hit in hits],
+                   'total': total,
+                   'pagecount': -(-total // pagelen),
+                   'facets': dict(
+                       (name, whoosh_backend.top_facet_values(
+                           counts, self.facet_limit))
+                       for name, counts in facets.items()),
+                   'correction': None,
+                   'partial': partial}
+        if total < self.correction_threshold and not partial:
+            results['correction'] = self.correct_query(query)
+        if self.store_result_fields:
+            results['fields'] = [hit[3] for hit in hits]
+        metrics.record_search(time.time() - start, total)
+        return results
+
+    def _per_generation(self, name, build):
+        """Return a structure built from the latest generation of every shard.
+
+        Args:
+            name: the name of the structure, whose builds are counted in the
+                '<name>_builds' stat.
+            build: a callable building the structure from a reader of every
+                shard's media index.
+        """
+        generation = self.generation()
+        with self._generation_lock:
+            value, built_at = self._generation_cache.get(name, (None, None))
+            if value is None or built_at != generation:
+                # The shards' readers are kept open by their searchers
+                reader = whoosh.reading.MultiReader(
+                    [shard.get_searcher().reader() for shard in self.shards])
+                value = build(reader)
+                self._generation_cache[name] = (value, generation)
+                self.stats[name + '_builds'] += 1
+            return value
+
+    def get_prefix_index(self):
+        """Return the prefix index of the terms of every shard."""
+        return self._per_generation('prefix_index',
+                                    whoosh_backend.build_prefix_index)
+
+    def get_corrector(self):
+        """Return the spelling corrector of the terms of every shard."""
+        return self._per_generation(
+            'corrector',
+            lambda reader: whoosh_backend.TermCorrector(
+                reader, whoosh_backend.CORRECTION_FIELDS))
+
+    def correct_query(self, query):
+        """Return a query string with misspelled words corrected, or None.
+
+        Words are only corrected if no shard holds them.
+        """
+        shard = self.shards[0]
+        return shard.correct_query(query, shard.get_searcher(),
+                                   self.get_corrector())
+
+    def suggest(self, prefix, limit):
+        return self.get_prefix_index().complete(prefix, limit)
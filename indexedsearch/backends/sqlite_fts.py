@@ -0,0 +1,930 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Search engine keeping the index in an SQLite database, using FTS5.
+
+Media entries are indexed in an FTS5 table and ranked by its bm25()
+function, with a weight per column. Their facets, times and fingerprints
+are kept in ordinary tables alongside. Like with whoosh, comments are rows
+of their own, in a second FTS5 table, so commenting doesn't rewrite the
+media entry.
+
+Queries are parsed by indexedsearch.querysyntax and turned into a single
+SQL query. Each set of words is matched by one FTS5 subquery, returning
+the matching media entries with their score, and AND, OR and NOT combine
+those subqueries like whoosh combines its matchers, adding up scores.
+"""
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+from array import array
+from contextlib import contextmanager
+
+from mediagoblin.db.base import Session
+from mediagoblin.db.models import MediaEntry
+
+from indexedsearch.cache import QueryCache, normalize_query
+from indexedsearch.idsets import (IdTimeTable, TYPECODE, difference,
+                                  intersection, sorted_ids, union)
+from indexedsearch.metrics import metrics
+from indexedsearch.querysyntax import And, Not, Or, Words, parse_query
+from indexedsearch.suggest import PrefixIndex
+from indexedsearch.backends import (BaseEngine, MediaNotProcessedError,
+                                    FACETS, SORT_ORDERS, MEDIA_ROWS,
+                                    COMMENT_ROWS, document_fingerprint,
+                                    iter_comment_batches,
+                                    iter_comment_documents,
+                                    iter_database_times,
+                                    iter_document_batches,
+                                    iter_media_entries, time_value)
+
+_log = logging.getLogger(__name__)
+DATABASE_NAME = 'media_entries.sqlite'
+# The FTS5 columns of media entries, in order, and their weight in scores
+TEXT_FIELDS = ('title', 'description', 'tag', 'user')
+COLUMN_WEIGHTS = {'title': 4.0, 'description': 1.0, 'tag': 2.0, 'user': 1.0}
+DEFAULT_SEARCH_FIELDS = ('title', 'description', 'tag', 'comment')
+SEARCH_FIELDS = TEXT_FIELDS + ('comment',)
+# The column each facet is kept in
+FACET_COLUMNS = {'tag': 'tags.tag',
+                 'user': 'documents.user',
+                 'media_type': 'documents.media_type'}
+SORT_CLAUSES = {'relevance': 'hits.score DESC, hits.media_id',
+                'newest': 'hits.created DESC, hits.media_id DESC',
+                'oldest': 'hits.created, hits.media_id'}
+# Seconds writers wait for another writer to finish
+WRITER_TIMEOUT = 60.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    media_id INTEGER PRIMARY KEY,
+    time INTEGER NOT NULL,
+    created INTEGER NOT NULL,
+    user TEXT,
+    media_type TEXT,
+    fingerprint TEXT,
+    result TEXT);
+CREATE INDEX IF NOT EXISTS documents_user ON documents (user);
+CREATE INDEX IF NOT EXISTS documents_media_type ON documents (media_type);
+CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT NOT NULL,
+    media_id INTEGER NOT NULL,
+    PRIMARY KEY (tag, media_id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tags_media_id ON tags (media_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS media_text USING fts5(
+    title, description, tag, user);
+CREATE VIRTUAL TABLE IF NOT EXISTS media_terms USING fts5vocab(
+    media_text, 'col');
+CREATE TABLE IF NOT EXISTS comments (
+    comment_id INTEGER PRIMARY KEY,
+    media_id INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    fingerprint TEXT);
+CREATE INDEX IF NOT EXISTS comments_media_id ON comments (media_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS comment_text USING fts5(comment);
+CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value);
+INSERT OR IGNORE INTO state (name, value) VALUES ('generation', 0);
+"""
+
+# Subqueries for the (media_id, score) of the media entries matching an FTS5
+# expression. LIMIT -1 stops SQLite from flattening them into the queries
+# joining or grouping their rows, where bm25() can't be used.
+MEDIA_MATCH_SQL = (
+    'SELECT rowid AS media_id, -bm25(media_text, %s) AS score '
+    'FROM media_text WHERE media_text MATCH ? LIMIT -1' %
+    ', '.join('%.1f' % COLUMN_WEIGHTS[field] for field in TEXT_FIELDS))
+# Media entries are scored by their best matching comment
+COMMENT_MATCH_SQL = (
+    'SELECT comments.media_id AS media_id, MAX(matches.score) AS score '
+    'FROM (SELECT rowid AS comment_id, -bm25(comment_text) AS score '
+    'FROM comment_text WHERE comment_text MATCH ? LIMIT -1) AS matches '
+    'JOIN comments ON comments.comment_id = matches.comment_id '
+    'GROUP BY comments.media_id')
+
+
+def _phrase(words):
+    """Return an FTS5 string matching words, a Words node."""
+    phrase = '"%s"' % ' '.join(words.words).replace('"', '""')
+    if words.prefix:
+        phrase += ' *'
+    return phrase
+
+
+def _media_expression(node):
+    """Return an FTS5 expression for a node, or None.
+
+    Nodes searching comments, and NOT without anything to subtract from,
+    can't be expressed in the media entries' FTS5 table.
+    """
+    if isinstance(node, Words):
+        if 'comment' in node.fields:
+            return None
+        return '{%s} : %s' % (' '.join(node.fields), _phrase(node))
+    if isinstance(node, Or):
+        parts = [_media_expression(child) for child in node.children]
+        if None in parts:
+            return None
+        return '(%s)' % ' OR '.join(parts)
+    if isinstance(node, And):
+        positives = [_media_expression(child) for child in node.children
+                     if not isinstance(child, Not)]
+        negatives = [_media_expression(child.child)
+                     for child in node.children if isinstance(child, Not)]
+        if not positives or None in positives or None in negatives:
+            return None
+        expression = '(%s)' % ' AND '.join(positives)
+        for negative in negatives:
+            expression = '(%s NOT %s)' % (expression, negative)
+        return expression
+    return None
+
+
+def _sum_scores(parts, required=None):
+    sql = ('SELECT media_id, SUM(score) AS score FROM (%s) GROUP BY media_id'
+           % ' UNION ALL '.join('SELECT media_id, score FROM (%s)' % part
+                                for part, _ in parts))
+    if required:
+        sql += ' HAVING COUNT(*) = %d' % required
+    return sql, [param for _, params in parts for param in params]
+
+
+def compile_query(node):
+    """Compile a parsed query into SQL.
+
+    Returns:
+        A (sql, params) tuple for a query selecting the media_id and score
+        of each matching media entry, once. Entries matched through their
+        comments may not be indexed.
+    """
+    if node is None:
+        return 'SELECT media_id, 0.0 AS score FROM documents WHERE 0', []
+
+    expression = _media_expression(node)
+    if expression is not None:
+        return MEDIA_MATCH_SQL, [expression]
+
+    if isinstance(node, Words):
+        media_fields = [field for field in node.fields
+                        if field in TEXT_FIELDS]
+        parts = [(COMMENT_MATCH_SQL, [_phrase(node)])]
+        if media_fields:
+            parts.insert(0, compile_query(
+                Words(media_fields, node.words, node.prefix)))
+        return _sum_scores(parts) if len(parts) > 1 else parts[0]
+    if isinstance(node, Or):
+        return _sum_scores([compile_query(child)
+                            for child in node.children])
+
+    children = node.children if isinstance(node, And) else [node]
+    positives = [compile_query(child) for child in children
+                 if not isinstance(child, Not)]
+    if len(positives) > 1:
+        sql, params = _sum_scores(positives, required=len(positives))
+    elif positives:
+        sql, params = positives[0]
+    else:
+        sql, params = 'SELECT media_id, 0.0 AS score FROM documents', []
+    for child in children:
+        if isinstance(child, Not):
+            negative, negative_params = compile_query(child.child)
+            sql = ('SELECT media_id, score FROM (%s) WHERE media_id NOT IN '
+                   '(SELECT media_id FROM (%s))' % (sql, negative))
+            params = params + negative_params
+    return sql, params
+
+
+def _tags(doc):
+    return set(tag for tag in doc.get('facet_tag', '').split(',') if tag)
+
+
+class Engine(BaseEngine):
+
+    def __init__(self, **connection_options):
+        self.index_dir = connection_options.get('INDEX_DIR')
+        self.path = os.path.join(self.index_dir, DATABASE_NAME)
+        self.procs = connection_options.get('INDEX_PROCESSES') or 1
+        self.batch_size = connection_options.get('INDEX_BATCH_SIZE') or 1000
+        self.store_result_fields = bool(
+            connection_options.get('STORE_RESULT_FIELDS'))
+        self.facet_limit = connection_options.get('FACET_LIMIT', 10)
+        self.stats = {'connections_opened': 0,
+                      'documents_written': 0, 'documents_unchanged': 0,
+                      'prefix_index_builds': 0, 'optimizations': 0}
+        cache_size = connection_options.get('QUERY_CACHE_SIZE', 256)
+        cache_ttl = connection_options.get('QUERY_CACHE_TTL', 300.0)
+        self.query_cache = QueryCache(cache_size, cache_ttl)
+        self.parsed_query_cache = QueryCache(cache_size, cache_ttl)
+        # SQLite connections can't be used by several threads at once, so
+        # each thread keeps its own
+        self._local = threading.local()
+        self._prefix_lock = threading.Lock()
+        self._prefix_index = (None, None)
+
+        if not os.path.exists(self.index_dir):
+            _log.info("Index directory doesn't exist: " + self.index_dir)
+            os.mkdir(self.index_dir)
+        try:
+            self.connection().executescript(SCHEMA)
+        except sqlite3.OperationalError:
+            _log.error("Can't create the index, SQLite %s may have been "
+                       "built without FTS5" % sqlite3.sqlite_version)
+            raise
+
+    def connection(self):
+        """Return this thread's connection to the index database.
+
+        The connection is opened on first use and kept open. Transactions
+        are started explicitly, see transaction().
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=WRITER_TIMEOUT,
+                                         isolation_level=None)
+            # Readers don't block the writer, nor the writer readers
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            self._local.connection = connection
+            self.stats['connections_opened'] += 1
+        return connection
+
+    @contextmanager
+    def transaction(self, timeout=WRITER_TIMEOUT):
+        """Write to the index in a single transaction.
+
+        The write lock is taken straight away. If anything was written, the
+        index generation is increased on commit, which invalidates the
+        results cached by every process.
+
+        Args:
+            timeout: seconds to wait for another writer to finish.
+
+        Raises:
+            sqlite3.OperationalError: the database stayed locked for longer
+                than the timeout.
+        """
+        connection = self.connection()
+        start = time.time()
+        connection.execute('PRAGMA busy_timeout = %d' % (timeout * 1000))
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError:
+            metrics.inc('writer_lock_timeouts')
+            raise
+        finally:
+            metrics.observe('writer_lock_wait_seconds', time.time() - start)
+            connection.execute('PRAGMA busy_timeout = %d' %
+                               (WRITER_TIMEOUT * 1000))
+
+        changes = connection.total_changes
+        try:
+            yield connection
+            if connection.total_changes != changes:
+                connection.execute("UPDATE state SET value = value + 1 "
+                                   "WHERE name = 'generation'")
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        with metrics.timer('commit_seconds'):
+            connection.execute('COMMIT')
+
+    def generation(self, connection=None):
+        """Return the number of transactions that have changed the index."""
+        connection = connection or self.connection()
+        return int(connection.execute(
+            "SELECT value FROM state WHERE name = 'generation'").fetchone()[0])
+
+    def read_checkpoint(self):
+        """Return the last id indexed by an interrupted rebuild, or None."""
+        row = self.connection().execute(
+            "SELECT value FROM state WHERE name = 'checkpoint'").fetchone()
+        return int(row[0]) if row else None
+
+    def _insert_documents(self, connection, docs):
+        """Insert the rows of media entries that aren't indexed."""
+        connection.executemany(
+            'INSERT INTO documents (media_id, time, created, user, '
+            'media_type, fingerprint, result) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(doc['media_id'], time_value(doc.get('time')),
+              time_value(doc.get('created')), doc.get('facet_user'),
+              doc.get('facet_media_type'), document_fingerprint(doc),
+              json.dumps(doc['result']) if doc.get('result') else None)
+             for doc in docs])
+        connection.executemany(
+            'INSERT INTO media_text (rowid, title, description, tag, user) '
+            'VALUES (?, ?, ?, ?, ?)',
+            [(doc['media_id'],) + tuple(doc.get(field)
+                                        for field in TEXT_FIELDS)
+             for doc in docs])
+        connection.executemany(
+            'INSERT INTO tags (tag, media_id) VALUES (?, ?)',
+            [(tag, doc['media_id']) for doc in docs for tag in _tags(doc)])
+
+    def _delete_documents(self, connection, media_ids):
+        params = [(media_id,) for media_id in media_ids]
+        connection.executemany('DELETE FROM media_text WHERE rowid = ?',
+                               params)
+        connection.executemany('DELETE FROM documents WHERE media_id = ?',
+                               params)
+        connection.executemany('DELETE FROM tags WHERE media_id = ?', params)
+
+    def _insert_comments(self, connection, docs):
+        """Insert the rows of comments that aren't indexed."""
+        connection.executemany(
+            'INSERT INTO comments (comment_id, media_id, time, fingerprint) '
+            'VALUES (?, ?, ?, ?)',
+            [(doc['comment_id'], doc['media_id'], time_value(doc['time']),
+              document_fingerprint(doc)) for doc in docs])
+        connection.executemany(
+            'INSERT INTO comment_text (rowid, comment) VALUES (?, ?)',
+            [(doc['comment_id'], doc['comment']) for doc in docs])
+
+    def _delete_comments(self, connection, comment_ids):
+        params = [(comment_id,) for comment_id in comment_ids]
+        connection.executemany('DELETE FROM comment_text WHERE rowid = ?',
+                               params)
+        connection.executemany('DELETE FROM comments WHERE comment_id = ?',
+                               params)
+
+    def _delete_range(self, connection, start, end, comments=False):
+        """Delete the media entries, or comments, with ids from start to end.
+        """
+        if comments:
+            tables = [('comment_text', 'rowid'), ('comments', 'comment_id')]
+        else:
+            tables = [('media_text', 'rowid'), ('documents', 'media_id'),
+                      ('tags', 'media_id')]
+        for table, column in tables:
+            connection.execute('DELETE FROM %s WHERE %s BETWEEN ? AND ?' %
+                               (table, column), (start, end))
+
+    def rebuild_index(self, procs=None, batch_size=None, progress=None):
+        """Replace the index with one built from scratch from the database.
+
+        Media entries are indexed in id order, one batch per transaction.
+        Each batch replaces every indexed document in its id range, and saves
+        the last indexed id as a checkpoint in the same transaction, which
+        an interrupted rebuild resumes from. Comments are rebuilt once the
+        media entries are.
+
+        Args:
+            procs: the number of processes building documents, defaults to
+                the INDEX_PROCESSES option.
+            batch_size: how many media entries to index per transaction,
+                defaults to the INDEX_BATCH_SIZE option.
+            progress: a callable called with the number of media entries
+                indexed so far and the last indexed id, after each commit.
+
+        Returns:
+            The number of media entries indexed.
+        """
+        procs = procs or self.procs
+        batch_size = batch_size or self.batch_size
+        after_id = self.read_checkpoint() or 0
+        if after_id:
+            _log.info("Resuming rebuild after media entry %d" % after_id)
+
+        count = 0
+        start = time.time()
+        for last_id, documents in iter_document_batches(
+                self, after_id, batch_size, procs):
+            with self.transaction() as connection:
+                self._delete_range(connection, after_id + 1, last_id)
+                self._insert_documents(connection, documents)
+                connection.execute(
+                    "INSERT OR REPLACE INTO state (name, value) "
+                    "VALUES ('checkpoint', ?)", (last_id,))
+            count += len(documents)
+            metrics.inc('documents_indexed', len(documents))
+            after_id = last_id
+            if progress is not None:
+                progress(count, last_id)
+
+        self._remove_missing_after(after_id)
+        self.rebuild_comments(batch_size)
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM state WHERE name = 'checkpoint'")
+        elapsed = time.time() - start
+        if elapsed > 0:
+            metrics.set('rebuild_docs_per_second', count / elapsed)
+        _log.info("Index rebuilt: %d media entries indexed" % count)
+        return count
+
+    def _remove_missing_after(self, media_id):
+        """Remove indexed entries past an id that aren't in the database."""
+        indexed_ids = [indexed_id for indexed_id, in self.connection().execute(
+            'SELECT media_id FROM documents WHERE media_id > ?', (media_id,))]
+        if not indexed_ids:
+            return
+
+        existing_ids = set(
+            media_id for media_id, in Session.query(MediaEntry.id).filter(
+                MediaEntry.id.in_(indexed_ids)))
+        missing = set(indexed_ids).difference(existing_ids)
+        with self.transaction() as connection:
+            self._delete_documents(connection, missing)
+        metrics.inc('documents_removed', len(missing))
+
+    def rebuild_comments(self, batch_size=None):
+        """Reindex every comment from the database, a batch at a time.
+
+        Returns:
+            The number of comments indexed.
+        """
+        batch_size = batch_size or self.batch_size
+        count = 0
+        after_id = 0
+        for last_id, documents in iter_comment_batches(after_id, batch_size):
+            with self.transaction() as connection:
+                self._delete_range(connection, after_id + 1, last_id,
+                                   comments=True)
+                self._insert_comments(connection, documents)
+            count += len(documents)
+            metrics.inc('documents_indexed', len(documents))
+            after_id = last_id
+
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM comment_text WHERE rowid > ?',
+                               (after_id,))
+            connection.execute('DELETE FROM comments WHERE comment_id > ?',
+                               (after_id,))
+        _log.info("Comments rebuilt: %d comments indexed" % count)
+        return count
+
+    def update_index(self, full=False):
+        """ Make the index consistent with the database.
+
+        Every media entry and comment is compared with the index, using only
+        the ids and update times of both, which are quick to read from the
+        index's tables. Full media entries are loaded only for the ids that
+        need (re)indexing.
+
+        Args:
+            full: ignored, every sync compares everything.
+
+        Returns:
+            A dict with the number of media entries 'added', 'updated' and
+            'removed'.
+        """
+        _log.info("Updating index ")
+        start = time.time()
+        counts, changed = self._sync(False)
+        comment_counts, comments_changed = self._sync(True)
+        elapsed = time.time() - start
+        metrics.observe('update_index_seconds', elapsed)
+        if elapsed > 0:
+            metrics.set('update_index_docs_per_second',
+                        (changed + comments_changed) / elapsed)
+        _log.info("Index updated: %(added)d added, %(updated)d updated, "
+                  "%(removed)d removed" % counts)
+        _log.info("Comments updated: %(added)d added, %(updated)d updated, "
+                  "%(removed)d removed" % comment_counts)
+        return counts
+
+    def _sync(self, comments):
+        """Sync the media entries, or the comments, with the database.
+
+        Returns:
+            A (counts, changed) tuple: a dict with the number of documents
+            'added', 'updated' and 'removed', and the number of documents
+            written or removed.
+        """
+        missing, added, updated = self._index_drift(comments=comments)
+        write_changes = self._write_changes
+        if comments:
+            write_changes = self._write_comment_changes
+        with self.transaction() as connection:
+            written, removed = write_changes(connection,
+                                             union(added, updated), missing)
+        counts = {'added': len(intersection(written, added)),
+                  'updated': len(intersection(written, updated)),
+                  'removed': len(removed)}
+        return counts, len(written) + len(removed)
+
+    def is_indexed(self, media_id):
+        return self.connection().execute(
+            'SELECT 1 FROM documents WHERE media_id = ?',
+            (media_id,)).fetchone() is not None
+
+    def check_index(self):
+        """Compare the index with the database without writing to it.
+
+        Returns:
+            A dict of sorted lists of media entry ids, for what update_index
+            would do: processed entries that would be 'added' or 'updated',
+            and indexed entries that would be 'removed' as they no longer
+            exist or aren't processed.
+        """
+        missing, added, updated = self._index_drift()
+        return {'added': list(added),
+                'updated': list(updated),
+                'removed': list(missing)}
+
+    def _index_drift(self, comments=False):
+        """Return the (missing, added, updated) sorted arrays of ids.
+
+        Missing documents are indexed but not in the database, added ones
+        are in the database but not indexed, and updated ones have been
+        updated since they were indexed.
+        Only rows that get a document, e.g. processed media entries, count
+        as in the database, so documents of entries that are no longer
+        processed are missing, and unprocessed entries are never added.
+        """
+        sql, rows = 'SELECT media_id, time FROM documents', MEDIA_ROWS
+        if comments:
+            sql, rows = 'SELECT comment_id, time FROM comments', COMMENT_ROWS
+        indexed = IdTimeTable()
+        for row_id, indexed_time in self.connection().execute(sql):
+            indexed.add(row_id, indexed_time)
+        database_times = (
+            (row_id, time_value(updated)) for row_id, updated
+            in iter_database_times(processed_only=True, rows=rows))
+        return indexed.compare(database_times)
+
+    def apply_changes(self, to_index, to_remove, comments_to_index=(),
+                      comments_to_remove=()):
+        """Apply a batch of changes in a single transaction.
+
+        Args:
+            to_index: ids of media entries to (re)index. Entries that no
+                longer exist or aren't processed are removed from the index.
+            to_remove: ids of media entries to remove from the index.
+            comments_to_index: ids of text comments to (re)index. Comments
+                that no longer exist are removed from the index.
+            comments_to_remove: ids of text comments to remove from the
+                index.
+        """
+        with self.transaction() as connection:
+            self._write_changes(connection, to_index, to_remove)
+            self._write_comment_changes(connection, comments_to_index,
+                                        comments_to_remove)
+
+    def _write_changes(self, connection, to_index, to_remove):
+        """(Re)index and remove media entries in a transaction.
+
+        Returns:
+            A (written, removed) tuple of sorted arrays of media ids: the
+            entries whose document was written, and the indexed entries that
+            were removed because they were asked to be, no longer exist or
+            aren't processed.
+        """
+        to_index = sorted_ids(to_index)
+        written = array(TYPECODE)
+        indexable = array(TYPECODE)
+        for media in iter_media_entries(to_index):
+            with metrics.timer('add_media_entry_seconds'):
+                try:
+                    doc = self.get_doc_for_media_entry(media)
+                except MediaNotProcessedError:
+                    continue
+                indexable.append(media.id)
+                if self.write_document(doc, connection):
+                    written.append(media.id)
+
+        # Entries that have been deleted or unprocessed since are removed
+        candidates = union(sorted_ids(to_remove),
+                           difference(to_index, indexable))
+        removed = array(TYPECODE, (media_id for media_id in candidates
+                                   if self.is_indexed(media_id)))
+        self._delete_documents(connection, removed)
+        metrics.inc('documents_removed', len(removed))
+        return written, removed
+
+    def _write_comment_changes(self, connection, to_index, to_remove):
+        """(Re)index and remove comments in a transaction.
+
+        Returns:
+            A (written, removed) tuple of sorted arrays of text comment ids,
+            like _write_changes.
+        """
+        to_index = sorted_ids(to_index)
+        written = array(TYPECODE)
+        indexable = array(TYPECODE)
+        for doc in iter_comment_documents(to_index):
+            comment_id = doc['comment_id']
+            indexable.append(comment_id)
+            indexed = connection.execute(
+                'SELECT fingerprint FROM comments WHERE comment_id = ?',
+                (comment_id,)).fetchone()
+            if indexed and indexed[0] == document_fingerprint(doc):
+                self.stats['documents_unchanged'] += 1
+                metrics.inc('documents_unchanged')
+                continue
+            if indexed:
+                self._delete_comments(connection, [comment_id])
+            self._insert_comments(connection, [doc])
+            self.stats['documents_written'] += 1
+            metrics.inc('documents_indexed')
+            written.append(comment_id)
+
+        # Comments that have been deleted since, or whose media entry has
+        candidates = union(sorted_ids(to_remove),
+                           difference(to_index, indexable))
+        removed = array(TYPECODE, (
+            comment_id for comment_id in candidates
+            if connection.execute(
+                'SELECT 1 FROM comments WHERE comment_id = ?',
+                (comment_id,)).fetchone()))
+        self._delete_comments(connection, removed)
+        metrics.inc('documents_removed', len(removed))
+        return written, removed
+
+    def write_document(self, doc, connection):
+        """Write a document unless the index already holds an identical one.
+
+        Returns:
+            True if the document was written.
+        """
+        indexed = connection.execute(
+            'SELECT fingerprint FROM documents WHERE media_id = ?',
+            (doc['media_id'],)).fetchone()
+        if indexed and indexed[0] == document_fingerprint(doc):
+            self.stats['documents_unchanged'] += 1
+            metrics.inc('documents_unchanged')
+            return False
+
+        if indexed:
+            self._delete_documents(connection, [doc['media_id']])
+        self._insert_documents(connection, [doc])
+        self.stats['documents_written'] += 1
+        metrics.inc('documents_indexed')
+        return True
+
+    def add_media_entry(self, media):
+        """Index a media entry in a transaction of its own.
+
+        Returns:
+            True if a document was written, False if the media entry isn't
+            processed yet or its document hasn't changed.
+        """
+        with metrics.timer('add_media_entry_seconds'):
+            try:
+                doc = self.get_doc_for_media_entry(media)
+            except MediaNotProcessedError:
+                return False
+            with self.transaction() as connection:
+                return self.write_document(doc, connection)
+
+    def remove_media_entry(self, media_entry_id):
+        """Remove a media entry from the index."""
+        with metrics.timer('remove_media_entry_seconds'):
+            _log.info("Deleting media entry with id: %d" % media_entry_id)
+            with self.transaction() as connection:
+                self._delete_documents(connection, [media_entry_id])
+            metrics.inc('documents_removed')
+
+    def optimize(self, wait=True):
+        """Merge the FTS5 indexes' segments into one, and checkpoint the WAL.
+
+        Args:
+            wait: whether to wait for another writer to finish.
+
+        Returns:
+            False if wait is False and another writer holds the lock.
+        """
+        try:
+            with self.transaction(
+                    timeout=WRITER_TIMEOUT if wait else 0.0) as connection:
+                _log.info("Optimizing index")
+                connection.execute(
+                    "INSERT INTO media_text (media_text) VALUES ('optimize')")
+                connection.execute("INSERT INTO comment_text (comment_text) "
+                                   "VALUES ('optimize')")
+        except sqlite3.OperationalError as error:
+            if wait or 'locked' not in str(error):
+                raise
+            return False
+        self.connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.stats['optimizations'] += 1
+        return True
+
+    def get_index_stats(self):
+        """Return figures for telling whether the index needs merging.
+
+        FTS5 merges its segments as they are written, and deleted rows are
+        dropped by those merges, so the database counts as a single segment
+        without deleted documents.
+        """
+        connection = self.connection()
+        documents = connection.execute(
+            'SELECT COUNT(*) FROM documents').fetchone()[0]
+        comments = connection.execute(
+            'SELECT COUNT(*) FROM comments').fetchone()[0]
+        size = sum(os.path.getsize(path)
+                   for path in (self.path, self.path + '-wal')
+                   if os.path.exists(path))
+        return {'segments': 1,
+                'documents': documents,
+                'deleted_documents': 0,
+                'deleted_ratio': 0.0,
+                'size': size,
+                'comment_documents': comments}
+
+    def get_stats(self):
+        stats = BaseEngine.get_stats(self)
+        for name in 'query_cache', 'parsed_query_cache':
+            for key, value in getattr(self, name).stats.items():
+                stats['%s_%s' % (name, key)] = value
+        return stats
+
+    def parse_query(self, query):
+        """Parse a normalized query string, reusing earlier parses."""
+        parsed = self.parsed_query_cache.get(query)
+        if parsed is None:
+            parsed = parse_query(query, DEFAULT_SEARCH_FIELDS, SEARCH_FIELDS)
+            self.parsed_query_cache.put(query, parsed)
+        return parsed
+
+    @contextmanager
+    def _hits(self, connection, query, filters=None, date_range=None):
+        """Collect the hits of a query into the temporary table 'hits'.
+
+        The table holds the media_id, score and created time of each
+        indexed media entry matching the query and filters. It is dropped
+        when the context exits.
+        """
+        sql, params = compile_query(self.parse_query(query))
+        conditions = []
+        for name, value in sorted((filters or {}).items()):
+            if name not in FACETS:
+                raise ValueError('Unknown facets: %s' % name)
+            if name == 'tag':
+                conditions.append('documents.media_id IN '
+                                  '(SELECT media_id FROM tags WHERE tag = ?)')
+            else:
+                conditions.append('%s = ?' % FACET_COLUMNS[name])
+            params.append(value)
+        start, end = date_range or (None, None)
+        if start is not None:
+            conditions.append('documents.created >= ?')
+            params.append(time_value(start))
+        if end is not None:
+            conditions.append('documents.created <= ?')
+            params.append(time_value(end))
+
+        connection.execute(
+            'CREATE TEMP TABLE hits AS SELECT matches.media_id AS media_id, '
+            'matches.score AS score, documents.created AS created '
+            'FROM (%s) AS matches JOIN documents '
+            'ON documents.media_id = matches.media_id WHERE %s' %
+            (sql, ' AND '.join(conditions) or '1'), params)
+        try:
+            yield
+        finally:
+            connection.execute('DROP TABLE temp.hits')
+
+    def search(self, query):
+        start = time.time()
+        query = normalize_query(query)
+        connection = self.connection()
+        generation = self.generation(connection)
+        key = ('search', query)
+        ids = self.query_cache.get(key, generation)
+        if ids is None:
+            # Only the top 10 hits, like whoosh.Engine.search
+            with self._hits(connection, query):
+                ids = tuple(media_id for media_id, in connection.execute(
+                    'SELECT media_id FROM temp.hits AS hits ORDER BY %s '
+                    'LIMIT 10' % SORT_CLAUSES['relevance']))
+            self.query_cache.put(key, ids, generation)
+        metrics.record_search(time.time() - start, len(ids))
+        return list(ids)
+
+    def _count_facets(self, connection):
+        facets = {}
+        for name in FACETS:
+            column = FACET_COLUMNS[name]
+            join = 'JOIN documents ON documents.media_id = hits.media_id'
+            if name == 'tag':
+                join = 'JOIN tags ON tags.media_id = hits.media_id'
+            facets[name] = [tuple(row) for row in connection.execute(
+                "SELECT %s, COUNT(*) FROM temp.hits AS hits %s "
+                "WHERE %s IS NOT NULL AND %s != '' GROUP BY %s "
+                "ORDER BY COUNT(*) DESC, %s LIMIT ?" %
+                (column, join, column, column, column, column),
+                (self.facet_limit,))]
+        return facets
+
+    def search_page(self, query, page, pagelen, filters=None, sort=None,
+                    date_range=None):
+        """Return one page of the media entries matching a query.
+
+        The matching media entries are collected in a temporary table, which
+        the page, the total and the facets are read from. Pages are cached
+        until the index generation changes.
+
+        Args:
+            query: the query string.
+            page: the page number, starting at 1.
+            pagelen: the number of media entries per page.
+            filters: a dict mapping names in FACETS to the value matching
+                media entries must have.
+            sort: one of SORT_ORDERS, defaults to 'relevance'.
+            date_range: a (start, end) tuple of datetimes the media entries
+                must have been created between. Either may be None.
+
+        Returns:
+            A dict like the whoosh engine's, but without corrections of
+            misspelled words, whose 'correction' is always None.
+        """
+        sort = sort or 'relevance'
+        if sort not in SORT_ORDERS:
+            raise ValueError('Unknown sort order: %s' % sort)
+
+        start = time.time()
+        query = normalize_query(query)
+        filter_key = (tuple(sorted((filters or {}).items())), date_range)
+        connection = self.connection()
+        # Read everything from a single snapshot of the database
+        connection.execute('BEGIN')
+        try:
+            generation = self.generation(connection)
+            key = ('page', query, page, pagelen, filter_key, sort)
+            cached = self.query_cache.get(key, generation)
+            if cached is None:
+                cached = self._search_page(connection, query, page, pagelen,
+                                           filters, sort, date_range,
+                                           generation)
+                self.query_cache.put(key, cached, generation)
+        finally:
+            connection.execute('COMMIT')
+
+        page = dict(cached, ids=list(cached['ids']))
+        if 'fields' in cached:
+            page['fields'] = list(cached['fields'])
+        metrics.record_search(time.time() - start, page['total'])
+        return page
+
+    def _search_page(self, connection, query, page, pagelen, filters, sort,
+                     date_range, generation):
+        filter_key = (tuple(sorted((filters or {}).items())), date_range)
+        with self._hits(connection, query, filters, date_range):
+            total = connection.execute(
+                'SELECT COUNT(*) FROM temp.hits').fetchone()[0]
+            hits = connection.execute(
+                'SELECT hits.media_id, documents.result '
+                'FROM temp.hits AS hits JOIN documents '
+                'ON documents.media_id = hits.media_id '
+                'ORDER BY %s LIMIT ? OFFSET ?' % SORT_CLAUSES[sort],
+                (pagelen, (page - 1) * pagelen)).fetchall()
+            facets_key = ('facets', query, filter_key)
+            facets = self.query_cache.get(facets_key, generation)
+            if facets is None:
+                facets = self._count_facets(connection)
+                self.query_cache.put(facets_key, facets, generation)
+
+        cached = {'ids': tuple(media_id for media_id, _ in hits),
+                  'total': total,
+                  'pagecount': (total + pagelen - 1) // pagelen,
+                  'facets': facets,
+                  'correction': None}
+        if self.store_result_fields:
+            cached['fields'] = tuple(json.loads(result) if result else None
+                                     for _, result in hits)
+        return cached
+
+    def get_prefix_index(self):
+        """Return the prefix index of the latest generation of the index.
+
+        Titles are completed from the words of the FTS5 vocabulary, tags and
+        uploaders from their columns.
+        """
+        connection = self.connection()
+        generation = self.generation(connection)
+        with self._prefix_lock:
+            prefix_index, built_at = self._prefix_index
+            if prefix_index is None or built_at != generation:
+                prefix_index = PrefixIndex({
+                    'tag': [tag for tag, in connection.execute(
+                        'SELECT DISTINCT tag FROM tags')],
+                    'user': [user for user, in connection.execute(
+                        'SELECT DISTINCT user FROM documents '
+                        'WHERE user IS NOT NULL')],
+                    'title': [term for term, in connection.execute(
+                        "SELECT term FROM media_terms WHERE col = 'title'")]})
+                self._prefix_index = (prefix_index, generation)
+                self.stats['prefix_index_builds'] += 1
+            return prefix_index
+
+    def suggest(self, prefix, limit):
+        """Return up to limit completions of a prefix.
+
+        Returns:
+            A list of (kind, term) tuples, kind being 'tag', 'user' or
+            'title'.
+        """
+        return self.get_prefix_index().complete(prefix, limit)
@@ -1,17 +1,83 @@
 import os
+import time
 import logging
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import repeat
 
 import whoosh.index
 import whoosh.fields
+import whoosh.columns
+import whoosh.query
+import whoosh.matching
+import whoosh.idsets
+import whoosh.reading
+import whoosh.sorting
+import whoosh.spelling
+import whoosh.searching
+import whoosh.collectors
 import whoosh.writing
+import whoosh.multiproc
 import whoosh.qparser
 
 from mediagoblin.db.models import MediaEntry
-from indexedsearch.backends import BaseEngine, MediaNotProcessedError
+from whoosh.automata.fsa import find_all_matches
+from whoosh.automata.lev import levenshtein_automaton
+
+from indexedsearch.cache import QueryCache, normalize_query
+from indexedsearch.idsets import (IdTimeTable, TYPECODE, UNKNOWN_TIME,
+                                  difference, intersection, sorted_ids, union)
+from indexedsearch.metrics import metrics
+from indexedsearch.suggest import PrefixIndex
+from indexedsearch.backends import (BaseEngine, MediaNotProcessedError,
+                                    FACETS, SORT_ORDERS, ID_RANGE_SIZE,
+                                    MAX_WATERMARK_CHANGES, MEDIA_ROWS,
+                                    COMMENT_ROWS, changed_since,
+                                    database_watermark, document_fingerprint,
+                                    dump_watermark, id_range_checksums,
+                                    load_watermark, processed_count,
+                                    processed_ids_in_ranges, time_value,
+                                    iter_comment_batches,
+                                    iter_comment_documents,
+                                    iter_database_times,
+                                    iter_document_batches,
+                                    iter_media_entries)
 
 _log = logging.getLogger(__name__)
 INDEX_NAME = 'media_entries'
+COMMENT_INDEX_NAME = 'comments'
 DEFAULT_SEARCH_FIELDS = ['title', 'description', 'tag', 'comment']
+# The field each facet is counted from
+FACET_FIELDS = {'tag': 'facet_tag',
+                'user': 'facet_user',
+                'media_type': 'facet_media_type'}
+# The field each kind of suggestion is completed from
+SUGGESTION_FIELDS = {'tag': 'facet_tag',
+                     'user': 'facet_user',
+                     'title': 'title'}
+# Fields whose terms misspelled query words are corrected to
+CORRECTION_FIELDS = ['title', 'description', 'tag']
+# How commits merge small segments, by INDEX_MERGE_POLICY option
+MERGE_POLICIES = {'small': whoosh.writing.MERGE_SMALL,
+                  'none': whoosh.writing.NO_MERGE}
+# Seconds a rebuild waits for other writers to release the index lock
+WRITER_TIMEOUT = 60.0
+
+
+def _positionless_phrase(query, schema):
+    """Turn a phrase in a field without positions into a query for its words.
+
+    Unfielded phrases are searched for in every default field, and searching
+    for a phrase in a field that doesn't record word positions, such as
+    tag, raises a QueryError.
+    """
+    if isinstance(query, whoosh.query.Phrase):
+        field = schema[query.fieldname] if query.fieldname in schema else None
+        if field is not None and not field.format.supports('positions'):
+            return whoosh.query.And([whoosh.query.Term(query.fieldname, word)
+                                     for word in query.words])
+    return query
 
 
 class MediaEntrySchema(whoosh.fields.SchemaClass):
@@ -23,66 +89,887 @@ class MediaEntrySchema(whoosh.fields.SchemaClass):
     tag = whoosh.fields.KEYWORD
     # collection = whoosh.fields.KEYWORD(commas=True)
     time = whoosh.fields.DATETIME(stored=True)
+    # A column, so that hits are sorted without loading stored fields
+    created = whoosh.fields.DATETIME(sortable=True)
     user = whoosh.fields.TEXT
     comment = whoosh.fields.TEXT
+    # Untokenized copies of fields, for counting and filtering results.
+    # Tag vectors let each hit's tags be read without scanning the lexicon.
+    facet_tag = whoosh.fields.KEYWORD(commas=True, vector=True)
+    facet_user = whoosh.fields.ID(sortable=True)
+    facet_media_type = whoosh.fields.ID(sortable=True)
+    fingerprint = whoosh.fields.STORED
+    # Column copies of the id and time, so that the index is compared with
+    # the database without loading every document's stored fields
+    media_id_column = whoosh.fields.COLUMN(whoosh.columns.NumericColumn('I'))
+    time_column = whoosh.fields.COLUMN(whoosh.columns.NumericColumn('q'))
+    # Only filled in with the STORE_RESULT_FIELDS option
+    result = whoosh.fields.STORED
+
+
+class CommentSchema(whoosh.fields.SchemaClass):
+    """ Whoosh schema for TextComment objects on media entries.
+
+    Comments are kept in an index of their own, one document per comment, so
+    adding, editing or deleting a comment only writes its own document.
+    """
+    comment_id = whoosh.fields.NUMERIC(signed=False, unique=True, stored=True)
+    # A column, so that the media entries of matching comments are found
+    # without loading stored fields
+    media_id = whoosh.fields.NUMERIC(signed=False, stored=True, sortable=True)
+    comment = whoosh.fields.TEXT
+    time = whoosh.fields.DATETIME(stored=True)
+    fingerprint = whoosh.fields.STORED
+    comment_id_column = whoosh.fields.COLUMN(
+        whoosh.columns.NumericColumn('I'))
+    time_column = whoosh.fields.COLUMN(whoosh.columns.NumericColumn('q'))
+
+
+class DocumentKind(object):
+    """An index of one kind of document, and the rows it's synced with."""
+
+    def __init__(self, name, index_name, schema, key, rows):
+        """
+        Args:
+            name: the name of the kind, for logging.
+            index_name: the name of the whoosh index in the index directory.
+            schema: the schema class of the index.
+            key: the unique numeric field documents are keyed by.
+            rows: the IndexedRows documents are built from.
+        """
+        self.name = name
+        self.index_name = index_name
+        self.schema = schema
+        self.key = key
+        self.rows = rows
+
+    def shard(self, number, count):
+        """Return the kind of document held by one of count shards."""
+        return DocumentKind(self.name, self.index_name, self.schema,
+                            self.key, self.rows.shard(number, count))
+
+
+MEDIA = DocumentKind('media entries', INDEX_NAME, MediaEntrySchema,
+                     'media_id', MEDIA_ROWS)
+COMMENTS = DocumentKind('comments', COMMENT_INDEX_NAME, CommentSchema,
+                        'comment_id', COMMENT_ROWS)
+
+
+def _with_columns(doc, key='media_id'):
+    """Return a document with its column copies of the id and time."""
+    return dict(doc, time_column=time_value(doc.get('time')),
+                **{key + '_column': doc[key]})
+
+
+def media_id_range(start, end=None, fieldname='media_id'):
+    """Return a query for documents with a media id from start to end.
+
+    Whoosh's NumericRange splits ranges of unsigned fields wrongly, e.g. a
+    range of a single id matches every document, so this matches the full
+    precision terms of the ids instead.
+
+    Args:
+        start: the lowest media id.
+        end: the highest media id, or None for no limit.
+        fieldname: the id field, e.g. 'comment_id' for comment ids.
+    """
+    field = MediaEntrySchema()['media_id']
+    if end is None:
+        end = field.max_value
+    return whoosh.query.TermRange(fieldname, field.to_bytes(start),
+                                  field.to_bytes(end))
+
+
+def column_reader(reader, fieldname):
+    """Return a reader of a column's raw values by top level document number.
+
+    Whoosh's MultiReader leaves segments without the column out of its
+    column reader, which then reads the documents after them from the wrong
+    segment. Here, such segments read as the column's default value.
+    """
+    leaves = [(leaf, offset) for leaf, offset in reader.leaf_readers()
+              if leaf.doc_count_all()]
+    return whoosh.columns.MultiColumnReader(
+        [leaf.column_reader(fieldname, translate=False)
+         for leaf, _ in leaves],
+        [offset for _, offset in leaves])
+
+
+class MediaScoreQuery(whoosh.query.Query):
+    """Matches media entries by id, each with a score of its own.
+
+    Each id is looked up in the media_id terms of the index, so matching
+    costs as much as the number of ids, not the size of the index. Unlike an
+    Or of boosted Terms, ids used by a single document are read from their
+    term info rather than a matcher of their own.
+    """
+
+    def __init__(self, scores):
+        """
+        Args:
+            scores: a dict mapping the ids of the media entries to match to
+                their scores.
+        """
+        self.scores = scores
+
+    def __unicode__(self):
+        return u'<scores of %d media entries>' % len(self.scores)
+
+    __str__ = __unicode__
+
+    def __repr__(self):
+        return '%s(<%d media entries>)' % (self.__class__.__name__,
+                                           len(self.scores))
+
+    def __eq__(self, other):
+        return (self.__class__ is other.__class__ and
+                self.scores == other.scores)
+
+    def __hash__(self):
+        return hash((self.__class__.__name__, len(self.scores)))
+
+    def field(self):
+        return None
+
+    def estimate_size(self, ixreader):
+        return min(len(self.scores), ixreader.doc_count())
+
+    def estimate_min_size(self, ixreader):
+        return 0
+
+    def matcher(self, searcher, context=None):
+        field = searcher.schema['media_id']
+        hits = []
+        for segment, offset in searcher.reader().leaf_readers():
+            has_deletions = segment.has_deletions()
+            for media_id, score in self.scores.items():
+                text = field.to_bytes(media_id)
+                try:
+                    info = segment.term_info('media_id', text)
+                except whoosh.reading.TermNotFound:
+                    continue
+                # Only replaced documents share their media id with others
+                if info.doc_frequency() == 1:
+                    docnums = [info.min_id()]
+                else:
+                    docnums = segment.postings('media_id', text).all_ids()
+                for docnum in docnums:
+                    if not (has_deletions and segment.is_deleted(docnum)):
+                        hits.append((offset + docnum, score))
+        if not hits:
+            return whoosh.matching.NullMatcher()
+        hits.sort()
+        return whoosh.matching.ListMatcher([docnum for docnum, _ in hits],
+                                           [score for _, score in hits])
+
+
+class SubsegmentWriter(whoosh.multiproc.MpWriter):
+    """Merges sub-segments written by other processes into one segment.
+
+    Unlike whoosh's multiprocessing writer, which sends documents to worker
+    processes of its own, the sub-segments are handed to it, so that the
+    processes writing them can build their documents too.
+    """
+
+    def __init__(self, ix, **kwargs):
+        # Without the multiprocessing writer's task queues
+        whoosh.writing.SegmentWriter.__init__(self, ix, **kwargs)
+        self.tasks = []
+        self.subsegments = []
+        self._added_sub = False
+
+    def add_subsegment(self, subsegment):
+        """Add a sub-segment returned by Engine.write_subsegment."""
+        self.subsegments.append(subsegment)
+        self._added_sub = True
+
+    def _commit(self, mergetype, optimize, merge):
+        finalsegments = self._merge_segments(mergetype, optimize, merge)
+        self._merge_subsegments(self.subsegments, mergetype)
+        self._close_segment()
+        self._assemble_segment()
+        finalsegments.append(self.get_segment())
+        self._commit_toc(finalsegments)
+        self._finish()
+
+
+class TermCorrector(whoosh.spelling.Corrector):
+    """Suggests corrections from the terms of several fields of a reader.
+
+    The terms are read into a sorted list once, so suggestions don't go back
+    to the reader. They are ranked by edit distance, then by how many
+    documents use them.
+    """
+
+    def __init__(self, reader, fieldnames):
+        self.frequencies = {}
+        for fieldname in fieldnames:
+            if fieldname not in reader.schema:
+                continue
+            from_bytes = reader.schema[fieldname].from_bytes
+            for btext, terminfo in reader.iter_field(fieldname):
+                text = from_bytes(btext)
+                self.frequencies[text] = (self.frequencies.get(text, 0) +
+                                          terminfo.doc_frequency())
+        self.wordlist = sorted(self.frequencies)
+
+    def __contains__(self, word):
+        return word in self.frequencies
+
+    def _next_word(self, word):
+        position = bisect_left(self.wordlist, word)
+        if position < len(self.wordlist):
+            return self.wordlist[position]
+        return None
+
+    def _suggestions(self, text, maxdist, prefix):
+        seen = set()
+        for distance in range(1, maxdist + 1):
+            dfa = levenshtein_automaton(text, distance, prefix).to_dfa()
+            for suggestion in find_all_matches(dfa, self._next_word):
+                if suggestion not in seen:
+                    seen.add(suggestion)
+                    frequency = self.frequencies[suggestion]
+                    yield (0 - (distance + 0.5 / frequency), suggestion)
+
+
+def build_prefix_index(reader):
+    """Return a PrefixIndex of the suggestion fields' terms in a reader."""
+    return PrefixIndex(dict(
+        (kind, reader.field_terms(fieldname))
+        for kind, fieldname in SUGGESTION_FIELDS.items()
+        if fieldname in reader.schema))
+
+
+def top_facet_values(counts, limit):
+    """Return the (value, count) tuples of the most common facet values.
+
+    Args:
+        counts: a dict mapping facet values to their number of hits.
+        limit: the number of values to return.
+    """
+    counts = [(value, count) for value, count in counts.items() if value]
+    counts.sort(key=lambda item: (-item[1], item[0]))
+    return counts[:limit]
+
+
+class _VectorCategorizer(whoosh.sorting.OverlappingCategorizer):
+    """Reads a document's keys from its term vector.
+
+    Unlike OverlappingCategorizer, documents without a vector for the
+    field, e.g. media entries without tags, don't raise an error.
+    """
+
+    def keys_for(self, matcher, docid):
+        if not self._segment_searcher.reader().has_vector(docid,
+                                                          self._fieldname):
+            return []
+        return whoosh.sorting.OverlappingCategorizer.keys_for(
+            self, matcher, docid)
+
+
+class VectorFacet(whoosh.sorting.FieldFacet):
+    """Groups documents by every term in their vector for a field."""
+
+    def __init__(self, fieldname, maptype=None):
+        whoosh.sorting.FieldFacet.__init__(self, fieldname,
+                                           allow_overlap=True,
+                                           maptype=maptype)
+
+    def categorizer(self, global_searcher):
+        return _VectorCategorizer(global_searcher, self.fieldname)
 
 
 class Engine(BaseEngine):
 
     def __init__(self, **connection_options):
         self.index_dir = connection_options.get('INDEX_DIR')
+        self.procs = connection_options.get('INDEX_PROCESSES') or 1
+        self.batch_size = connection_options.get('INDEX_BATCH_SIZE') or 1000
+        self.store_result_fields = bool(
+            connection_options.get('STORE_RESULT_FIELDS'))
+        self.facet_limit = connection_options.get('FACET_LIMIT', 10)
+        self.mergetype = MERGE_POLICIES[
+            connection_options.get('INDEX_MERGE_POLICY') or 'small']
+        self.stats = {'searcher_reused': 0, 'searcher_reopened': 0,
+                      'documents_written': 0, 'documents_unchanged': 0,
+                      'prefix_index_builds': 0, 'corrector_builds': 0,
+                      'optimizations': 0, 'partial_searches': 0}
+        # Seconds a search may spend collecting hits, 0 for no limit
+        self.time_limit = connection_options.get('SEARCH_TIME_LIMIT') or 0
+        # Results are cached per index generation. Parsed queries only
+        # depend on the schema, so they are kept across generations.
+        cache_size = connection_options.get('QUERY_CACHE_SIZE', 256)
+        cache_ttl = connection_options.get('QUERY_CACHE_TTL', 300.0)
+        self.query_cache = QueryCache(cache_size, cache_ttl)
+        self.parsed_query_cache = QueryCache(cache_size, cache_ttl)
+        # Facet filters, as sets of document numbers of a generation
+        self.filter_cache = QueryCache(cache_size, cache_ttl)
+        # Whoosh readers keep file positions, so searchers can't be used by
+        # several threads at once. Each thread keeps its own searcher.
+        self._local = threading.local()
+        # Lookup structures shared by every thread, each rebuilt the first
+        # time it's needed after the generation changes.
+        self._generation_lock = threading.Lock()
+        self._generation_cache = {}
+        self.correction_threshold = connection_options.get(
+            'CORRECTION_THRESHOLD', 1)
+        # A (number, count) tuple when the index only holds one shard of the
+        # media entries, see indexedsearch.backends.sharded
+        self.media_kind = MEDIA
+        self.comment_kind = COMMENTS
+        shard = connection_options.get('INDEX_SHARD')
+        if shard is not None:
+            self.media_kind = MEDIA.shard(*shard)
+            self.comment_kind = COMMENTS.shard(*shard)
 
         try:
             self.index = whoosh.index.open_dir(self.index_dir,
                                                indexname=INDEX_NAME)
         except whoosh.index.EmptyIndexError:
             self.maybe_create_index()
+        self.upgrade_schema()
+        self.comment_index = self.open_comment_index()
+
+    def upgrade_schema(self):
+        """Add fields that an index created by an older version lacks."""
+        schema = self.index.schema
+        missing = [(name, field) for name, field in MediaEntrySchema().items()
+                   if name not in schema]
+        if not missing:
+            return
+
+        with self.open_writer(timeout=WRITER_TIMEOUT) as writer:
+            for name, field in missing:
+                _log.info("Adding field %s to the index" % name)
+                writer.add_field(name, field)
+
+    def rebuild_index(self, procs=None, batch_size=None, progress=None):
+        """Replace the index with one built from scratch from the database.
+
+        Media entries are indexed in id order, one batch per commit. Each
+        batch replaces every indexed document in its id range, so searches
+        keep working on the rest of the index while it is rebuilt. After each
+        commit the last indexed id is saved as a checkpoint in the index
+        directory, and an interrupted rebuild resumes from there.
+
+        With more than one process, each batch is split between forked
+        worker processes, which build the documents for their part of it and
+        write them into a sub-segment. The sub-segments are merged into a
+        single segment on commit, so documents never leave the process that
+        built them.
+
+        Args:
+            procs: the number of processes to use, defaults to the
+                INDEX_PROCESSES option.
+            batch_size: how many media entries to index per commit, defaults
+                to the INDEX_BATCH_SIZE option.
+            progress: a callable called with the number of media entries
+                indexed so far and the last indexed id, after each commit.
+
+        Returns:
+            The number of media entries indexed.
+        """
+        self.rebuild_comments(batch_size)
+        procs = procs or self.procs
+        batch_size = batch_size or self.batch_size
+        # Until the rebuild is done, syncs have to compare every entry
+        self.clear_watermark()
+        watermark = None
+        after_id = self.read_checkpoint() or 0
+        if after_id:
+            _log.info("Resuming rebuild after media entry %d" % after_id)
+        else:
+            # Entries indexed before an interruption may have changed since,
+            # so a resumed rebuild leaves the next sync to compare everything
+            watermark = database_watermark(self.media_kind.rows)
+        _log.info("Rebuilding index using %d process(es)" % procs)
+
+        count = 0
+        start = time.time()
+        finish = None
+        if procs > 1:
+            finish = self.write_subsegment
+        for last_id, documents in iter_document_batches(
+                self, after_id, batch_size, procs, self.media_kind.rows,
+                finish):
+            batch_count = 0
+            if finish is None:
+                writer = self.open_writer(timeout=WRITER_TIMEOUT)
+            else:
+                writer = self.open_writer(writer_class=SubsegmentWriter,
+                                          timeout=WRITER_TIMEOUT)
+            try:
+                writer.delete_by_query(media_id_range(after_id + 1, last_id))
+                if finish is None:
+                    for doc in documents:
+                        writer.add_document(
+                            fingerprint=document_fingerprint(doc),
+                            **_with_columns(doc))
+                    batch_count = len(documents)
+                else:
+                    for part_count, subsegment in documents:
+                        if subsegment is not None:
+                            writer.add_subsegment(subsegment)
+                        batch_count += part_count
+            except BaseException:
+                writer.cancel()
+                raise
+            self.commit(writer)
+
+            count += batch_count
+            metrics.inc('documents_indexed', batch_count)
+            self.write_checkpoint(last_id)
+            after_id = last_id
+            if progress is not None:
+                progress(count, last_id)
+
+        self._remove_missing_after(after_id)
+        self.clear_checkpoint()
+        if watermark is not None:
+            self.write_watermark(watermark)
+        elapsed = time.time() - start
+        if elapsed > 0:
+            metrics.set('rebuild_docs_per_second', count / elapsed)
+        _log.info("Index rebuilt: %d media entries indexed" % count)
+        return count
+
+    def write_subsegment(self, documents):
+        """Write media entry documents into a sub-segment of the index.
+
+        The index isn't locked, as the SubsegmentWriter the sub-segment is
+        added to holds the lock.
+
+        Returns:
+            A (count, subsegment) tuple, subsegment being None without
+            documents.
+        """
+        if not documents:
+            return 0, None
+        writer = whoosh.writing.SegmentWriter(self.index, _lk=False)
+        for doc in documents:
+            writer.add_document(fingerprint=document_fingerprint(doc),
+                                **_with_columns(doc))
+        return len(documents), whoosh.multiproc.finish_subsegment(writer)
+
+    def rebuild_comments(self, batch_size=None):
+        """Reindex every comment from the database.
+
+        Like media entries, comments are indexed in id order, and each batch
+        replaces the indexed comments in its id range. There are no
+        checkpoints, as comment documents are small and quick to build.
+
+        Returns:
+            The number of comments indexed.
+        """
+        batch_size = batch_size or self.batch_size
+        self.clear_watermark(COMMENTS)
+        watermark = database_watermark(self.comment_kind.rows)
+        count = 0
+        after_id = 0
+        for last_id, documents in iter_comment_batches(
+                after_id, batch_size, self.comment_kind.rows):
+            writer = self.open_writer(index=self.comment_index,
+                                      timeout=WRITER_TIMEOUT)
+            try:
+                writer.delete_by_query(
+                    media_id_range(after_id + 1, last_id, 'comment_id'))
+                for doc in documents:
+                    writer.add_document(
+                        fingerprint=document_fingerprint(doc),
+                        **_with_columns(doc, 'comment_id'))
+            except BaseException:
+                writer.cancel()
+                raise
+            self.commit(writer)
+            count += len(documents)
+            metrics.inc('documents_indexed', len(documents))
+            after_id = last_id
+
+        query = media_id_range(after_id + 1, fieldname='comment_id')
+        if self.get_comment_searcher().search(query, limit=1):
+            with self.open_writer(index=self.comment_index,
+                                  timeout=WRITER_TIMEOUT) as writer:
+                writer.delete_by_query(query)
+        self.write_watermark(watermark, COMMENTS)
+        _log.info("Comments rebuilt: %d comments indexed" % count)
+        return count
+
+    def _remove_missing_after(self, media_id):
+        """Remove indexed entries past an id that aren't in the database."""
+        query = media_id_range(media_id + 1)
+        indexed_ids = [fields['media_id'] for fields
+                       in self.get_searcher().search(query, limit=None)]
+        if not indexed_ids:
+            return
+
+        # Entries of other shards count as missing from this one
+        existing_ids = set(
+            media_id for media_id, in self.media_kind.rows.query(
+                MediaEntry.id).filter(MediaEntry.id.in_(indexed_ids)))
+        writer = self.async_writer()
+        try:
+            for media_id in set(indexed_ids).difference(existing_ids):
+                self.remove_media_entry(media_id, writer)
+        except BaseException:
+            writer.cancel()
+            raise
+        self.commit(writer)
+
+    @property
+    def checkpoint_path(self):
+        return os.path.join(self.index_dir, INDEX_NAME + '.checkpoint')
+
+    def read_checkpoint(self):
+        """Return the last id indexed by an interrupted rebuild, or None."""
+        try:
+            with open(self.checkpoint_path) as checkpoint:
+                return int(checkpoint.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write_checkpoint(self, media_id):
+        # Write then rename, so a crash can't leave a truncated checkpoint
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as checkpoint:
+            checkpoint.write('%d' % media_id)
+        os.rename(tmp_path, self.checkpoint_path)
+
+    def clear_checkpoint(self):
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
 
-    def update_index(self):
+    def update_index(self, full=False):
         """ Make an index consistent with the database.
 
         Removes media entries from the index that aren't in the database.
         Indexes media entries that are in the database but not in the index.
         Re-indexes media entries that have been updated since they were last
-        indexed.
+        indexed. Comments are synced with the comment index the same way.
+
+        The database is only asked for (id, updated) pairs, and full media
+        entries are loaded only for the ids that need (re)indexing.
+
+        After each sync, the latest update time and highest id of the media
+        entries are saved as a watermark in the index directory. The next
+        sync only looks at entries updated or added since then. Deleted
+        entries are noticed by the number of processed entries differing
+        from the number of indexed documents, in which case only the id
+        ranges whose counts or sums of ids differ are compared.
 
         Args:
-            dirname: directory containing the index.
+            full: compare every media entry and comment with the index,
+                rather than only those changed since the watermark.
+
+        Returns:
+            A dict with the number of media entries 'added', 'updated' and
+            'removed'.
         """
         _log.info("Updating index ")
+        start = time.time()
+        counts, changed = self._sync(self.media_kind, full)
+        comment_counts, comments_changed = self._sync(self.comment_kind,
+                                                      full)
+        elapsed = time.time() - start
+        metrics.observe('update_index_seconds', elapsed)
+        if elapsed > 0:
+            metrics.set('update_index_docs_per_second',
+                        (changed + comments_changed) / elapsed)
+        _log.info("Index updated: %(added)d added, %(updated)d updated, "
+                  "%(removed)d removed" % counts)
+        _log.info("Comments updated: %(added)d added, %(updated)d updated, "
+                  "%(removed)d removed" % comment_counts)
+        return counts
+
+    def _sync(self, kind, full=False):
+        """Make the index of a kind of document consistent with the database.
+
+        Returns:
+            A (counts, changed) tuple: a dict with the number of documents
+            'added', 'updated' and 'removed', and the number of documents
+            written or removed.
+        """
+        watermark = None if full else self.read_watermark(kind)
+        # Taken before looking for changes, so none are missed next time
+        new_watermark = database_watermark(kind.rows)
+        changes = None
+        if watermark is not None:
+            changes = self._changes_since(watermark, kind)
+        if changes is None:
+            watermark = None
+            missing, added, updated = self._index_drift(kind=kind)
+        else:
+            missing = array(TYPECODE)
+            added, updated = changes
+
+        commit_changes = self._commit_changes
+        if kind.index_name == COMMENT_INDEX_NAME:
+            commit_changes = self._commit_comment_changes
+        written, removed = commit_changes(union(added, updated), missing)
+        if watermark is not None:
+            to_index, to_remove = self._range_drift(kind)
+            if to_index or to_remove:
+                more_written, more_removed = commit_changes(to_index,
+                                                            to_remove)
+                added = union(added, to_index)
+                written = union(written, more_written)
+                removed = union(removed, more_removed)
+        self.write_watermark(new_watermark, kind)
+
+        counts = {'added': len(intersection(written, added)),
+                  'updated': len(intersection(written, updated)),
+                  'removed': len(removed)}
+        return counts, len(written) + len(removed)
+
+    def _changes_since(self, watermark, kind=None):
+        """Return (added, updated) arrays of ids changed since a watermark.
+
+        Returns:
+            None if more than MAX_WATERMARK_CHANGES rows changed, as it's
+            then quicker to compare every document.
+        """
+        kind = kind or self.media_kind
+        changed = changed_since(watermark, kind.rows).order_by(
+            kind.rows.id_column).limit(MAX_WATERMARK_CHANGES + 1).all()
+        if len(changed) > MAX_WATERMARK_CHANGES:
+            return None
+
+        searcher = self._searcher_for(kind)
+        added = array(TYPECODE)
+        updated = array(TYPECODE)
+        for row_id, database_time in changed:
+            indexed = searcher.document(**{kind.key: row_id})
+            if indexed is None:
+                added.append(row_id)
+            elif (indexed.get('time') is None or
+                  database_time > indexed['time']):
+                updated.append(row_id)
+        return added, updated
+
+    def _range_drift(self, kind=None):
+        """Find documents missed by the watermark, e.g. deleted ones.
+
+        Returns:
+            A (to_index, to_remove) tuple of sorted arrays of ids, both empty
+            if the index holds as many documents as there are indexable
+            rows, e.g. processed entries.
+        """
+        kind = kind or self.media_kind
+        searcher = self._searcher_for(kind)
+        if searcher.doc_count() == processed_count(kind.rows):
+            return array(TYPECODE), array(TYPECODE)
+
+        _log.info("Index and database differ, comparing id ranges of %s" %
+                  kind.name)
+        indexed = self._indexed_times(kind)
+        indexed_ranges = indexed.range_checksums(ID_RANGE_SIZE)
+        database_ranges = id_range_checksums(rows=kind.rows)
+        differing = sorted(
+            number for number in set(indexed_ranges).union(database_ranges)
+            if indexed_ranges.get(number) != database_ranges.get(number))
+
+        indexed_ids = array(TYPECODE)
+        for number in differing:
+            indexed_ids.extend(indexed.ids(number * ID_RANGE_SIZE,
+                                           (number + 1) * ID_RANGE_SIZE))
+        database_ids = processed_ids_in_ranges(differing, rows=kind.rows)
+        return (difference(database_ids, indexed_ids),
+                difference(indexed_ids, database_ids))
+
+    @property
+    def watermark_path(self):
+        return self._watermark_path(MEDIA)
+
+    def _watermark_path(self, kind):
+        return os.path.join(self.index_dir, kind.index_name + '.watermark')
+
+    def read_watermark(self, kind=MEDIA):
+        """Return the watermark saved by the last sync, or None."""
+        try:
+            with open(self._watermark_path(kind)) as watermark:
+                return load_watermark(watermark.read())
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def write_watermark(self, watermark, kind=MEDIA):
+        path = self._watermark_path(kind)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as watermark_file:
+            watermark_file.write(dump_watermark(watermark))
+        os.rename(tmp_path, path)
+
+    def clear_watermark(self, kind=MEDIA):
+        path = self._watermark_path(kind)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def is_indexed(self, media_id):
+        return self.get_searcher().document(media_id=media_id) is not None
+
+    def check_index(self):
+        """Compare the index with the database without writing to it.
+
+        As in update_index, entries that aren't processed don't count as
+        missing from the index, as there is nothing to index for them.
+
+        Returns:
+            A dict of sorted lists of media entry ids, for what update_index
+            would do: processed entries that would be 'added' or 'updated',
+            and indexed entries that would be 'removed' as they no longer
+            exist or aren't processed.
+        """
+        missing, added, updated = self._index_drift()
+        return {'added': list(added),
+                'updated': list(updated),
+                'removed': list(missing)}
+
+    def _index_drift(self, kind=None):
+        """Return the (missing, added, updated) sorted arrays of ids.
+
+        Missing documents are indexed but not in the database, added ones
+        are in the database but not indexed, and updated ones have been
+        updated since they were indexed.
+        Only rows that get a document, e.g. processed media entries, count
+        as in the database, so documents of entries that are no longer
+        processed are missing, and unprocessed entries are never added.
+        """
+        kind = kind or self.media_kind
+        indexed = self._indexed_times(kind)
+        database_times = (
+            (row_id, time_value(updated)) for row_id, updated
+            in iter_database_times(processed_only=True, rows=kind.rows))
+        return indexed.compare(database_times)
 
-        # The set of all media in the index
-        indexed_media = set()
-        # The set of all media we need to re-index
-        to_index = set()
-
-        with self.index.searcher() as searcher:
-            with whoosh.writing.AsyncWriter(self.index) as writer:
-                # Loop over the stored fields in the index
-                for fields in searcher.all_stored_fields():
-                    media_id = fields['media_id']
-                    indexed_media.add(media_id)
-
-                    media = MediaEntry.query.filter_by(id=media_id).first()
-                    if not media:
-                        # This entry has been deleted since it was indexed
-                        self.remove_media_entry(media_id, writer)
-                    else:
-                        # Check if this file was changed since it
-                        # was indexed
-                        indexed_time = fields['time']
-                        last_updated = media.updated
-                        if last_updated > indexed_time:
-                            # The file has changed, delete it and add it to the
-                            # list of files to reindex
-                            writer.delete_by_term('media_id', media_id)
-                            to_index.add(media_id)
-
-                for media in MediaEntry.query.all():
-                    if media.id in to_index or media.id not in indexed_media:
-                        # This is either a entry that's changed, or a new entry
-                        # that wasn't indexed before. So index it!
-                        self.add_media_entry(media, writer)
+    def _indexed_times(self, kind=MEDIA):
+        """Return an IdTimeTable of the indexed ids and times.
+
+        Ids and times are read from their columns. Only documents written
+        before the columns were added to the schema are read from their
+        stored fields.
+        """
+        table = IdTimeTable()
+        id_column = kind.key + '_column'
+        reader = self._searcher_for(kind).reader()
+        for segment, _ in reader.leaf_readers():
+            if segment.has_column(id_column):
+                pairs = zip(
+                    segment.column_reader(id_column, translate=False),
+                    segment.column_reader('time_column', translate=False))
+            else:
+                pairs = repeat((0, 0), segment.doc_count_all())
+            has_deletions = segment.has_deletions()
+            for docnum, (row_id, indexed_time) in enumerate(pairs):
+                if has_deletions and segment.is_deleted(docnum):
+                    continue
+                if not row_id:
+                    fields = segment.stored_fields(docnum)
+                    row_id = fields[kind.key]
+                    indexed_time = time_value(fields.get('time'))
+                # Documents indexed without a time are treated as out of date
+                table.add(row_id, indexed_time or UNKNOWN_TIME)
+        return table
+
+    def apply_changes(self, to_index, to_remove, comments_to_index=(),
+                      comments_to_remove=()):
+        """Apply a batch of changes with a single commit per index.
+
+        Args:
+            to_index: ids of media entries to (re)index. Entries that no
+                longer exist or aren't processed are removed from the index.
+            to_remove: ids of media entries to remove from the index.
+            comments_to_index: ids of text comments to (re)index. Comments
+                that no longer exist are removed from the index.
+            comments_to_remove: ids of text comments to remove from the
+                index.
+        """
+        if to_index or to_remove:
+            self._commit_changes(to_index, to_remove)
+        if comments_to_index or comments_to_remove:
+            self._commit_comment_changes(comments_to_index,
+                                         comments_to_remove)
+
+    def _commit_changes(self, to_index, to_remove):
+        return self._commit(self.index, self._write_changes, to_index,
+                            to_remove)
+
+    def _commit_comment_changes(self, to_index, to_remove):
+        return self._commit(self.comment_index, self._write_comment_changes,
+                            to_index, to_remove)
+
+    def _commit(self, index, write_changes, to_index, to_remove):
+        writer = self.async_writer(index)
+        try:
+            written, removed = write_changes(writer, to_index, to_remove)
+        except BaseException:
+            writer.cancel()
+            raise
+
+        if written or removed:
+            self.commit(writer)
+        else:
+            # Don't create a new generation (and segment) for nothing
+            writer.cancel()
+        return written, removed
+
+    def _write_changes(self, writer, to_index, to_remove):
+        """(Re)index and remove media entries using a writer.
+
+        Returns:
+            A (written, removed) tuple of sorted arrays of media ids: the
+            entries whose document was written, and the indexed entries that
+            were removed because they were asked to be, no longer exist or
+            aren't processed.
+        """
+        searcher = self.get_searcher()
+        to_index = sorted_ids(to_index)
+        written = array(TYPECODE)
+        indexable = array(TYPECODE)
+        for media in iter_media_entries(to_index):
+            with metrics.timer('add_media_entry_seconds'):
+                try:
+                    doc = self.get_doc_for_media_entry(media)
+                except MediaNotProcessedError:
+                    continue
+                indexable.append(media.id)
+                if self.write_document(doc, writer):
+                    written.append(media.id)
+
+        # Entries that have been deleted or unprocessed since are removed
+        candidates = union(sorted_ids(to_remove),
+                           difference(to_index, indexable))
+        removed = array(TYPECODE, (
+            media_id for media_id in candidates
+            if searcher.document_number(media_id=media_id) is not None))
+        for media_id in removed:
+            self.remove_media_entry(media_id, writer)
+        return written, removed
+
+    def _write_comment_changes(self, writer, to_index, to_remove):
+        """(Re)index and remove comments using a comment index writer.
+
+        Returns:
+            A (written, removed) tuple of sorted arrays of text comment ids,
+            like _write_changes.
+        """
+        searcher = self.get_comment_searcher()
+        to_index = sorted_ids(to_index)
+        written = array(TYPECODE)
+        indexable = array(TYPECODE)
+        for doc in iter_comment_documents(to_index):
+            indexable.append(doc['comment_id'])
+            if self._write_if_changed(doc, writer, COMMENTS):
+                written.append(doc['comment_id'])
+
+        # Comments that have been deleted since, or whose media entry has
+        candidates = union(sorted_ids(to_remove),
+                           difference(to_index, indexable))
+        removed = array(TYPECODE, (
+            comment_id for comment_id in candidates
+            if searcher.document_number(comment_id=comment_id) is not None))
+        for comment_id in removed:
+            writer.delete_by_term('comment_id', comment_id)
+            metrics.inc('documents_removed')
+        return written, removed
 
     def add_media_entry(self, media, writer=None):
         """Adds a media entry to the index using a writer.
@@ -93,20 +980,55 @@ class Engine(BaseEngine):
         Args:
             media: a media entry for indexing.
             writer: a whoosh writer to index the media entry.
+
+        Returns:
+            True if a document was written, False if the media entry isn't
+            processed yet or its document hasn't changed.
         """
         commit = False
 
-        if not writer:
-            writer = whoosh.writing.AsyncWriter(self.index)
-            commit = True
-        try:
-            writer.update_document(**self.get_doc_for_media_entry(media))
+        with metrics.timer('add_media_entry_seconds'):
+            if not writer:
+                writer = self.async_writer()
+                commit = True
+            try:
+                written = self.write_document(
+                    self.get_doc_for_media_entry(media), writer)
+            except MediaNotProcessedError:
+                written = False
 
             if commit:
-                writer.commit()
+                if written:
+                    self.commit(writer)
+                else:
+                    writer.cancel()
+        return written
+
+    def write_document(self, doc, writer):
+        """Write a document unless the index already holds an identical one.
+
+        The document's fingerprint is stored alongside it, so an unchanged
+        document can be detected without comparing every field, and skipping
+        it saves a segment write and a deleted document.
+
+        Returns:
+            True if the document was written.
+        """
+        return self._write_if_changed(doc, writer, MEDIA)
+
+    def _write_if_changed(self, doc, writer, kind):
+        doc = dict(doc, fingerprint=document_fingerprint(doc))
+        indexed = self._searcher_for(kind).document(
+            **{kind.key: doc[kind.key]})
+        if indexed and indexed.get('fingerprint') == doc['fingerprint']:
+            self.stats['documents_unchanged'] += 1
+            metrics.inc('documents_unchanged')
+            return False
 
-        except MediaNotProcessedError:
-            pass
+        writer.update_document(**_with_columns(doc, kind.key))
+        self.stats['documents_written'] += 1
+        metrics.inc('documents_indexed')
+        return True
 
     def maybe_create_index(self):
         """Ensure that a given directory contains the plugin's index.
@@ -127,6 +1049,7 @@ class Engine(BaseEngine):
 
         if new_index_required:
             _log.info("Creating new index in " + self.index_dir)
+            self.clear_watermark()
             self.index = whoosh.index.create_in(self.index_dir,
                                                 schema=MediaEntrySchema(),
                                                 indexname=INDEX_NAME)
@@ -135,6 +1058,20 @@ class Engine(BaseEngine):
             self.index = whoosh.index.open_dir(self.index_dir,
                                                indexname=INDEX_NAME)
 
+    def open_comment_index(self):
+        """Open the comment index, creating it if it doesn't exist yet.
+
+        The comment index lives in the same directory as the media index,
+        which has been created by then.
+        """
+        if whoosh.index.exists_in(self.index_dir, COMMENT_INDEX_NAME):
+            return whoosh.index.open_dir(self.index_dir,
+                                         indexname=COMMENT_INDEX_NAME)
+        _log.info("Creating comment index in " + self.index_dir)
+        self.clear_watermark(COMMENTS)
+        return whoosh.index.create_in(self.index_dir, schema=CommentSchema(),
+                                      indexname=COMMENT_INDEX_NAME)
+
     def remove_media_entry(self, media_entry_id, writer=None):
         """Remove a media entry from the index using a writer.
 
@@ -147,19 +1084,617 @@ class Engine(BaseEngine):
         """
         commit = False
 
-        if not writer:
-            writer = whoosh.writing.AsyncWriter(self.index)
-            commit = True
+        with metrics.timer('remove_media_entry_seconds'):
+            if not writer:
+                writer = self.async_writer()
+                commit = True
+
+            _log.info("Deleting media entry with id: %d" % media_entry_id)
+            writer.delete_by_term('media_id', media_entry_id)
+            metrics.inc('documents_removed')
+
+            if commit:
+                self.commit(writer)
+
+    def open_writer(self, index=None, writer_class=None, **kwargs):
+        """Open a writer, recording how long the index lock took to get.
+
+        Args:
+            index: the index to write to, defaults to the media index.
+            writer_class: the class of writer to open, defaults to the one
+                the index opens.
+
+        Raises:
+            whoosh.index.LockError: the lock wasn't released within the
+                timeout given.
+        """
+        start = time.time()
+        index = index or self.index
+        try:
+            if writer_class is not None:
+                return writer_class(index, **kwargs)
+            return index.writer(**kwargs)
+        except whoosh.index.LockError:
+            metrics.inc('writer_lock_timeouts')
+            raise
+        finally:
+            metrics.observe('writer_lock_wait_seconds', time.time() - start)
+
+    def async_writer(self, index=None):
+        """Return a writer that buffers writes while the index is locked.
+
+        Args:
+            index: the index to write to, defaults to the media index.
+        """
+        start = time.time()
+        writer = whoosh.writing.AsyncWriter(index or self.index)
+        metrics.observe('writer_lock_wait_seconds', time.time() - start)
+        if writer.writer is None:
+            # Committing will wait for the lock in a background thread
+            metrics.inc('writer_lock_busy')
+        return writer
+
+    def commit(self, writer):
+        """Commit a writer, merging segments as the merge policy says."""
+        with metrics.timer('commit_seconds'):
+            writer.commit(mergetype=self.mergetype)
+
+    def optimize(self, wait=True):
+        """Merge the whole index into a single segment.
+
+        This also drops deleted documents for good. The comment index is
+        merged too, unless wait is False and it's locked.
+
+        Args:
+            wait: whether to wait for another writer to finish.
+
+        Returns:
+            False if wait is False and another writer holds the index lock.
+        """
+        if not self._optimize(self.index, wait):
+            return False
+        self._optimize(self.comment_index, wait)
+        self.stats['optimizations'] += 1
+        return True
+
+    def _optimize(self, index, wait):
+        try:
+            writer = self.open_writer(
+                index=index, timeout=WRITER_TIMEOUT if wait else 0.0)
+        except whoosh.index.LockError:
+            if wait:
+                raise
+            return False
+        _log.info("Optimizing index %s" % index.indexname)
+        with metrics.timer('commit_seconds'):
+            writer.commit(optimize=True)
+        return True
+
+    def get_index_stats(self):
+        """Return figures for telling whether the index needs merging.
+
+        Returns:
+            A dict with the number of 'segments', of live 'documents' and of
+            'deleted_documents' still in segments, the 'deleted_ratio' of
+            deleted to all documents, the 'size' of the index in bytes, and
+            the number of 'comment_documents' in the comment index.
+        """
+        reader = self.index.reader()
+        try:
+            # An empty index has an EmptyReader, but no segment
+            segments = [leaf for leaf, _ in reader.leaf_readers()
+                        if not isinstance(leaf, whoosh.reading.EmptyReader)]
+            count = sum(leaf.doc_count_all() for leaf in segments)
+            deleted = count - sum(leaf.doc_count() for leaf in segments)
+        finally:
+            reader.close()
+        storage = self.index.storage
+        size = sum(storage.file_length(name) for name in storage.list()
+                   if INDEX_NAME in name and name.endswith(('.seg', '.toc')))
+        return {'segments': len(segments),
+                'documents': count - deleted,
+                'deleted_documents': deleted,
+                'deleted_ratio': float(deleted) / count if count else 0.0,
+                'size': size,
+                'comment_documents': self.comment_index.doc_count()}
+
+    def get_searcher(self):
+        """Return a searcher for the latest generation of the index.
+
+        The searcher is kept open and reused by later calls from the same
+        thread. It is only reopened when a writer has committed a new
+        generation, and segments that didn't change are reused when it is.
+        The returned searcher must not be closed by the caller.
+        """
+        return self._thread_searcher(self.index, 'searcher', 'generation')
+
+    def get_comment_searcher(self):
+        """Return a searcher for the latest generation of the comment index.
+
+        Like get_searcher, it's kept open by the calling thread.
+        """
+        return self._thread_searcher(self.comment_index, 'comment_searcher',
+                                     'comment_generation')
+
+    def _searcher_for(self, kind):
+        if kind.index_name == COMMENT_INDEX_NAME:
+            return self.get_comment_searcher()
+        return self.get_searcher()
+
+    def _thread_searcher(self, index, name, generation_name):
+        generation = index.latest_generation()
+        searcher = getattr(self._local, name, None)
+        if searcher is None:
+            searcher = index.searcher()
+            self.stats['searcher_reopened'] += 1
+        elif getattr(self._local, generation_name) != generation:
+            # An empty index has no reader generation to compare against,
+            # so track the index generation the searcher was opened at.
+            searcher = searcher.refresh()
+            self.stats['searcher_reopened'] += 1
+        else:
+            self.stats['searcher_reused'] += 1
+
+        setattr(self._local, name, searcher)
+        setattr(self._local, generation_name, generation)
+        return searcher
+
+    def get_stats(self):
+        stats = BaseEngine.get_stats(self)
+        for name in 'query_cache', 'parsed_query_cache', 'filter_cache':
+            for key, value in getattr(self, name).stats.items():
+                stats['%s_%s' % (name, key)] = value
+        return stats
+
+    def parse_query(self, query, searcher):
+        """Parse a normalized query string, reusing earlier parses.
+
+        Parsed queries aren't modified by searching, so the same query object
+        can be shared by every thread.
+        """
+        parsed = self.parsed_query_cache.get(query)
+        if parsed is None:
+            parsed = whoosh.qparser.MultifieldParser(
+                DEFAULT_SEARCH_FIELDS, searcher.schema).parse(query)
+            parsed = parsed.accept(
+                lambda q: _positionless_phrase(q, searcher.schema))
+            self.parsed_query_cache.put(query, parsed)
+        return parsed
 
-        _log.info("Deleting media entry with id: %d" % media_entry_id)
-        writer.delete_by_term('media_id', media_entry_id)
+    def join_comments(self, parsed, deadline=None):
+        """Replace the parts of a parsed query on comments with media ids.
 
-        if commit:
-            writer.commit()
+        Comments are in an index of their own, so each part of the query on
+        the comment field is searched for in it, and replaced by a query for
+        the media entries the matching comments are on. A media entry is
+        scored by its best matching comment, which adds up with its score
+        for the rest of the query, as if its comments were one of its fields.
+
+        Args:
+            parsed: the parsed query.
+            deadline: the time.time() by which to stop collecting comments,
+                or None for no limit.
+
+        Returns:
+            A (joined, partial) tuple, partial being True if time ran out and
+            the joined query only matches the comments found until then.
+        """
+        searcher = self.get_comment_searcher()
+        timed_out = []
+
+        def join(query):
+            if not query.is_leaf() or query.field() != 'comment':
+                return query
+            results, partial = self._timed_search(searcher, query, None,
+                                                  deadline)
+            if partial:
+                timed_out.append(query)
+            hits = list(results.items())
+            if not hits:
+                # An index nothing was committed to yet has no columns
+                return whoosh.query.NullQuery
+            media_ids = searcher.reader().column_reader('media_id',
+                                                        translate=False)
+            scores = {}
+            for docnum, score in hits:
+                media_id = media_ids[docnum]
+                scores[media_id] = max(score, scores.get(media_id, 0))
+            return MediaScoreQuery(scores)
+        return parsed.accept(join), bool(timed_out)
+
+    def _joined_query(self, query, searcher, generation, deadline=None):
+        """Return a parsed query joined with the comments of a generation.
+
+        Returns:
+            A (joined, partial) tuple, as returned by join_comments. Partial
+            joins aren't cached.
+        """
+        key = ('joined', query)
+        joined = self.query_cache.get(key, generation)
+        if joined is not None:
+            return joined, False
+        joined, partial = self.join_comments(self.parse_query(query, searcher),
+                                             deadline)
+        if not partial:
+            self.query_cache.put(key, joined, generation)
+        return joined, partial
+
+    def _result_generation(self):
+        """Return the media searcher and the generation results hold for.
+
+        Results depend on the comment index as well as on the media index,
+        so they are cached for a (media, comment) pair of generations.
+        """
+        searcher = self.get_searcher()
+        self.get_comment_searcher()
+        return searcher, (self._local.generation,
+                          self._local.comment_generation)
+
+    def _timed_search(self, searcher, query, limit, deadline, **kwargs):
+        """Search, collecting hits until a deadline.
+
+        Hits are collected through a TimeLimitCollector, which checks a
+        timer thread between matching documents, as the signal it can use
+        instead only works in the main thread. Expanding the terms of
+        wildcards and collecting facet counts aren't interrupted.
+
+        Args:
+            searcher: the searcher to search with.
+            query: the parsed query.
+            limit: the number of top hits to collect, or None for every hit.
+            deadline: the time.time() by which to stop, or None for no
+                limit.
+            kwargs: passed on to the searcher's collector, e.g. 'filter'.
+
+        Returns:
+            A (results, partial) tuple, partial being True if time ran out
+            and the results only hold the hits found until then.
+        """
+        if deadline is None:
+            return searcher.search(query, limit=limit, **kwargs), False
+        collector = whoosh.collectors.TimeLimitCollector(
+            searcher.collector(limit=limit, **kwargs),
+            max(deadline - time.time(), 0), greedy=True, use_alarm=False)
+        try:
+            searcher.search_with_collector(query, collector)
+        except whoosh.searching.TimeLimit:
+            return collector.results(), True
+        return collector.results(), False
+
+    def _run_search(self, searcher, query, generation, limit, **kwargs):
+        """Search, taking at most the SEARCH_TIME_LIMIT.
+
+        The query is joined with the comments first, and searching the
+        comment index counts against the same time limit, the media index
+        being searched in the time that's left.
+
+        Args:
+            searcher: the media searcher to search with.
+            query: the normalized query string.
+            generation: the generation of the results, as returned by
+                _result_generation.
+            limit: the number of top hits to collect, or None for every hit.
+            kwargs: passed on to the searcher's collector, e.g. 'filter'.
+
+        Returns:
+            A (results, partial) tuple, as returned by _timed_search.
+        """
+        deadline = None
+        if self.time_limit:
+            deadline = time.time() + self.time_limit
+        filter = kwargs.get('filter')
+        if filter is not None and not filter:
+            # Whoosh ignores an empty filter rather than matching nothing
+            joined, partial = whoosh.query.NullQuery, False
+        else:
+            joined, partial = self._joined_query(query, searcher,
+                                                 generation, deadline)
+        results, timed_out = self._timed_search(searcher, joined, limit,
+                                                deadline, **kwargs)
+        if partial or timed_out:
+            _log.info('Search for %s ran out of time after %.2fs' % (
+                query, self.time_limit))
+            self.stats['partial_searches'] += 1
+            metrics.inc('partial_searches')
+            return results, True
+        return results, False
 
     def search(self, query):
-        with self.index.searcher() as searcher:
-            query_string = whoosh.qparser.MultifieldParser(
-                DEFAULT_SEARCH_FIELDS, self.index.schema).parse(query)
-            results = searcher.search(query_string)
-            return [result['media_id'] for result in results]
+        start = time.time()
+        query = normalize_query(query)
+        searcher, generation = self._result_generation()
+        key = ('search', query)
+        ids = self.query_cache.get(key, generation)
+        if ids is None:
+            results, partial = self._run_search(searcher, query, generation,
+                                                10)
+            ids = tuple(result['media_id'] for result in results)
+            # Partial results are left for a later search to complete
+            if not partial:
+                self.query_cache.put(key, ids, generation)
+        metrics.record_search(time.time() - start, len(ids))
+        return list(ids)
+
+    def get_filter(self, filters, searcher, generation, date_range=None):
+        """Return the documents matching facet filters and dates, or None.
+
+        Document numbers only hold for one generation of the index, so the
+        sets are cached per generation.
+
+        Args:
+            filters: a dict mapping names in FACETS to values.
+            searcher: a searcher for the generation.
+            generation: the searcher's index generation.
+            date_range: a (start, end) tuple of datetimes the media entries
+                must have been created between. Either may be None.
+        """
+        if date_range == (None, None):
+            date_range = None
+        if not filters and not date_range:
+            return None
+        filters = filters or {}
+        unknown = set(filters).difference(FACETS)
+        if unknown:
+            raise ValueError('Unknown facets: %s' % ', '.join(unknown))
+
+        key = (tuple(sorted(filters.items())), date_range)
+        docs = self.filter_cache.get(key, generation)
+        if docs is None:
+            subqueries = [whoosh.query.Term(FACET_FIELDS[name], value)
+                          for name, value in key[0]]
+            if date_range:
+                subqueries.append(whoosh.query.DateRange(
+                    'created', date_range[0], date_range[1]))
+            query = whoosh.query.And(subqueries)
+            docs = whoosh.idsets.BitSet(searcher.docs_for_query(query),
+                                        size=searcher.doc_count_all())
+            self.filter_cache.put(key, docs, generation)
+        return docs
+
+    def _top_facet_values(self, counts):
+        return top_facet_values(counts, self.facet_limit)
+
+    def _sorted_by(self, sort):
+        """Return the facet hits are sorted by, or None for relevance."""
+        sort = sort or 'relevance'
+        if sort not in SORT_ORDERS:
+            raise ValueError('Unknown sort order: %s' % sort)
+        if sort == 'relevance':
+            return None
+        return whoosh.sorting.FieldFacet('created',
+                                         reverse=(sort == 'newest'))
+
+    def _facet_groups(self):
+        """Return the facets hits are counted by, keyed by name."""
+        return {'tag': VectorFacet(FACET_FIELDS['tag'],
+                                   maptype=whoosh.sorting.Count),
+                'user': whoosh.sorting.FieldFacet(
+                    FACET_FIELDS['user'], maptype=whoosh.sorting.Count),
+                'media_type': whoosh.sorting.FieldFacet(
+                    FACET_FIELDS['media_type'],
+                    maptype=whoosh.sorting.Count)}
+
+    def search_page(self, query, page, pagelen, filters=None, sort=None,
+                    date_range=None):
+        """Return one page of the media entries matching a query.
+
+        Only the top page * pagelen hits are collected and sorted, by score
+        or by the creation date column, but every matching document is
+        counted. Pages are cached until the
+        index generation changes. With the STORE_RESULT_FIELDS option, the
+        stored result fields of the hits are returned too. With the
+        SEARCH_TIME_LIMIT option, a search running out of time returns the
+        hits found until then, and isn't cached.
+
+        Facet counts are collected while searching, from the facet fields'
+        columns and term vectors, and are cached separately from pages so
+        that moving between pages doesn't count them again.
+
+        Args:
+            query: the query string.
+            page: the page number, starting at 1.
+            pagelen: the number of media entries per page.
+            filters: a dict mapping names in FACETS to the value matching
+                media entries must have.
+            sort: one of SORT_ORDERS, defaults to 'relevance'.
+            date_range: a (start, end) tuple of datetimes the media entries
+                must have been created between. Either may be None.
+
+        Returns:
+            A dict with the page's media entry 'ids' in sort order, the
+            'total' number of matching media entries, the 'pagecount' and
+            the 'facets', a dict mapping each name in FACETS to a list of
+            (value, count) tuples for the most common values. When there
+            are fewer hits than the CORRECTION_THRESHOLD option, the
+            'correction' is the query with misspelled words corrected, or
+            None. With stored result fields, 'fields' lists the fields of
+            each media entry, or None for entries indexed without them.
+            'partial' is True if the search ran out of time, the total and
+            facets then only counting the hits found until then.
+        """
+        if page < 1:
+            raise ValueError('Page numbers start at 1')
+        sortedby = self._sorted_by(sort)
+        sort = sort or 'relevance'
+
+        start = time.time()
+        query = normalize_query(query)
+        filter_key = (tuple(sorted((filters or {}).items())), date_range)
+        searcher, generation = self._result_generation()
+        key = ('page', query, page, pagelen, filter_key, sort)
+        cached = self.query_cache.get(key, generation)
+        if cached is None:
+            facets_key = ('facets', query, filter_key)
+            facets = self.query_cache.get(facets_key, generation)
+            groupedby = None
+            if facets is None:
+                groupedby = self._facet_groups()
+
+            results, partial = self._run_search(
+                searcher, query, generation, page * pagelen,
+                filter=self.get_filter(filters, searcher, generation[0],
+                                       date_range),
+                sortedby=sortedby, groupedby=groupedby)
+            results = whoosh.searching.ResultsPage(results, page, pagelen)
+            if facets is None:
+                groups = results.results.groups
+                facets = dict((name, self._top_facet_values(groups(name)))
+                              for name in FACETS)
+                if not partial:
+                    self.query_cache.put(facets_key, facets, generation)
+
+            hits = []
+            # Whoosh hands out the last page for pages past the end
+            if results.pagenum == page:
+                hits = list(results)
+            cached = {'ids': tuple(hit['media_id'] for hit in hits),
+                      'total': results.total,
+                      'pagecount': results.pagecount,
+                      'facets': facets,
+                      'correction': None,
+                      'partial': partial}
+            # Partial results may be missing hits, not words of the query
+            if results.total < self.correction_threshold and not partial:
+                cached['correction'] = self.correct_query(query, searcher)
+            if self.store_result_fields:
+                cached['fields'] = tuple(hit.get('result') for hit in hits)
+            if not partial:
+                self.query_cache.put(key, cached, generation)
+
+        page = dict(cached, ids=list(cached['ids']))
+        if 'fields' in cached:
+            page['fields'] = list(cached['fields'])
+        metrics.record_search(time.time() - start, page['total'])
+        return page
+
+    def search_hits(self, query, limit, filters=None, sort=None,
+                    date_range=None):
+        """Return the top hits of a query, with what they are sorted by.
+
+        The sharded backend merges the hits of each of its shards. Unlike
+        search_page, every facet value is counted, so that counts can be
+        added up. Hits are cached until the index generation changes.
+
+        Args:
+            query: the query string.
+            limit: the number of hits to return, or None for every hit.
+            filters: as for search_page.
+            sort: as for search_page.
+            date_range: as for search_page.
+
+        Returns:
+            A dict with the 'hits', a list of (score, created, media_id,
+            fields) tuples in sort order, created being the time_value of
+            the creation date and fields the stored result fields or None,
+            the 'total' number of matching media entries, the 'facets',
+            a dict mapping each name in FACETS to a dict of the number of
+            hits with each value, and whether the hits are 'partial', as
+            for search_page.
+        """
+        sortedby = self._sorted_by(sort)
+        query = normalize_query(query)
+        filter_key = (tuple(sorted((filters or {}).items())), date_range)
+        searcher, generation = self._result_generation()
+        key = ('hits', query, limit, filter_key, sort or 'relevance')
+        cached = self.query_cache.get(key, generation)
+        if cached is None:
+            results, partial = self._run_search(
+                searcher, query, generation, limit,
+                filter=self.get_filter(filters, searcher, generation[0],
+                                       date_range),
+                sortedby=sortedby, groupedby=self._facet_groups())
+            created = column_reader(searcher.reader(), 'created')
+            cached = {'hits': [(hit.score, created[hit.docnum],
+                                hit['media_id'], hit.get('result'))
+                               for hit in results],
+                      'total': len(results),
+                      'facets': dict((name, results.groups(name))
+                                     for name in FACETS),
+                      'partial': partial}
+            if not partial:
+                self.query_cache.put(key, cached, generation)
+        return cached
+
+    def _per_generation(self, name, build):
+        """Return a structure built from the latest generation of the index.
+
+        Args:
+            name: the name of the structure, whose builds are counted in the
+                '<name>_builds' stat.
+            build: a callable building the structure from a searcher.
+        """
+        searcher = self.get_searcher()
+        generation = self._local.generation
+        with self._generation_lock:
+            value, built_at = self._generation_cache.get(name, (None, None))
+            if value is None or built_at < generation:
+                value = build(searcher)
+                self._generation_cache[name] = (value, generation)
+                self.stats[name + '_builds'] += 1
+            return value
+
+    def get_prefix_index(self):
+        """Return the prefix index of the latest generation of the index.
+
+        The index is built from the term dictionaries of the suggestion
+        fields the first time it's needed after a writer commits. Terms
+        only used by deleted documents are kept until their segments merge.
+        """
+        return self._per_generation(
+            'prefix_index',
+            lambda searcher: build_prefix_index(searcher.reader()))
+
+    def get_corrector(self):
+        """Return the spelling corrector of the latest index generation."""
+        return self._per_generation(
+            'corrector',
+            lambda searcher: TermCorrector(searcher.reader(),
+                                           CORRECTION_FIELDS))
+
+    def correct_query(self, query, searcher, corrector=None):
+        """Return a query string with misspelled words corrected, or None.
+
+        Words that aren't in the title, description or tag term dictionaries
+        are replaced with the closest term sharing their first letter.
+
+        Args:
+            query: a normalized query string.
+            searcher: the searcher the query is parsed with.
+            corrector: the TermCorrector to use, defaults to the one of the
+                latest index generation.
+        """
+        corrector = corrector or self.get_corrector()
+        # The parser repeats each word for every default search field, and
+        # each field's analyzer may have changed it differently.
+        words = {}
+        for token in self.parse_query(query, searcher).all_tokens():
+            if (token.fieldname in CORRECTION_FIELDS and
+                    token.startchar is not None):
+                words.setdefault((token.startchar, token.endchar),
+                                 set()).add(token.text)
+
+        corrected = query
+        # Replace from the end, so that earlier positions still hold
+        for (start, end), texts in sorted(words.items(), reverse=True):
+            if any(text in corrector for text in texts):
+                continue
+            for text in sorted(texts):
+                # Ask for a few, as ties are only ordered among those kept
+                suggestions = corrector.suggest(text, limit=5, prefix=1)
+                if suggestions:
+                    corrected = corrected[:start] + suggestions[0] + \
+                        corrected[end:]
+                    break
+
+        if corrected == query:
+            return None
+        return corrected
+
+    def suggest(self, prefix, limit):
+        """Return up to limit completions of a prefix.
+
+        Returns:
+            A list of (kind, term) tuples, kind being 'tag', 'user' or
+            'title'.
+        """
+        return self.get_prefix_index().complete(prefix, limit)
@@ -0,0 +1,104 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import time
+import threading
+from collections import OrderedDict
+
+
+def normalize_query(query):
+    """Collapse the whitespace in a query string.
+
+    Case is kept, as it matters to operators such as AND and to field names.
+    """
+    return u' '.join(query.split())
+
+
+class QueryCache(object):
+    """A bounded LRU cache whose entries expire after ttl seconds.
+
+    Entries can belong to an index generation. Once an entry for a newer
+    generation is looked up or stored, every entry of older generations is
+    dropped, and entries for older generations are neither returned nor
+    stored. A cache used without generations only drops entries through its
+    LRU and ttl limits.
+    """
+
+    def __init__(self, size=256, ttl=300.0):
+        """
+        Args:
+            size: the maximum number of entries, 0 to disable the cache.
+            ttl: seconds an entry is kept for, 0 to keep it until evicted.
+        """
+        self.size = size
+        self.ttl = ttl
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0,
+                      'invalidations': 0}
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generation = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _check_generation(self, generation):
+        # Must be called with the lock held. Returns False for a generation
+        # older than the cached one.
+        if generation is None:
+            return True
+        if self._generation is not None and generation < self._generation:
+            return False
+        if generation != self._generation:
+            self.stats['invalidations'] += len(self._entries)
+            self._entries = OrderedDict()
+            self._generation = generation
+        return True
+
+    def get(self, key, generation=None):
+        """Return the value cached for a key, or None."""
+        if not self.size:
+            return None
+        with self._lock:
+            entry = None
+            if self._check_generation(generation):
+                entry = self._entries.pop(key, None)
+            if entry is not None and self.ttl and entry[0] < time.time():
+                self.stats['evictions'] += 1
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            # Move the entry to the most recently used end
+            self._entries[key] = entry
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def put(self, key, value, generation=None):
+        """Cache a value, evicting the least recently used entry if full."""
+        if not self.size:
+            return
+        with self._lock:
+            if not self._check_generation(generation):
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self._generation = None
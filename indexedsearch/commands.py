@@ -0,0 +1,246 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Index maintenance commands, e.g. for running from cron.
+
+The commands follow the layout of MediaGoblin's gmg commands. gmg only knows
+its own commands, so they are run with the gmg-indexedsearch script, or with
+gmg after adding an 'indexedsearch' entry to
+mediagoblin.gmg_commands.SUBCOMMAND_MAP:
+
+    {'setup': 'indexedsearch.commands:parser_setup',
+     'func': 'indexedsearch.commands:indexedsearch',
+     'help': 'Maintain the search index'}
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+
+from sqlalchemy import func
+
+# How many ids of drifted media entries verify lists, unless asked for all
+VERIFY_LIST_LIMIT = 20
+
+
+def parser_setup(subparser):
+    actions = subparser.add_subparsers(dest='action',
+                                       help='index maintenance action')
+
+    rebuild = actions.add_parser(
+        'rebuild', help='Rebuild the index from scratch')
+    rebuild.add_argument(
+        '--procs', type=int, default=None,
+        help='Number of processes to use, defaults to INDEX_PROCESSES')
+    rebuild.add_argument(
+        '--batch-size', type=int, default=None,
+        help='Media entries to index per commit, defaults to '
+             'INDEX_BATCH_SIZE')
+
+    sync = actions.add_parser(
+        'sync', help='Index new and updated media entries, and remove '
+                     'deleted ones')
+    sync.add_argument(
+        '--full', action='store_true',
+        help='Compare every media entry with the index, rather than only '
+             'those changed since the last sync')
+
+    verify = actions.add_parser(
+        'verify', help='Report differences between the index and the '
+                       'database, without changing the index')
+    verify.add_argument(
+        '--all', action='store_true',
+        help='List every differing media entry id')
+
+    actions.add_parser(
+        'optimize', help='Merge the index into a single segment')
+
+    actions.add_parser('stats', help='Show the size and state of the index')
+
+    actions.add_parser(
+        'indexer', help='Run the indexer daemon, which applies the index '
+                        'changes of every web worker')
+
+
+def _rate(count, elapsed):
+    return count / elapsed if elapsed > 0 else 0.0
+
+
+def _format_ids(ids, show_all):
+    if show_all or len(ids) <= VERIFY_LIST_LIMIT:
+        return ', '.join(str(media_id) for media_id in ids)
+    return '%s, ... (%d more)' % (
+        ', '.join(str(media_id) for media_id in ids[:VERIFY_LIST_LIMIT]),
+        len(ids) - VERIFY_LIST_LIMIT)
+
+
+def rebuild(engine, args):
+    from mediagoblin.db.base import Session
+    from mediagoblin.db.models import MediaEntry
+
+    max_id = Session.query(func.max(MediaEntry.id)).scalar() or 0
+    start = time.time()
+
+    def progress(count, last_id):
+        elapsed = time.time() - start
+        print('Indexed %d media entries (up to id %d of %d, %.0f%%), '
+              '%.1f docs/sec' % (count, last_id, max_id,
+                                 100.0 * last_id / max_id if max_id else 100,
+                                 _rate(count, elapsed)))
+        sys.stdout.flush()
+
+    count = engine.rebuild_index(procs=args.procs,
+                                 batch_size=args.batch_size,
+                                 progress=progress)
+    elapsed = time.time() - start
+    print('Rebuilt the index: %d media entries in %.1fs, %.1f docs/sec' % (
+        count, elapsed, _rate(count, elapsed)))
+    return 0
+
+
+def sync(engine, args):
+    start = time.time()
+    counts = engine.update_index(full=args.full)
+    elapsed = time.time() - start
+    changed = counts['added'] + counts['updated'] + counts['removed']
+    print('Synced the index in %.1fs: %d added, %d updated, %d removed, '
+          '%.1f docs/sec' % (elapsed, counts['added'], counts['updated'],
+                             counts['removed'], _rate(changed, elapsed)))
+    return 0
+
+
+def verify(engine, args):
+    drift = engine.check_index()
+    descriptions = [
+        ('added', 'processed media entries missing from the index'),
+        ('updated', 'media entries updated since they were indexed'),
+        ('removed', 'indexed media entries that no longer exist or '
+                    'aren\'t processed')]
+
+    drifted = False
+    for key, description in descriptions:
+        ids = drift[key]
+        print('%d %s' % (len(ids), description))
+        if ids:
+            drifted = True
+            print('  ' + _format_ids(ids, args.all))
+
+    if drifted:
+        print('The index is out of sync, run "sync" to update it')
+        return 1
+    print('The index is in sync with the database')
+    return 0
+
+
+def optimize(engine, args):
+    before = engine.get_index_stats()
+    start = time.time()
+    engine.optimize()
+    after = engine.get_index_stats()
+    print('Optimized the index in %.1fs: %d segments and %d deleted '
+          'documents before, %d segments and %d deleted documents after' % (
+              time.time() - start, before['segments'],
+              before['deleted_documents'], after['segments'],
+              after['deleted_documents']))
+    return 0
+
+
+def stats(engine, args):
+    from mediagoblin.db.models import MediaEntry
+
+    index_stats = engine.get_index_stats()
+    processed = MediaEntry.query.filter(
+        MediaEntry.state == u'processed').count()
+    print('Indexed documents:   %d' % index_stats['documents'])
+    print('Processed entries:   %d' % processed)
+    print('Indexed comments:    %d' % index_stats['comment_documents'])
+    print('Segments:            %d' % index_stats['segments'])
+    print('Deleted documents:   %d (%.1f%%)' % (
+        index_stats['deleted_documents'],
+        index_stats['deleted_ratio'] * 100))
+    print('Size:                %.1f MiB' % (
+        index_stats['size'] / (1024.0 * 1024.0)))
+    checkpoint = getattr(engine, 'read_checkpoint', lambda: None)()
+    if checkpoint:
+        print('An interrupted rebuild will resume after media entry %d' %
+              checkpoint)
+    return 0
+
+
+def indexer(engine, args):
+    from mediagoblin.tools import pluginapi
+    from indexedsearch import daemon, get_engine, maintenance
+
+    config = pluginapi.get_config('indexedsearch')
+    if not config.get('INDEXER_SOCKET'):
+        print('Set INDEXER_SOCKET in the indexedsearch config to run the '
+              'indexer daemon')
+        return 2
+
+    maintenance.setup_merge_scheduler(get_engine, config)
+    try:
+        daemon.IndexerDaemon(
+            get_engine, config['INDEXER_SOCKET'],
+            batch_size=config.get('INDEX_QUEUE_BATCH_SIZE', 100),
+            flush_interval=config.get('INDEX_QUEUE_INTERVAL', 1.0)).run()
+    except RuntimeError as error:
+        print(error)
+        return 1
+    return 0
+
+
+ACTIONS = {'rebuild': rebuild,
+           'sync': sync,
+           'verify': verify,
+           'optimize': optimize,
+           'stats': stats,
+           'indexer': indexer}
+
+
+def indexedsearch(args):
+    from mediagoblin.gmg_commands import util as commands_util
+    from indexedsearch import get_engine
+
+    if not getattr(args, 'action', None):
+        print('Choose one of: ' + ', '.join(sorted(ACTIONS)))
+        sys.exit(2)
+
+    # Setting up the app loads the plugin config, but doesn't run the
+    # plugin's wrap_wsgi hook, so the index isn't synced on startup.
+    commands_util.setup_app(args)
+    sys.exit(ACTIONS[args.action](get_engine(), args))
+
+
+def main():
+    """Entry point of the gmg-indexedsearch script."""
+    parser = argparse.ArgumentParser(
+        description='Maintain the GNU MediaGoblin indexedsearch index.')
+    parser.add_argument(
+        '-cf', '--conf_file', default=None,
+        help=('Config file used to set up environment.  '
+              'Default to mediagoblin_local.ini if readable, '
+              'otherwise mediagoblin.ini'))
+    parser_setup(parser)
+    args = parser.parse_args()
+
+    args.orig_conf_file = args.conf_file
+    if args.conf_file is None:
+        if os.access('mediagoblin_local.ini', os.R_OK):
+            args.conf_file = 'mediagoblin_local.ini'
+        else:
+            args.conf_file = 'mediagoblin.ini'
+    indexedsearch(args)
@@ -0,0 +1,334 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""An indexer daemon holding the only index writer of a server.
+
+With several web worker processes, each one's index queue opens writers of
+its own, which wait for each other's locks. When the INDEXER_SOCKET option
+is set, workers send their queued changes over a Unix socket to the daemon
+run by "gmg-indexedsearch indexer" instead. The daemon queues them in an
+IndexQueue of its own, which deduplicates and batches the changes of every
+worker, and commits them from a single writer. Searches in the workers see
+each commit as a new index generation, as they do when workers write.
+
+Requests and replies are JSON objects, one per line. The daemon syncs the
+index when it starts, which indexes the changes it missed while it was
+down. While it is unavailable, workers apply their changes themselves, and
+try the daemon again after RETRY_INTERVAL seconds.
+"""
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import socket
+import logging
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from mediagoblin.db.base import Session
+
+from indexedsearch.indexing import (IndexQueue, INDEX, REMOVE, MEDIA,
+                                    COMMENT)
+
+_log = logging.getLogger(__name__)
+
+# Seconds a worker waits for the daemon to reply
+CLIENT_TIMEOUT = 5.0
+# Seconds a worker applies changes itself before trying the daemon again
+RETRY_INTERVAL = 30.0
+
+
+class IndexerClient(object):
+    """Sends index changes to the indexer daemon.
+
+    Each process keeps one connection to the daemon, opened on first use,
+    and shared by its threads.
+    """
+
+    def __init__(self, path, timeout=CLIENT_TIMEOUT,
+                 retry_interval=RETRY_INTERVAL):
+        """
+        Args:
+            path: the path of the daemon's Unix socket.
+            timeout: seconds to wait for the daemon to reply.
+            retry_interval: seconds to wait before connecting again after
+                the daemon was unavailable.
+        """
+        self.path = path
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.stats = {'requests': 0, 'unavailable': 0}
+        self._lock = threading.Lock()
+        self._socket = None
+        self._file = None
+        self._retry_at = 0
+        self._pid = os.getpid()
+
+    def _connect(self):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(self.timeout)
+        self._socket.connect(self.path)
+        self._file = self._socket.makefile('rwb')
+
+    def _close(self):
+        for closeable in (self._file, self._socket):
+            if closeable is not None:
+                try:
+                    closeable.close()
+                except (IOError, OSError, socket.error):
+                    pass
+        self._socket = None
+        self._file = None
+
+    def request(self, message):
+        """Send a request to the daemon.
+
+        A kept connection may have been closed by a restarted daemon, so a
+        request failing on one is sent again on a new connection.
+
+        Returns:
+            The daemon's reply, or None if the daemon is unavailable.
+        """
+        with self._lock:
+            if os.getpid() != self._pid:
+                # The connection belongs to the parent process
+                self._socket = None
+                self._file = None
+                self._pid = os.getpid()
+            if time.time() < self._retry_at:
+                return None
+
+            for attempt in range(2):
+                try:
+                    if self._socket is None:
+                        self._connect()
+                    self._file.write(json.dumps(message).encode('utf-8') +
+                                     b'\n')
+                    self._file.flush()
+                    line = self._file.readline()
+                    if not line:
+                        raise socket.error(errno.ECONNRESET,
+                                           'Connection closed')
+                    self.stats['requests'] += 1
+                    return json.loads(line.decode('utf-8'))
+                except (IOError, OSError, socket.error, ValueError) as error:
+                    failure = error
+                    self._close()
+
+            _log.warning('Indexer daemon unavailable at %s (%s), indexing in '
+                         'this process' % (self.path, failure))
+            self.stats['unavailable'] += 1
+            self._retry_at = time.time() + self.retry_interval
+            return None
+
+    def send(self, changes):
+        """Send changes to the daemon.
+
+        Args:
+            changes: a list of ((kind, id), action) pairs, like the batches
+                of an IndexQueue.
+
+        Returns:
+            True if the daemon queued the changes.
+        """
+        reply = self.request({'changes': [
+            [kind, object_id, action]
+            for (kind, object_id), action in changes]})
+        return reply is not None and 'queued' in reply
+
+    def ping(self):
+        """Return whether the daemon is running and answering."""
+        reply = self.request({'ping': True})
+        return reply is not None and reply.get('pong', False)
+
+    def flush(self):
+        """Ask the daemon to commit its queued changes, and wait for it.
+
+        Returns:
+            True if the daemon committed them.
+        """
+        reply = self.request({'flush': True})
+        return reply is not None and reply.get('flushed', False)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            try:
+                reply = self.server.indexer.handle(
+                    json.loads(line.decode('utf-8')))
+            except (ValueError, TypeError, KeyError) as error:
+                reply = {'error': 'Invalid request: %s' % error}
+            if reply is None:
+                # Shutting down, the client will index the changes itself
+                return
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+
+def _exit(signum, frame):
+    sys.exit(0)
+
+
+class IndexerDaemon(object):
+    """Applies the index changes sent by every web worker of a server."""
+
+    def __init__(self, get_engine, path, batch_size=100, flush_interval=1.0):
+        """
+        Args:
+            get_engine: a callable returning the engine to apply changes to.
+            path: the path of the Unix socket to listen on.
+            batch_size: the maximum number of changes per writer commit.
+            flush_interval: seconds between commits of queued changes, 0 to
+                commit each request's changes before replying.
+        """
+        self.get_engine = get_engine
+        self.path = path
+        self.queue = IndexQueue(get_engine, batch_size=batch_size,
+                                flush_interval=flush_interval)
+        self.server = None
+        # Connections outlive the server's accept loop, so once stopping,
+        # requests are turned down rather than queued and never committed
+        self.stopping = False
+        self._lock = threading.Lock()
+
+    def handle(self, message):
+        """Handle a request, returning the reply.
+
+        Returns:
+            The reply, or None if the daemon is shutting down.
+
+        Raises:
+            ValueError: the request holds an unknown kind or action.
+        """
+        if self.stopping:
+            return None
+        if 'changes' in message:
+            changes = {}
+            for kind, object_id, action in message['changes']:
+                if kind not in (MEDIA, COMMENT) or \
+                        action not in (INDEX, REMOVE):
+                    raise ValueError('Unknown change %s of %s' % (action,
+                                                                  kind))
+                changes[kind, int(object_id)] = action
+            with self._lock:
+                if self.stopping:
+                    return None
+                self.queue.put(changes)
+            if not self.queue.flush_interval:
+                self.flush()
+            return {'queued': len(changes)}
+        if message.get('flush'):
+            self.flush()
+            return {'flushed': True}
+        if message.get('ping'):
+            return {'pong': True}
+        raise ValueError('Unknown request')
+
+    def flush(self):
+        """Commit the queued changes from the calling thread."""
+        try:
+            self.queue.flush()
+        finally:
+            # Connections are served by threads of their own, which
+            # shouldn't keep a session open between requests
+            Session.remove()
+
+    def bind(self):
+        """Listen on the socket, replacing one left by a daemon that died.
+
+        Raises:
+            RuntimeError: another daemon is listening on the socket.
+        """
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                _log.info('Removing stale indexer socket %s' % self.path)
+                os.remove(self.path)
+            else:
+                raise RuntimeError('An indexer daemon is already listening '
+                                   'on %s' % self.path)
+            finally:
+                probe.close()
+        self.server = _Server(self.path, _RequestHandler)
+        self.server.indexer = self
+
+    def serve_forever(self):
+        """Answer requests until shutdown is called."""
+        self.server.serve_forever()
+
+    def shutdown(self):
+        """Stop answering requests, and commit the queued changes."""
+        with self._lock:
+            self.stopping = True
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.queue.flush()
+
+    def run(self):
+        """Sync the index, then answer requests until interrupted.
+
+        Must be called from the main thread, which handles SIGTERM by
+        shutting down cleanly.
+        """
+        signal.signal(signal.SIGTERM, _exit)
+        _log.info('Syncing the index before accepting changes')
+        self.get_engine().update_index()
+        self.bind()
+        _log.info('Indexer daemon listening on %s' % self.path)
+        thread = threading.Thread(target=self.serve_forever,
+                                  name='indexedsearch-daemon')
+        thread.daemon = True
+        thread.start()
+        try:
+            # Waiting with a timeout lets signals interrupt the wait
+            while thread.is_alive():
+                thread.join(1.0)
+        finally:
+            self.shutdown()
+
+
+indexer_client = None
+
+
+def setup_client(config):
+    """Create the process's indexer client, if the config names a socket.
+
+    Returns:
+        The IndexerClient, or None if there is no indexer daemon.
+    """
+    global indexer_client
+
+    path = config.get('INDEXER_SOCKET')
+    indexer_client = IndexerClient(path) if path else None
+    return indexer_client
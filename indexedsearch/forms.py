@@ -20,3 +20,12 @@ from mediagoblin.tools.translate import lazy_pass_to_ugettext as _
 class SearchForm(wtforms.Form):
     q = wtforms.StringField(_('Search media'),
                             [wtforms.validators.InputRequired()])
+    sort = wtforms.SelectField(_('Sort by'),
+                               choices=[('relevance', _('Relevance')),
+                                        ('newest', _('Newest first')),
+                                        ('oldest', _('Oldest first'))],
+                               default='relevance')
+    after = wtforms.DateField(_('Added on or after (YYYY-MM-DD)'),
+                              [wtforms.validators.Optional()])
+    before = wtforms.DateField(_('Added on or before (YYYY-MM-DD)'),
+                               [wtforms.validators.Optional()])
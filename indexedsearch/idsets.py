@@ -0,0 +1,199 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Compact sets of media entry ids, for comparing the index with the database.
+
+Sets and dicts of Python ints and datetimes take over 100 bytes per media
+entry, which adds up to hundreds of megabytes for millions of entries. Ids
+are instead kept in sorted arrays of machine integers, 8 bytes each, and
+combined by merging them. The indexed times are kept in an IdTimeTable, an
+array indexed by media id: ids are allocated in increasing order, so the
+table is about as long as the library is large, and looking an id up is an
+array access rather than a hash.
+"""
+from array import array
+from itertools import compress
+
+try:
+    array('q')
+    TYPECODE = 'q'
+except ValueError:
+    # Python 2 lacks 'q', but 'l' is 64 bits wide on 64-bit Unix
+    TYPECODE = 'l'
+
+# The time of ids without a document in an IdTimeTable
+ABSENT = 0
+# The time of documents indexed without one, older than any real time
+UNKNOWN_TIME = 1
+
+
+def sorted_ids(ids):
+    """Return ids as a sorted array, without duplicates.
+
+    Args:
+        ids: an iterable of ids. Arrays are taken to be sorted already.
+    """
+    if isinstance(ids, array):
+        return ids
+    result = array(TYPECODE)
+    last = None
+    for media_id in sorted(ids):
+        if media_id != last:
+            result.append(media_id)
+            last = media_id
+    return result
+
+
+def union(a, b):
+    """Merge two sorted arrays of ids into one."""
+    result = array(TYPECODE)
+    i = j = 0
+    len_a = len(a)
+    len_b = len(b)
+    while i < len_a and j < len_b:
+        if a[i] < b[j]:
+            result.append(a[i])
+            i += 1
+        elif a[i] > b[j]:
+            result.append(b[j])
+            j += 1
+        else:
+            result.append(a[i])
+            i += 1
+            j += 1
+    result.extend(a[i:])
+    result.extend(b[j:])
+    return result
+
+
+def intersection(a, b):
+    """Return the ids in both of two sorted arrays."""
+    result = array(TYPECODE)
+    i = j = 0
+    len_a = len(a)
+    len_b = len(b)
+    while i < len_a and j < len_b:
+        if a[i] < b[j]:
+            i += 1
+        elif a[i] > b[j]:
+            j += 1
+        else:
+            result.append(a[i])
+            i += 1
+            j += 1
+    return result
+
+
+def difference(a, b):
+    """Return the ids of sorted array a that aren't in sorted array b."""
+    result = array(TYPECODE)
+    i = j = 0
+    len_a = len(a)
+    len_b = len(b)
+    while i < len_a and j < len_b:
+        if a[i] < b[j]:
+            result.append(a[i])
+            i += 1
+        elif a[i] > b[j]:
+            j += 1
+        else:
+            i += 1
+            j += 1
+    result.extend(a[i:])
+    return result
+
+
+class IdTimeTable(object):
+    """The time each media entry was indexed at, in an array by media id.
+
+    Times are integers, e.g. microseconds, greater than ABSENT. The table
+    takes 8 bytes per id up to the highest id added, however many ids are
+    added.
+    """
+
+    def __init__(self):
+        self.times = array(TYPECODE)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, media_id):
+        return (media_id < len(self.times) and
+                self.times[media_id] != ABSENT)
+
+    def add(self, media_id, time):
+        times = self.times
+        if media_id >= len(times):
+            # Grow geometrically, so adding ids in any order takes linear time
+            size = max(media_id + 1, len(times) * 2)
+            times.extend(array(TYPECODE, [ABSENT]) * (size - len(times)))
+        if times[media_id] == ABSENT:
+            self.count += 1
+        times[media_id] = time
+
+    def ids(self, start=0, stop=None):
+        """Return the ids from start up to stop in the table, sorted."""
+        times = self.times
+        stop = len(times) if stop is None else min(stop, len(times))
+        if start >= stop:
+            return array(TYPECODE)
+        # ABSENT is 0, so the times themselves select the ids
+        return array(TYPECODE, compress(range(start, stop),
+                                        times[start:stop]))
+
+    def range_checksums(self, range_size):
+        """Return the count and sum of the ids in each range of ids.
+
+        Returns:
+            A dict mapping range numbers, ids divided by range_size, of ranges
+            holding ids to a (count, sum) tuple.
+        """
+        checksums = {}
+        for number in range((len(self.times) + range_size - 1) //
+                            range_size):
+            ids = self.ids(number * range_size, (number + 1) * range_size)
+            if ids:
+                checksums[number] = (len(ids), sum(ids))
+        return checksums
+
+    def compare(self, database_times):
+        """Compare the table with the ids and times of the database.
+
+        The table is emptied as it goes, so that it holds the ids that aren't
+        in the database once every pair has been compared.
+
+        Args:
+            database_times: (media id, time) pairs, in ascending id order.
+
+        Returns:
+            A (missing, added, updated) tuple of sorted arrays of ids: ids in
+            the table but not in the database, ids in the database but not in
+            the table, and ids whose database time is after their indexed
+            time.
+        """
+        times = self.times
+        size = len(times)
+        added = array(TYPECODE)
+        updated = array(TYPECODE)
+        for media_id, database_time in database_times:
+            if media_id >= size or times[media_id] == ABSENT:
+                added.append(media_id)
+                continue
+            if database_time > times[media_id]:
+                updated.append(media_id)
+            times[media_id] = ABSENT
+            self.count -= 1
+        return self.ids(), added, updated
@@ -0,0 +1,226 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Deferred indexing of media entries changed by committed transactions.
+
+The ORM event listeners only record which media entries and comments a
+transaction touched. Nothing reaches the index until the transaction commits,
+and a rollback simply forgets the recorded changes. Committed changes are put
+on an IndexQueue, which applies them to the engine in deduplicated batches.
+"""
+import os
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+
+from mediagoblin.db.base import Session
+
+_log = logging.getLogger(__name__)
+
+INDEX = 'index'
+REMOVE = 'remove'
+
+# The kinds of objects changes are recorded for
+MEDIA = 'media'
+COMMENT = 'comment'
+
+# Session.info keys for changes recorded by the current transaction, and for
+# changes of a committed transaction waiting for the transaction to end.
+PENDING_KEY = 'indexedsearch_pending'
+COMMITTED_KEY = 'indexedsearch_committed'
+
+
+class IndexQueue(object):
+    """Media entry and comment changes waiting to be applied to the index.
+
+    Changes are keyed by (kind, id) pairs, so an entry changed many times
+    before the queue is drained is only (re)indexed once, and the most
+    recent change wins. With a positive flush_interval a background thread
+    drains the queue, as soon as a full batch is waiting or at the latest
+    every flush_interval seconds. Otherwise the queue has to be drained by
+    calling flush(). With an indexer daemon, batches are sent to it, and
+    only applied in this process while it is unavailable.
+    """
+
+    def __init__(self, get_engine, batch_size=100, flush_interval=1.0,
+                 indexer=None):
+        """
+        Args:
+            get_engine: a callable returning the engine to apply changes to.
+            batch_size: the maximum number of changes per writer commit.
+            flush_interval: seconds between background flushes, 0 to disable
+                the background thread.
+            indexer: an indexedsearch.daemon.IndexerClient to send batches
+                to, or None.
+        """
+        self.get_engine = get_engine
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.indexer = indexer
+        self.stats = {'queued': 0, 'deduplicated': 0, 'batches': 0,
+                      'failed_batches': 0, 'sent_batches': 0}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = OrderedDict()
+        self._thread = None
+        self._pid = os.getpid()
+
+    def put(self, changes):
+        """Queue changes, a dict mapping (kind, id) pairs to INDEX/REMOVE."""
+        with self._lock:
+            self._check_pid()
+            for key, action in changes.items():
+                if key in self._pending:
+                    self.stats['deduplicated'] += 1
+                    del self._pending[key]
+                self._pending[key] = action
+                self.stats['queued'] += 1
+            full = len(self._pending) >= self.batch_size
+
+        if self.flush_interval > 0:
+            self._ensure_worker()
+            if full:
+                self._wakeup.set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _check_pid(self):
+        # Must be called with the lock held. Threads don't survive a fork,
+        # and the changes belong to the parent, which will index them.
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pending = OrderedDict()
+            self._thread = None
+            self._pid = pid
+
+    def _take_batch(self):
+        with self._lock:
+            self._check_pid()
+            batch = []
+            while self._pending and len(batch) < self.batch_size:
+                batch.append(self._pending.popitem(last=False))
+            return batch
+
+    def flush(self):
+        """Apply every queued change, one writer commit per batch."""
+        batch = self._take_batch()
+        while batch:
+            if self.indexer is not None and self.indexer.send(batch):
+                self.stats['sent_batches'] += 1
+                batch = self._take_batch()
+                continue
+            changes = dict(((kind, action), []) for kind in (MEDIA, COMMENT)
+                           for action in (INDEX, REMOVE))
+            for (kind, object_id), action in batch:
+                changes[kind, action].append(object_id)
+            try:
+                self.get_engine().apply_changes(
+                    changes[MEDIA, INDEX], changes[MEDIA, REMOVE],
+                    changes[COMMENT, INDEX], changes[COMMENT, REMOVE])
+                self.stats['batches'] += 1
+            except Exception:
+                # update_index reconciles whatever gets lost here
+                _log.exception('Failed to index a batch of media entries')
+                self.stats['failed_batches'] += 1
+            batch = self._take_batch()
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='indexedsearch-indexer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            finally:
+                # The thread has its own scoped session, don't keep it open
+                Session.remove()
+
+
+index_queue = None
+
+
+def setup_queue(get_engine, config, threaded=True, indexer=None):
+    """Create the process's index queue from the plugin config.
+
+    Args:
+        get_engine: a callable returning the engine to apply changes to.
+        config: the plugin config.
+        threaded: False if the database can't be used from another thread,
+            in which case changes are indexed as their transaction ends.
+        indexer: the IndexerClient of the indexer daemon, or None.
+    """
+    global index_queue
+
+    flush_interval = config.get('INDEX_QUEUE_INTERVAL', 1.0)
+    if not threaded:
+        flush_interval = 0
+    index_queue = IndexQueue(get_engine,
+                             batch_size=config.get('INDEX_QUEUE_BATCH_SIZE',
+                                                   100),
+                             flush_interval=flush_interval,
+                             indexer=indexer)
+    return index_queue
+
+
+def defer_change(session, object_id, action, kind=MEDIA):
+    """Record a change to a media entry, to be queued if the session commits.
+
+    Args:
+        session: the session of the changed object, or None.
+        object_id: the id of the media entry, or of the text comment.
+        action: INDEX or REMOVE.
+        kind: MEDIA or COMMENT.
+    """
+    if session is None:
+        # Not attached to a session, so there's no transaction to wait for
+        index_queue.put({(kind, object_id): action})
+        return
+    session.info.setdefault(PENDING_KEY, {})[kind, object_id] = action
+
+
+def session_after_commit(session):
+    changes = session.info.pop(PENDING_KEY, None)
+    if changes:
+        index_queue.put(changes)
+        if not index_queue.flush_interval:
+            # Can't query the database from within after_commit, so wait
+            # for the transaction to end.
+            session.info[COMMITTED_KEY] = True
+
+
+def session_after_rollback(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+def session_after_transaction_end(session, transaction):
+    if (transaction.parent is None and
+            session.info.pop(COMMITTED_KEY, False)):
+        index_queue.flush()
+
+
+@atexit.register
+def _flush_on_exit():
+    if index_queue is not None and index_queue.flush_interval:
+        index_queue.flush()
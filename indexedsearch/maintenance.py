@@ -0,0 +1,170 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Background merging of the index outside of busy hours.
+
+Every commit adds a segment, and deleted documents stay in their segment
+until it is merged. A MergeScheduler periodically checks the engine's index
+stats during configured off-peak hours, and optimizes the index once it has
+too many segments or too many deleted documents.
+"""
+import os
+import time
+import logging
+import datetime
+import threading
+
+_log = logging.getLogger(__name__)
+
+# Seconds between checks of whether the index needs merging
+CHECK_INTERVAL = 600.0
+
+
+def parse_hours(hours):
+    """Parse an off-peak window such as '1-5' into a (start, end) tuple.
+
+    Returns:
+        None if hours is empty.
+
+    Raises:
+        ValueError: hours isn't a range of hours of the day.
+    """
+    if not hours or not hours.strip():
+        return None
+    start, end = [int(hour) for hour in hours.split('-')]
+    if not (0 <= start < 24 and 0 <= end <= 24) or start == end:
+        raise ValueError('Invalid hours: %r' % hours)
+    return start, end
+
+
+def in_window(window, now=None):
+    """Return True if a time is within a (start, end) window of hours.
+
+    The window wraps around midnight when start is after end.
+    """
+    hour = (now or datetime.datetime.now()).hour
+    start, end = window
+    if start < end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+class MergeScheduler(object):
+    """Optimizes the index from a background thread during off-peak hours.
+    """
+
+    def __init__(self, get_engine, window, max_segments=10,
+                 max_deleted_ratio=0.2, check_interval=CHECK_INTERVAL):
+        """
+        Args:
+            get_engine: a callable returning the engine to optimize.
+            window: a (start, end) tuple of the hours merges may run in.
+            max_segments: merge once the index has more segments than this.
+            max_deleted_ratio: merge once a larger share of the documents
+                in the index are deleted.
+            check_interval: seconds between checks.
+        """
+        self.get_engine = get_engine
+        self.window = window
+        self.max_segments = max_segments
+        self.max_deleted_ratio = max_deleted_ratio
+        self.check_interval = check_interval
+        self.stats = {'checks': 0, 'merges': 0, 'skipped_locked': 0}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def needs_merge(self, index_stats):
+        return (index_stats['segments'] > self.max_segments or
+                index_stats['deleted_ratio'] > self.max_deleted_ratio)
+
+    def check(self, now=None):
+        """Optimize the index if it's off-peak and the index needs it.
+
+        Returns:
+            True if the index was optimized.
+        """
+        if not in_window(self.window, now):
+            return False
+        self.stats['checks'] += 1
+        engine = self.get_engine()
+        index_stats = engine.get_index_stats()
+        if not self.needs_merge(index_stats):
+            return False
+
+        _log.info('Merging %(segments)d segments, %(deleted_ratio).0f%% '
+                  'deleted documents' % dict(
+                      index_stats,
+                      deleted_ratio=index_stats['deleted_ratio'] * 100))
+        # Another process may already be merging, or busy indexing
+        if not engine.optimize(wait=False):
+            self.stats['skipped_locked'] += 1
+            return False
+        self.stats['merges'] += 1
+        return True
+
+    def ensure_running(self):
+        """Start the background thread, unless it runs in this process."""
+        # Threads don't survive a fork, so a child starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='indexedsearch-merger')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        # Stop once the plugin has been set up again with a new scheduler
+        while merge_scheduler is self:
+            time.sleep(self.check_interval)
+            try:
+                self.check()
+            except Exception:
+                _log.exception('Failed to merge the index')
+
+
+merge_scheduler = None
+
+
+def setup_merge_scheduler(get_engine, config):
+    """Start merging the index in the background, if the config asks to.
+
+    Args:
+        get_engine: a callable returning the engine to optimize.
+        config: the plugin config.
+    """
+    global merge_scheduler
+
+    try:
+        window = parse_hours(config.get('INDEX_MERGE_HOURS'))
+    except ValueError:
+        _log.warning('Ignoring invalid INDEX_MERGE_HOURS %r, expected e.g. '
+                     '"1-5"', config.get('INDEX_MERGE_HOURS'))
+        window = None
+
+    if window is None:
+        merge_scheduler = None
+        return None
+
+    merge_scheduler = MergeScheduler(
+        get_engine, window,
+        max_segments=config.get('INDEX_MERGE_SEGMENTS', 10),
+        max_deleted_ratio=config.get('INDEX_MERGE_DELETED_RATIO', 0.2))
+    merge_scheduler.ensure_running()
+    return merge_scheduler
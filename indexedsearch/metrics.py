@@ -0,0 +1,243 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Counters, gauges and latency histograms of searching and indexing.
+
+Engines record into the process's Metrics object, which renders them in the
+Prometheus text format for the optional /search/metrics/ route. Observers
+are told about every recorded value, e.g. to forward them to another
+monitoring system, and collectors are asked for values at render time, e.g.
+the number of index segments. Other plugins can register either by
+implementing the 'indexedsearch_metrics' hook, which is called with the
+Metrics object when the engine is set up.
+"""
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+_log = logging.getLogger(__name__)
+
+PREFIX = 'indexedsearch_'
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# Upper bounds, in seconds, of the latency histograms' buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Help text of the metrics recorded by the engines
+DESCRIPTIONS = {
+    'searches': 'Searches answered, including cached ones',
+    'search_hits': 'Media entries matched by searches',
+    'zero_result_searches': 'Searches without any hits',
+    'search_seconds': 'Time taken to answer a search',
+    'partial_searches': 'Searches that ran out of time, answered with the '
+                        'hits found until then',
+    'abandoned_searches': 'Searches the results page stopped waiting for',
+    'documents_indexed': 'Documents written to the index',
+    'documents_unchanged': 'Documents not rewritten as they were unchanged',
+    'documents_removed': 'Documents removed from the index',
+    'add_media_entry_seconds': 'Time taken to index a media entry',
+    'remove_media_entry_seconds': 'Time taken to remove a media entry',
+    'update_index_seconds': 'Time taken to sync the index with the database',
+    'update_index_docs_per_second': 'Documents written or removed per '
+                                    'second by the last index sync',
+    'rebuild_docs_per_second': 'Documents written per second by the last '
+                               'rebuild',
+    'commit_seconds': 'Time taken to commit a writer',
+    'writer_lock_wait_seconds': 'Time spent waiting for the index lock',
+    'writer_lock_busy': 'Writes buffered because the index lock was held',
+    'writer_lock_timeouts': 'Writers that gave up waiting for the index lock',
+    'index_segments': 'Segments in the index',
+    'index_documents': 'Live documents in the index',
+    'index_deleted_documents': 'Deleted documents still in the index',
+    'index_size_bytes': 'Size of the index',
+}
+
+
+class Histogram(object):
+    """Counts observed values into buckets of increasing upper bounds."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for bucket_index, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = bucket_index
+                break
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """Return (upper bound, count) tuples, the last bound being inf."""
+        total = 0
+        counts = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            counts.append((bound, total))
+        return counts
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Metrics(object):
+    """The metrics of one process.
+
+    Like the engine stats, metrics are kept per process. A server running
+    several worker processes has each of them report its own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._observers = []
+        self._collectors = {}
+
+    def add_observer(self, observer):
+        """Call observer(kind, name, value) for every recorded value."""
+        self._observers.append(observer)
+
+    def add_collector(self, name, collector):
+        """Register a callable returning (kind, name, value) tuples.
+
+        Collectors are called whenever the metrics are rendered. Adding a
+        collector replaces any other collector of the same name.
+        """
+        self._collectors[name] = collector
+
+    def reset(self):
+        """Forget every recorded value, observer and collector."""
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+            self._observers = []
+            self._collectors = {}
+
+    def _notify(self, kind, name, value):
+        for observer in self._observers:
+            try:
+                observer(kind, name, value)
+            except Exception:
+                _log.exception('Metrics observer %r failed', observer)
+
+    def inc(self, name, amount=1):
+        """Add to a counter."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        self._notify(COUNTER, name, amount)
+
+    def set(self, name, value):
+        """Set a gauge."""
+        with self._lock:
+            self.gauges[name] = value
+        self._notify(GAUGE, name, value)
+
+    def observe(self, name, value):
+        """Add a value, e.g. a duration in seconds, to a histogram."""
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+        self._notify(HISTOGRAM, name, value)
+
+    @contextmanager
+    def timer(self, name):
+        """Observe how long the body of a with statement takes."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def record_search(self, seconds, hits):
+        """Record a search that took seconds and matched hits entries."""
+        self.observe('search_seconds', seconds)
+        self.inc('searches')
+        self.inc('search_hits', hits)
+        if not hits:
+            self.inc('zero_result_searches')
+
+    def collect(self):
+        """Return the values of every collector as (kind, name, value)."""
+        collected = []
+        for name, collector in list(self._collectors.items()):
+            try:
+                collected.extend(collector())
+            except Exception:
+                _log.exception('Metrics collector %s failed', name)
+        return collected
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        with self._lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = dict(
+                (name, (histogram.cumulative_counts(), histogram.sum,
+                        histogram.count))
+                for name, histogram in self.histograms.items())
+        for kind, name, value in self.collect():
+            if kind == COUNTER:
+                counters[name] = counters.get(name, 0) + value
+            else:
+                gauges[name] = value
+
+        lines = []
+
+        def header(name, kind, metric_name):
+            lines.append('# HELP %s %s' % (
+                metric_name, DESCRIPTIONS.get(name, name.replace('_', ' '))))
+            lines.append('# TYPE %s %s' % (metric_name, kind))
+
+        for name in sorted(counters):
+            metric_name = PREFIX + name + '_total'
+            header(name, COUNTER, metric_name)
+            lines.append('%s %s' % (metric_name,
+                                    _format_value(counters[name])))
+        for name in sorted(gauges):
+            metric_name = PREFIX + name
+            header(name, GAUGE, metric_name)
+            lines.append('%s %s' % (metric_name, _format_value(gauges[name])))
+        for name in sorted(histograms):
+            counts, total, count = histograms[name]
+            metric_name = PREFIX + name
+            header(name, HISTOGRAM, metric_name)
+            for bound, bucket_count in counts:
+                lines.append('%s_bucket{le="%s"} %d' % (
+                    metric_name, _format_value(bound), bucket_count))
+            lines.append('%s_sum %s' % (metric_name, _format_value(total)))
+            lines.append('%s_count %d' % (metric_name, count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -0,0 +1,182 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""The subset of whoosh's query language understood by the other backends.
+
+Queries are parsed into a tree of Words, And, Or and Not nodes, which each
+backend translates into its own kind of query. The syntax covers words,
+"phrases", prefixes (word*), field:word, field:"phrase", field:(group),
+AND, OR, NOT and parentheses. Like whoosh's default parser, every word of a
+query has to match unless OR says otherwise, and malformed queries are
+parsed as well as they can be rather than rejected.
+"""
+import re
+
+# Parentheses, quoted phrases (possibly unterminated) and words
+_TOKEN = re.compile(r'\(|\)|"[^"]*"?|[^\s()"]+')
+OPERATORS = ('AND', 'OR', 'NOT')
+
+
+class Node(object):
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            '%s=%r' % item for item in sorted(self.__dict__.items())))
+
+
+class Words(Node):
+    """Words to find next to each other in any of some fields.
+
+    A single word is a phrase of one word. A prefix phrase's last word
+    matches any word starting with it.
+    """
+
+    def __init__(self, fields, words, prefix=False):
+        self.fields = tuple(fields)
+        self.words = tuple(words)
+        self.prefix = prefix
+
+
+class And(Node):
+    """Matches what all of its children match. Some may be Not nodes."""
+
+    def __init__(self, children):
+        self.children = list(children)
+
+
+class Or(Node):
+    """Matches what any of its children match."""
+
+    def __init__(self, children):
+        self.children = list(children)
+
+
+class Not(Node):
+    """Matches what its child doesn't."""
+
+    def __init__(self, child):
+        self.child = child
+
+
+def _combine(node_class, children):
+    children = [child for child in children if child is not None]
+    if not children:
+        return None
+    if len(children) == 1:
+        return children[0]
+    return node_class(children)
+
+
+def parse_query(text, default_fields, fields=None):
+    """Parse a query string into a tree of nodes.
+
+    Args:
+        text: the query string.
+        default_fields: the fields words without a field are searched in.
+        fields: the names of the fields words can be prefixed with,
+            defaults to default_fields. Other prefixes are part of the word.
+
+    Returns:
+        The root node, or None if the query has no words.
+    """
+    return _Parser(_TOKEN.findall(text), default_fields,
+                   fields or default_fields).parse()
+
+
+class _Parser(object):
+
+    def __init__(self, tokens, default_fields, fields):
+        self.tokens = tokens
+        self.position = 0
+        self.default_fields = tuple(default_fields)
+        self.fields = set(fields)
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        children = [self.parse_or(self.default_fields)]
+        # Carry on after unbalanced closing parentheses
+        while self.next() is not None:
+            children.append(self.parse_or(self.default_fields))
+        return _combine(And, children)
+
+    def parse_or(self, fields):
+        children = [self.parse_and(fields)]
+        while self.peek() == 'OR':
+            self.next()
+            children.append(self.parse_and(fields))
+        return _combine(Or, children)
+
+    def parse_and(self, fields):
+        children = []
+        while self.peek() not in (None, ')', 'OR'):
+            if self.peek() == 'AND':
+                self.next()
+                continue
+            children.append(self.parse_not(fields))
+        return _combine(And, children)
+
+    def parse_not(self, fields):
+        if self.peek() != 'NOT':
+            return self.parse_atom(fields)
+        self.next()
+        if self.peek() in (None, ')', 'OR'):
+            return None
+        child = self.parse_not(fields)
+        return Not(child) if child is not None else None
+
+    def parse_atom(self, fields):
+        token = self.next()
+        if token == '(':
+            node = self.parse_or(fields)
+            if self.peek() == ')':
+                self.next()
+            return node
+        if token.startswith('"'):
+            return self.words(fields, token.strip('"').split())
+
+        field, colon, rest = token.partition(':')
+        if colon and field in self.fields:
+            if rest:
+                return self.word((field,), rest)
+            # e.g. title:"a phrase" or tag:(one OR two)
+            if self.peek() in (None, ')') or self.peek() in OPERATORS:
+                return None
+            return self.parse_atom((field,))
+        return self.word(fields, token)
+
+    def word(self, fields, text):
+        prefix = len(text) > 1 and text.endswith('*')
+        return self.words(fields, [text.rstrip('*')], prefix)
+
+    def words(self, fields, words, prefix=False):
+        words = [word for word in words if word]
+        if not words:
+            return None
+        return Words(fields, words, prefix)
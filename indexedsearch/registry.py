@@ -0,0 +1,90 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import logging
+import importlib
+import threading
+
+_log = logging.getLogger(__name__)
+
+
+class EngineRegistry(object):
+    """Per-process cache of search engines.
+
+    Engines are keyed by their configuration, so every caller asking for the
+    same backend and options gets the same engine (and therefore the same
+    opened index) back. The registry remembers the pid it was filled in; a
+    forked child finds a different pid and starts with an empty registry
+    rather than sharing index handles with its parent.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._engines = {}
+        self._pid = os.getpid()
+        self.stats = {'created': 0, 'reused': 0}
+
+    def _key(self, config):
+        return tuple(sorted((key, repr(value))
+                            for key, value in config.items()))
+
+    def _check_pid(self):
+        # Must be called with the lock held.
+        pid = os.getpid()
+        if pid != self._pid:
+            _log.debug('Process forked, discarding cached engines')
+            self._engines = {}
+            self._pid = pid
+
+    def get(self, config):
+        """Return the engine for a config, creating it on first use.
+
+        Args:
+            config: the plugin config. BACKEND names the module providing
+                the Engine class, the whole config is passed to the engine.
+        """
+        key = self._key(config)
+        with self._lock:
+            self._check_pid()
+            engine = self._engines.get(key)
+            if engine is not None:
+                self.stats['reused'] += 1
+                return engine
+
+            backend_module = importlib.import_module(config.get('BACKEND'))
+            engine = backend_module.Engine(**config)
+            self._engines[key] = engine
+            self.stats['created'] += 1
+            return engine
+
+    def clear(self):
+        """Forget every cached engine, e.g. after the index was recreated."""
+        with self._lock:
+            self._engines = {}
+            self._pid = os.getpid()
+
+    def get_stats(self):
+        """Return engine, searcher and cache counters for this process."""
+        with self._lock:
+            stats = dict(('engines_' + key, value)
+                         for key, value in self.stats.items())
+            for engine in self._engines.values():
+                for key, value in engine.get_stats().items():
+                    stats[key] = stats.get(key, 0) + value
+        return stats
+
+
+registry = EngineRegistry()
@@ -0,0 +1,66 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from bisect import bisect_left
+
+# The order completions of each kind are suggested in
+SUGGESTION_KINDS = ('tag', 'user', 'title')
+
+
+class PrefixIndex(object):
+    """Sorted arrays of terms, for looking up completions of a prefix.
+
+    Terms are matched case-insensitively, but suggested as they were given.
+    A lookup is a binary search followed by a slice, so it doesn't depend on
+    how many terms share the prefix.
+    """
+
+    def __init__(self, terms):
+        """
+        Args:
+            terms: a dict mapping each kind in SUGGESTION_KINDS to an
+                iterable of terms.
+        """
+        self._keys = {}
+        self._terms = {}
+        for kind in SUGGESTION_KINDS:
+            pairs = sorted(set((term.lower(), term)
+                               for term in terms.get(kind, ())))
+            self._keys[kind] = [key for key, term in pairs]
+            self._terms[kind] = [term for key, term in pairs]
+
+    def __len__(self):
+        return sum(len(keys) for keys in self._keys.values())
+
+    def complete(self, prefix, limit):
+        """Return up to limit (kind, term) tuples for terms with a prefix."""
+        prefix = prefix.lower()
+        suggestions = []
+        if not prefix:
+            return suggestions
+
+        for kind in SUGGESTION_KINDS:
+            keys = self._keys[kind]
+            start = bisect_left(keys, prefix)
+            stop = start
+            wanted = limit - len(suggestions)
+            while (stop < len(keys) and stop - start < wanted and
+                   keys[stop].startswith(prefix)):
+                stop += 1
+            suggestions.extend((kind, term)
+                               for term in self._terms[kind][start:stop])
+            if len(suggestions) >= limit:
+                break
+        return suggestions
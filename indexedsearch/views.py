@@ -15,17 +15,207 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from mediagoblin.db.models import MediaEntry
 from mediagoblin.decorators import require_active_login, uses_pagination
-from mediagoblin.tools.response import render_to_response
-from mediagoblin.tools.pagination import Pagination
+from mediagoblin.tools.response import (render_to_response, json_response,
+                                        Response)
+from mediagoblin.tools.pagination import (Pagination,
+                                          PAGINATION_DEFAULT_PER_PAGE)
 from mediagoblin.tools import pluginapi
+from mediagoblin.tools.translate import lazy_pass_to_ugettext as _
 from mediagoblin.meddleware.csrf import csrf_exempt
 
 from indexedsearch import get_engine
+from indexedsearch.backends import FACETS, SORT_ORDERS
+from indexedsearch.metrics import metrics
 import indexedsearch.forms
 
+import os
+import time
+import datetime
 import logging
+import threading
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 _log = logging.getLogger(__name__)
 
+FACET_LABELS = {'tag': _('Tags'),
+                'user': _('Uploaders'),
+                'media_type': _('Media types')}
+
+# Seconds the results page waits for a search on the search pool beyond the
+# SEARCH_TIME_LIMIT, for counting facets and correcting the query
+SEARCH_DEADLINE_GRACE = 1.0
+
+_search_pool = None
+_search_pool_pid = None
+_search_pool_lock = threading.Lock()
+
+
+def get_search_pool(threads):
+    """Return the process's pool of search threads, starting it if needed.
+
+    Threads don't survive a fork, so a forked worker starts its own pool.
+    """
+    global _search_pool, _search_pool_pid
+
+    with _search_pool_lock:
+        if _search_pool is None or _search_pool_pid != os.getpid():
+            _search_pool = ThreadPool(threads)
+            _search_pool_pid = os.getpid()
+        return _search_pool
+
+
+def run_search(config, function, *args, **kwargs):
+    """Call a search function, waiting at most until the search deadline.
+
+    With the SEARCH_THREADS and SEARCH_TIME_LIMIT options, the search runs
+    on the search pool, and the request stops waiting for it once the time
+    limit and SEARCH_DEADLINE_GRACE have passed, whatever the backend. A
+    search given up on keeps its pool thread until the engine's own time
+    limit stops it, and searches still queued by then are skipped, so that
+    slow queries only ever hold up the pool's threads.
+
+    Returns:
+        What the function returned, or None if the deadline passed first.
+    """
+    threads = config.get('SEARCH_THREADS') or 0
+    time_limit = config.get('SEARCH_TIME_LIMIT') or 0
+    if not threads or not time_limit:
+        return function(*args, **kwargs)
+
+    deadline = time.time() + time_limit + SEARCH_DEADLINE_GRACE
+
+    def search():
+        if time.time() > deadline:
+            return None
+        return function(*args, **kwargs)
+
+    result = get_search_pool(threads).apply_async(search)
+    try:
+        return result.get(max(0, deadline - time.time()))
+    except TimeoutError:
+        _log.warning('Gave up waiting for a search after %.2fs' % (
+            time_limit + SEARCH_DEADLINE_GRACE))
+        metrics.inc('abandoned_searches')
+        return None
+
+
+class MediaEntryList(list):
+    """A list of media entries that can stand in for a query in templates.
+
+    object_gallery calls count() on the media entries it is given.
+    """
+
+    def count(self, *args):
+        if args:
+            return list.count(self, *args)
+        return len(self)
+
+
+class StoredMediaEntry(object):
+    """A search result rendered from the fields stored in the index.
+
+    Provides the attributes object_gallery uses, without a database query.
+    """
+
+    def __init__(self, media_id, fields):
+        self.id = media_id
+        self.title = fields['title']
+        self.slug = fields['slug']
+        self.username = fields['user']
+        self.media_type = fields['media_type']
+        self.thumb_url = fields['thumb_url']
+        self.icon_url = fields['icon_url']
+
+    @property
+    def slug_or_id(self):
+        if self.slug:
+            return self.slug
+        return u'id:%s' % self.id
+
+    def url_for_self(self, urlgen, **extra_args):
+        return urlgen(
+            'mediagoblin.user_pages.media_home',
+            user=self.username,
+            media=self.slug_or_id,
+            **extra_args)
+
+
+class SearchPagination(Pagination):
+    """Pagination over a page of search results.
+
+    The engine has already worked out which media entries are on the page
+    and how many match in total, so unlike Pagination this doesn't count or
+    slice a database query.
+    """
+
+    def __init__(self, page, media_ids, total_count,
+                 per_page=PAGINATION_DEFAULT_PER_PAGE, stored_fields=None):
+        """
+        Args:
+            stored_fields: for each media id, the result fields stored in the
+                index, or None to load the media entry from the database.
+        """
+        self.page = page
+        self.per_page = per_page
+        self.media_ids = media_ids
+        self.stored_fields = stored_fields or [None] * len(media_ids)
+        self.total_count = total_count
+        self.active_id = None
+
+    def __call__(self):
+        """Return the page's media entries, in relevance order."""
+        entries = {}
+        for media_id, fields in zip(self.media_ids, self.stored_fields):
+            if fields is not None:
+                entries[media_id] = StoredMediaEntry(media_id, fields)
+
+        missing = [media_id for media_id in self.media_ids
+                   if media_id not in entries]
+        if missing:
+            for entry in MediaEntry.query.filter(MediaEntry.id.in_(missing)):
+                entries[entry.id] = entry
+
+        return MediaEntryList(entries[media_id] for media_id in self.media_ids
+                              if media_id in entries)
+
+
+def facet_links(request, params, filters, facets):
+    """Return the facets of a search, with links to filter the results.
+
+    Args:
+        request: the search request.
+        params: a dict of the search's other url parameters, e.g. 'q'.
+        filters: a dict of the facet filters applied to the search.
+        facets: the facet counts returned by the engine's search_page.
+
+    Returns:
+        A list with a dict per facet holding its 'label' and 'links', each
+        link being a dict with a 'value', a 'count' and a 'url' that adds the
+        value to the filters. Filters that are applied have a link removing
+        them instead, with a count of None.
+    """
+    result = []
+    for name in FACETS:
+        links = []
+        if name in filters:
+            others = dict((other, value) for other, value in filters.items()
+                          if other != name)
+            others.update(params)
+            links.append({'value': filters[name],
+                          'count': None,
+                          'url': request.urlgen('indexedsearch', **others)})
+        else:
+            for value, count in facets.get(name, []):
+                link_params = dict(filters, **params)
+                link_params[name] = value
+                links.append({'value': value,
+                              'count': count,
+                              'url': request.urlgen('indexedsearch',
+                                                    **link_params)})
+        if links:
+            result.append({'label': FACET_LABELS[name], 'links': links})
+    return result
+
 
 @require_active_login
 def user_search_results_view(request):
@@ -37,7 +227,12 @@ def user_search_results_view(request):
 def search_results_view(request, page):
     media_entries = None
     pagination = None
-    form = indexedsearch.forms.SearchForm(request.form)
+    facets = None
+    correction = None
+    partial = False
+    form = indexedsearch.forms.SearchForm(request.GET)
+    # uses_pagination lets page 0 through, engines count pages from 1
+    page = max(page, 1)
 
     config = pluginapi.get_config('indexedsearch')
     if config.get('SEARCH_LINK_STYLE') == 'form':
@@ -50,13 +245,45 @@ def search_results_view(request, page):
         query = request.GET['q']
 
     if query:
-        engine = get_engine()
-        result_ids = engine.search(query)
+        filters = dict((name, request.GET[name]) for name in FACETS
+                       if request.GET.get(name))
+        # Links to other searches keep the sort order and date range
+        params = dict((name, request.GET[name])
+                      for name in ('q', 'sort', 'after', 'before')
+                      if request.GET.get(name))
+
+        sort = form.sort.data
+        if sort not in SORT_ORDERS:
+            sort = None
+        # Invalid dates are left as None by the form
+        start = end = None
+        if form.after.data:
+            start = datetime.datetime.combine(form.after.data,
+                                              datetime.time.min)
+        if form.before.data:
+            end = datetime.datetime.combine(form.before.data,
+                                            datetime.time.max)
 
-        if result_ids:
-            matches = MediaEntry.query.filter(
-                MediaEntry.id.in_(result_ids))
-            pagination = Pagination(page, matches)
+        results = run_search(config, get_engine().search_page, query, page,
+                             PAGINATION_DEFAULT_PER_PAGE, filters=filters,
+                             sort=sort, date_range=(start, end))
+        if results is None:
+            # The search didn't finish in time, keep the form and filters
+            results = {'ids': [], 'total': 0, 'facets': {},
+                       'partial': True}
+        partial = results.get('partial', False)
+        facets = facet_links(request, params, filters, results['facets'])
+        if results.get('correction'):
+            correction_params = dict(filters, **params)
+            correction_params['q'] = results['correction']
+            correction = {'query': results['correction'],
+                          'url': request.urlgen('indexedsearch',
+                                                **correction_params)}
+
+        if results['total']:
+            pagination = SearchPagination(
+                page, results['ids'], results['total'],
+                stored_fields=results.get('fields'))
             media_entries = pagination()
 
     return render_to_response(
@@ -64,4 +291,42 @@ def search_results_view(request, page):
         'indexedsearch/results.html',
         {'media_entries': media_entries,
          'pagination': pagination,
+         'facets': facets,
+         'correction': correction,
+         'partial': partial,
          'form': form})
+
+
+@require_active_login
+def user_suggest_view(request):
+    return suggest_view(request)
+
+
+def suggest_view(request):
+    """Return completions of the 'q' parameter as JSON.
+
+    At most SUGGEST_LIMIT completions are returned, fewer if the 'limit'
+    parameter asks for fewer.
+    """
+    config = pluginapi.get_config('indexedsearch')
+    max_limit = config.get('SUGGEST_LIMIT', 10)
+    try:
+        limit = min(int(request.GET.get('limit', max_limit)), max_limit)
+    except ValueError:
+        limit = max_limit
+
+    prefix = request.GET.get('q', '').lstrip()
+    suggestions = []
+    if prefix and limit > 0:
+        suggestions = get_engine().suggest(prefix, limit)
+
+    return json_response(
+        {'suggestions': [{'kind': kind, 'text': text}
+                         for kind, text in suggestions]},
+        _disable_cors=True)
+
+
+def metrics_view(request):
+    """Return this process's search and indexing metrics for Prometheus."""
+    return Response(metrics.render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
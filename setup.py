@@ -55,6 +55,9 @@ setup(
     include_package_data=True,
     package_data={'': ['indexedsearch/config_spec.ini']},
     install_requires=['whoosh'],
+    entry_points={
+        'console_scripts': [
+            'gmg-indexedsearch = indexedsearch.commands:main']},
     tests_require=['pytest'],
     cmdclass={'test': PyTest},
     classifiers=[
@@ -14,10 +14,18 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import importlib
+
 import pytest
 import pkg_resources
 from mediagoblin.tests import tools
 
+# The options of each backend the engine fixture creates engines of
+BACKENDS = {'whoosh': {},
+            'sqlite_fts': {},
+            'memory': {},
+            'sharded': {'INDEX_SHARDS': 2}}
+
 
 @pytest.fixture()
 def test_app(request):
@@ -30,3 +38,17 @@ def test_app(request):
         request,
         mgoblin_config=pkg_resources.resource_filename(
             'test', config_file))
+
+
+@pytest.fixture(params=sorted(BACKENDS))
+def engine(request, test_app, tmpdir):
+    """An engine of each backend, with an index of its own in tmpdir.
+
+    The app's event hooks index into the engine of its own config, so
+    database changes only reach this engine through its update_index,
+    apply_changes and rebuild_index.
+    """
+    backend = importlib.import_module('indexedsearch.backends.' +
+                                      request.param)
+    return backend.Engine(INDEX_DIR=str(tmpdir.join('index')),
+                          **BACKENDS[request.param])
@@ -0,0 +1,324 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import unicode_literals
+
+import argparse
+import datetime
+from mediagoblin.db.base import Session
+from mediagoblin.tests.tools import (fixture_media_entry,
+                                     fixture_add_comment)
+from indexedsearch import commands
+from indexedsearch.backends import memory, sharded, sqlite_fts
+
+
+def write_documents(engine, *docs):
+    """Write documents into any backend's index, bypassing the database."""
+    if isinstance(engine, sharded.Engine):
+        for doc in docs:
+            write_documents(engine.shard_for(doc['media_id']), doc)
+    elif isinstance(engine, sqlite_fts.Engine):
+        with engine.transaction() as connection:
+            for doc in docs:
+                engine.write_document(doc, connection)
+    elif isinstance(engine, memory.Engine):
+        for doc in docs:
+            engine.write_document(doc)
+    else:
+        with engine.open_writer() as writer:
+            for doc in docs:
+                engine.write_document(doc, writer)
+
+
+def test_update_index(engine):
+    """
+    Test that update_index adds, updates and removes media entries and
+    comments, and that check_index reports what it would do.
+    """
+    media_a = fixture_media_entry(title='mediaA', save=False,
+                                  expunge=False, fake_upload=False,
+                                  state='processed')
+    media_b = fixture_media_entry(title='mediaB', save=False,
+                                  expunge=False, fake_upload=False,
+                                  state='processed')
+    Session.add(media_a)
+    Session.add(media_b)
+    Session.commit()
+    comment = fixture_add_comment(author=media_a.actor, media_entry=media_a,
+                                  comment='a goblin party')
+
+    assert engine.check_index()['added'] == sorted([media_a.id, media_b.id])
+    assert engine.update_index() == {'added': 2, 'updated': 0, 'removed': 0}
+    assert engine.search('mediaA') == [media_a.id]
+    assert engine.search('party') == [media_a.id]
+    assert engine.is_indexed(media_b.id)
+
+    media_a.title = 'new'
+    media_a.updated = datetime.datetime.utcnow()
+    media_a.save()
+    media_b.delete()
+    comment.delete()
+    assert engine.check_index() == {'added': [], 'updated': [media_a.id],
+                                    'removed': [media_b.id]}
+    assert engine.update_index() == {'added': 0, 'updated': 1, 'removed': 1}
+    assert engine.search('new') == [media_a.id]
+    assert engine.search('mediaA') == []
+    assert engine.search('mediaB') == []
+    assert engine.search('party') == []
+
+
+def test_sync_skips_unprocessed_media_entries(engine):
+    """
+    Test that a full sync doesn't try to add unprocessed media entries, and
+    that it agrees with check_index about entries no longer processed.
+    """
+    media_a = fixture_media_entry(title='mediaA', save=False,
+                                  expunge=False, fake_upload=False,
+                                  state='processed')
+    media_b = fixture_media_entry(title='mediaB', save=False,
+                                  expunge=False, fake_upload=False,
+                                  state='unprocessed')
+    Session.add(media_a)
+    Session.add(media_b)
+    Session.commit()
+
+    engine.update_index(full=True)
+    assert engine.update_index(full=True) == {'added': 0, 'updated': 0,
+                                              'removed': 0}
+
+    media_a.state = 'failed'
+    media_a.save()
+    assert engine.check_index()['removed'] == [media_a.id]
+    assert engine.update_index(full=True)['removed'] == 1
+    assert not engine.is_indexed(media_a.id)
+    assert engine.check_index() == {'added': [], 'updated': [],
+                                    'removed': []}
+
+
+def test_rebuild_index(engine):
+    """
+    Test that rebuild_index replaces the index with documents for exactly
+    the processed media entries in the database, reporting its progress, and
+    that the rebuilt index can be optimized.
+    """
+    media = []
+    for title, state in [('mediaA', 'processed'), ('mediaB', 'unprocessed'),
+                         ('mediaC', 'processed'), ('mediaD', 'processed')]:
+        media.append(fixture_media_entry(title=title, save=False,
+                                         expunge=False, fake_upload=False,
+                                         state=state))
+        Session.add(media[-1])
+    Session.commit()
+    ids = [entry.id for entry in media]
+    engine.update_index()
+    # Leaves a document behind, as the engine isn't told about it
+    media[3].delete()
+
+    progress = []
+    assert engine.rebuild_index(
+        batch_size=1, progress=lambda *args: progress.append(args)) == 2
+    assert progress[-1][0] == 2
+    assert engine.search('mediaA') == [ids[0]]
+    assert engine.search('mediaB') == []
+    assert engine.search('mediaC') == [ids[2]]
+    assert engine.search('mediaD') == []
+    assert engine.check_index() == {'added': [], 'updated': [],
+                                    'removed': []}
+    assert engine.optimize()
+    assert engine.get_index_stats()['documents'] == 2
+
+
+def test_comments(engine):
+    """Test that comments match the media entries they are on."""
+    media_a = fixture_media_entry(title='mediaA', save=False,
+                                  expunge=False, fake_upload=False,
+                                  state='processed')
+    media_b = fixture_media_entry(title='goblin', save=False,
+                                  expunge=False, fake_upload=False,
+                                  state='processed')
+    Session.add(media_a)
+    Session.add(media_b)
+    Session.commit()
+    comment = fixture_add_comment(author=media_a.actor, media_entry=media_a,
+                                  comment='a goblin party')
+
+    engine.update_index()
+    assert engine.get_index_stats()['comment_documents'] == 1
+    assert engine.search('party') == [media_a.id]
+    assert sorted(engine.search('goblin')) == sorted([media_a.id,
+                                                      media_b.id])
+    assert engine.search('goblin NOT comment:party') == [media_b.id]
+    assert engine.search('mediaA comment:party') == [media_a.id]
+
+    engine.apply_changes([], [], comments_to_remove=[comment.id])
+    assert engine.search('party') == []
+    engine.apply_changes([], [], comments_to_index=[comment.id])
+    assert engine.search('party') == [media_a.id]
+
+
+def test_search_page(engine):
+    """
+    Test that search_page returns a page of ids in relevance order, along
+    with the total number of hits and pages.
+    """
+    write_documents(engine,
+                    {'media_id': 1, 'title': 'goblin'},
+                    {'media_id': 2, 'title': 'goblin goblin goblin'},
+                    {'media_id': 3, 'title': 'goblin goblin'},
+                    {'media_id': 4, 'title': 'party'})
+
+    def page(query, pagenum):
+        result = engine.search_page(query, pagenum, 2)
+        return dict((key, result[key]) for key in ('ids', 'total',
+                                                   'pagecount'))
+
+    assert page('goblin', 1) == {'ids': [2, 3], 'total': 3, 'pagecount': 2}
+    assert page('goblin', 2) == {'ids': [1], 'total': 3, 'pagecount': 2}
+    assert page('goblin', 3)['ids'] == []
+    assert page('missing', 1) == {'ids': [], 'total': 0, 'pagecount': 0}
+
+
+def test_search_top_hits(engine):
+    """Test that search returns the 10 most relevant hits on any backend."""
+    write_documents(engine, *[{'media_id': media_id,
+                               'title': 'goblin %d' % media_id}
+                              for media_id in range(1, 13)])
+    write_documents(engine, {'media_id': 20,
+                             'title': 'goblin goblin goblin'})
+
+    ids = engine.search('goblin')
+    assert len(ids) == 10
+    assert ids[0] == 20
+    assert len(engine.search_page('goblin', 1, 20)['ids']) == 13
+
+
+def test_search_page_facets_and_filters(engine):
+    """
+    Test that search_page counts the tags, uploaders and media types of the
+    matching media entries, and can be narrowed down by them.
+    """
+    write_documents(engine,
+                    {'media_id': 1, 'title': 'goblin',
+                     'facet_tag': 'hello world,cat', 'facet_user': 'chris',
+                     'facet_media_type': 'image'},
+                    {'media_id': 2, 'title': 'goblin goblin',
+                     'facet_tag': 'cat', 'facet_user': 'bob',
+                     'facet_media_type': 'image'},
+                    {'media_id': 3, 'title': 'goblin goblin goblin'})
+
+    results = engine.search_page('goblin', 1, 10)
+    assert results['facets'] == {
+        'tag': [('cat', 2), ('hello world', 1)],
+        'user': [('bob', 1), ('chris', 1)],
+        'media_type': [('image', 2)]}
+
+    results = engine.search_page('goblin', 1, 10, filters={'tag': 'cat'})
+    assert sorted(results['ids']) == [1, 2]
+    assert results['total'] == 2
+
+    results = engine.search_page('goblin', 1, 10,
+                                 filters={'tag': 'hello world',
+                                          'user': 'chris'})
+    assert results['ids'] == [1]
+    assert results['facets']['user'] == [('chris', 1)]
+
+    results = engine.search_page('goblin', 1, 10,
+                                 filters={'tag': 'hello world',
+                                          'user': 'bob'})
+    assert results['ids'] == []
+    assert results['total'] == 0
+
+
+def test_suggest(engine):
+    """
+    Test that suggest completes tags, uploaders and title words, and that
+    its prefix index is rebuilt once the index changes.
+    """
+    write_documents(engine, {'media_id': 1, 'title': 'Goblin gold',
+                             'facet_tag': 'Good dog', 'facet_user': 'gordon'})
+
+    assert engine.suggest('go', 10) == [
+        ('tag', 'Good dog'), ('user', 'gordon'),
+        ('title', 'goblin'), ('title', 'gold')]
+    assert engine.suggest('go', 2) == [('tag', 'Good dog'),
+                                       ('user', 'gordon')]
+
+    builds = engine.stats['prefix_index_builds']
+    write_documents(engine, {'media_id': 2, 'title': 'goblins'})
+    assert ('title', 'goblins') in engine.suggest('gob', 10)
+    assert engine.stats['prefix_index_builds'] == builds + 1
+
+
+def test_search_page_sort_and_date_range(engine):
+    """
+    Test that search_page sorts hits by creation date when asked to, and
+    only returns media entries created within a date range.
+    """
+    write_documents(engine,
+                    {'media_id': 1, 'title': 'goblin',
+                     'created': datetime.datetime(2016, 1, 5)},
+                    {'media_id': 2, 'title': 'goblin goblin',
+                     'created': datetime.datetime(2016, 3, 5)},
+                    {'media_id': 3, 'title': 'goblin goblin goblin',
+                     'created': datetime.datetime(2016, 2, 5)})
+
+    assert engine.search_page('goblin', 1, 10, sort='newest')['ids'] == \
+        [2, 3, 1]
+    assert engine.search_page('goblin', 2, 2, sort='oldest')['ids'] == [2]
+
+    results = engine.search_page(
+        'goblin', 1, 10, sort='oldest',
+        date_range=(datetime.datetime(2016, 2, 1), None))
+    assert results['ids'] == [3, 2]
+    assert results['total'] == 2
+
+
+def test_check_index_and_verify_command(engine, capsys):
+    """
+    Test that check_index reports drift without changing the index, that the
+    verify command fails until the index is synced, and that a rebuild
+    reports its progress.
+    """
+    media_a = fixture_media_entry(title='mediaA', save=False,
+                                  expunge=False, fake_upload=False,
+                                  state='processed')
+    media_b = fixture_media_entry(title='mediaB', save=False,
+                                  expunge=False, fake_upload=False,
+                                  state='unprocessed')
+    Session.add(media_a)
+    Session.add(media_b)
+    Session.commit()
+
+    engine.update_index()
+    engine.remove_media_entry(media_a.id)
+    write_documents(engine, {'media_id': 29, 'title': 'fake document'})
+
+    # Unprocessed entries have nothing to index, so aren't drift
+    drift = engine.check_index()
+    assert drift == {'added': [media_a.id], 'updated': [], 'removed': [29]}
+    assert engine.check_index() == drift
+
+    args = argparse.Namespace(all=False)
+    assert commands.verify(engine, args) == 1
+    assert 'out of sync' in capsys.readouterr()[0]
+
+    engine.update_index()
+    assert commands.verify(engine, args) == 0
+    assert 'in sync' in capsys.readouterr()[0]
+
+    progress = []
+    engine.rebuild_index(batch_size=1,
+                         progress=lambda *args: progress.append(args))
+    assert (1, media_a.id) in progress
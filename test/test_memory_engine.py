@@ -0,0 +1,81 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import unicode_literals
+
+import os
+from mediagoblin.tests.tools import fixture_media_entry
+from indexedsearch.backends.memory import Engine, SNAPSHOT_NAME
+
+
+def make_engine(tmpdir, **options):
+    return Engine(INDEX_DIR=str(tmpdir.join('index')), **options)
+
+
+def test_search_syntax(test_app, tmpdir):
+    """Test that phrases, prefixes and exclusions are matched in memory."""
+    engine = make_engine(tmpdir)
+    engine.write_document({'media_id': 1, 'title': 'big red goblin'})
+    engine.write_document({'media_id': 2, 'title': 'red big goblin goblin'})
+    engine.write_document({'media_id': 3, 'title': 'goblins'})
+
+    assert engine.search('"big red"') == [1]
+    assert sorted(engine.search('gob*')) == [1, 2, 3]
+    assert engine.search('goblin NOT big') == []
+
+
+def test_optimize_and_snapshot(test_app, tmpdir):
+    """
+    Test that optimize drops replaced documents, and that the index is
+    loaded from its snapshot.
+    """
+    for title in ('mediaA', 'mediaB', 'mediaC'):
+        fixture_media_entry(title=title, fake_upload=False,
+                            state='processed')
+
+    engine = make_engine(tmpdir, MEMORY_SNAPSHOT=True)
+    assert engine.rebuild_index(batch_size=2) == 3
+    engine.write_document({'media_id': 29, 'title': 'fake document'})
+    engine.write_document({'media_id': 29, 'title': 'fake document 2'})
+    assert engine.get_index_stats()['deleted_documents'] == 1
+    assert engine.optimize()
+    assert engine.get_index_stats()['deleted_documents'] == 0
+    assert engine.search('fake') == [29]
+    assert os.path.exists(str(tmpdir.join('index', SNAPSHOT_NAME)))
+
+    engine = make_engine(tmpdir, MEMORY_SNAPSHOT=True)
+    assert engine.stats['snapshots_loaded'] == 1
+    assert engine.search('fake') == [29]
+    assert engine.update_index()['removed'] == 1
+    assert engine.search('mediaC') != []
+
+
+def test_writes_compact_deleted_documents(test_app, tmpdir):
+    """
+    Test that batches of changes compact the index once enough of its
+    documents are deleted, without waiting for optimize.
+    """
+    ids = [fixture_media_entry(title='goblin', fake_upload=False,
+                               state='processed').id
+           for _ in range(5)]
+    engine = make_engine(tmpdir)
+    engine.update_index()
+
+    engine.apply_changes([], ids[:1])
+    assert engine.get_index_stats()['deleted_documents'] == 1
+    engine.apply_changes([], ids[1:2])
+    assert engine.get_index_stats()['deleted_documents'] == 0
+    assert engine.stats['compactions'] == 1
+    assert sorted(engine.search('goblin')) == sorted(ids[2:])
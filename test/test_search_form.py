@@ -18,6 +18,7 @@ import pytest
 import webtest
 from six import itervalues
 from mediagoblin.tests.tools import fixture_add_user
+from indexedsearch import get_engine
 
 
 class TestSearch:
@@ -89,3 +90,74 @@ class TestSearch:
         assert response.status_int == 200
         response.mustcontain('<a href="/u/chris/m/title-number-two/">')
         response.mustcontain('<a href="/u/chris/m/title-number-one/">')
+
+    def test_sort_by_date(self):
+        """Test that results can be sorted by when they were added."""
+        for sort, first, second in [('oldest', 'one', 'two'),
+                                    ('newest', 'two', 'one')]:
+            response = self.test_app.get('/search/', {'q': 'number',
+                                                      'sort': sort})
+            assert response.status_int == 200
+            body = response.body.decode('utf-8')
+            assert (body.index('/u/chris/m/title-number-%s/' % first) <
+                    body.index('/u/chris/m/title-number-%s/' % second))
+
+    def test_page_zero(self):
+        """Test that page 0 shows the first page rather than failing."""
+        response = self.test_app.get('/search/', {'q': 'number one',
+                                                  'page': '0'})
+        assert response.status_int == 200
+        response.mustcontain('<a href="/u/chris/m/title-number-one/">')
+
+    def test_suggest(self):
+        """Test that the suggest route completes words as JSON."""
+        response = self.test_app.get('/search/suggest/',
+                                     {'q': 'numb', 'limit': '5'})
+        assert response.content_type == 'application/json'
+        assert {'kind': 'title', 'text': 'number'} in \
+            response.json['suggestions']
+
+
+class TestSearchStoredResultFields(TestSearch):
+
+    config_file = 'conf_store_result_fields.ini'
+
+    def test_result_fields_stored(self):
+        """Test that results can be rendered from the index alone."""
+        results = get_engine().search_page('number one', 1, 30)
+        assert len(results['ids']) == 1
+        fields = results['fields'][0]
+        assert fields['title'] == 'title number one'
+        assert fields['slug'] == 'title-number-one'
+        assert fields['user'] == 'chris'
+        assert fields['media_type'] == 'mediagoblin.media_types.image'
+        assert fields['thumb_url']
+
+
+class TestSearchMetrics(TestSearch):
+
+    config_file = 'conf_metrics.ini'
+
+    def test_metrics_endpoint(self):
+        """Test that searches show up in the metrics endpoint."""
+        self.test_app.get('/search/', {'q': 'number'})
+        response = self.test_app.get('/search/metrics/')
+        assert response.content_type == 'text/plain'
+        body = response.body.decode('utf-8')
+        assert 'indexedsearch_searches_total' in body
+        assert 'indexedsearch_index_documents 2' in body
+
+
+class TestSearchSqliteFts(TestSearch):
+
+    config_file = 'conf_sqlite_fts.ini'
+
+
+class TestSearchMemory(TestSearch):
+
+    config_file = 'conf_memory.ini'
+
+
+class TestSearchSharded(TestSearch):
+
+    config_file = 'conf_sharded.ini'
@@ -0,0 +1,124 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import unicode_literals
+
+import os
+import datetime
+from mediagoblin.db.base import Session
+from mediagoblin.tests.tools import (fixture_media_entry,
+                                     fixture_add_comment)
+from indexedsearch.backends.sharded import Engine
+
+
+def make_engine(tmpdir, shards):
+    return Engine(INDEX_DIR=str(tmpdir.join('index')), INDEX_SHARDS=shards)
+
+
+def add_media_entries(*titles):
+    entries = []
+    for title in titles:
+        media = fixture_media_entry(title=title, save=False, expunge=False,
+                                    fake_upload=False, state='processed')
+        Session.add(media)
+        entries.append(media)
+    Session.commit()
+    return entries
+
+
+def test_update_index_and_reshard(test_app, tmpdir):
+    """
+    Test that media entries are indexed in the shard of their id, and that
+    changing the number of shards moves them and removes unused shards.
+    """
+    entries = add_media_entries('goblin a', 'goblin b', 'goblin c',
+                                'goblin d')
+    ids = sorted(media.id for media in entries)
+
+    engine = make_engine(tmpdir, 2)
+    assert engine.update_index() == {'added': 4, 'updated': 0, 'removed': 0}
+    for media_id in ids:
+        assert engine.shard_for(media_id).is_indexed(media_id)
+        assert not engine.shards[(media_id + 1) % 2].is_indexed(media_id)
+    assert sorted(engine.search('goblin')) == ids
+    assert engine.check_index() == {'added': [], 'updated': [],
+                                    'removed': []}
+    assert engine.get_index_stats()['documents'] == 4
+
+    engine = make_engine(tmpdir, 3)
+    assert engine.update_index()['added'] > 0
+    assert sorted(engine.search('goblin')) == ids
+    assert all(engine.is_indexed(media_id) for media_id in ids)
+    assert engine.get_index_stats()['documents'] == 4
+
+    engine = make_engine(tmpdir, 1)
+    engine.update_index()
+    assert sorted(engine.search('goblin')) == ids
+    assert not os.path.exists(str(tmpdir.join('index', 'shard-1')))
+    assert not os.path.exists(str(tmpdir.join('index', 'shard-2')))
+
+
+def test_search_top_hits(test_app, tmpdir):
+    """
+    Test that search returns the top 10 hits of every shard, like the whoosh
+    engine does.
+    """
+    entries = add_media_entries('goblin goblin goblin',
+                                *['goblin %d' % number
+                                  for number in range(11)])
+    engine = make_engine(tmpdir, 3)
+    engine.update_index()
+    ids = engine.search('goblin')
+    assert len(ids) == 10
+    assert ids[0] == entries[0].id
+
+
+def test_search_page_of_segments_without_dates(test_app, tmpdir):
+    """
+    Test that hits are paged across segments written with and without
+    creation dates, as in an index created by an older version.
+    """
+    engine = make_engine(tmpdir, 2)
+    for doc in ({'media_id': 1, 'title': 'goblin'},
+                {'media_id': 3, 'title': 'goblin goblin',
+                 'created': datetime.datetime(2017, 1, 1)},
+                {'media_id': 5, 'title': 'goblin party'}):
+        shard = engine.shard_for(doc['media_id'])
+        with shard.open_writer() as writer:
+            shard.write_document(doc, writer)
+
+    assert engine.search_page('goblin', 1, 10)['ids'] == [3, 1, 5]
+    assert engine.search_page('goblin', 1, 10,
+                              sort='oldest')['ids'] == [3, 1, 5]
+
+
+def test_comments_go_to_the_shard_of_their_media_entry(test_app, tmpdir):
+    """Test that comments are written to the shard of their media entry."""
+    media_a, media_b = add_media_entries('mediaA', 'mediaB')
+    engine = make_engine(tmpdir, 2)
+    engine.update_index()
+
+    comment = fixture_add_comment(author=media_a.actor, media_entry=media_a,
+                                  comment='a goblin party')
+    engine.apply_changes([], [], comments_to_index=[comment.id])
+    shard = engine.shard_for(media_a.id)
+    assert shard.get_comment_searcher().document_number(
+        comment_id=comment.id) is not None
+    assert engine.get_index_stats()['comment_documents'] == 1
+    assert engine.search('party') == [media_a.id]
+
+    comment.delete()
+    engine.apply_changes([], [], comments_to_remove=[comment.id])
+    assert engine.search('party') == []
@@ -0,0 +1,76 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import unicode_literals
+
+from indexedsearch.backends.sqlite_fts import Engine
+from indexedsearch.querysyntax import And, Not, Or, Words, parse_query
+
+
+def make_engine(tmpdir):
+    return Engine(INDEX_DIR=str(tmpdir.join('index')))
+
+
+def write_documents(engine, *docs):
+    with engine.transaction() as connection:
+        for doc in docs:
+            engine.write_document(doc, connection)
+
+
+def test_parse_query():
+    """Test that queries are parsed like whoosh's default parser does."""
+    fields = ('title', 'tag')
+    assert parse_query('', fields) is None
+    assert parse_query('goblin', fields) == Words(fields, ['goblin'])
+    assert parse_query('"red goblin" gob*', fields) == And([
+        Words(fields, ['red', 'goblin']),
+        Words(fields, ['gob'], prefix=True)])
+    assert parse_query('tag:(cat OR dog) NOT title:x', fields) == And([
+        Or([Words(['tag'], ['cat']), Words(['tag'], ['dog'])]),
+        Not(Words(['title'], ['x']))])
+    # Unknown fields are part of the word, stray operators are ignored
+    assert parse_query('user:bob AND', fields) == Words(fields, ['user:bob'])
+
+
+def test_search_syntax(test_app, tmpdir):
+    """Test the supported subset of whoosh's query syntax."""
+    engine = make_engine(tmpdir)
+    write_documents(
+        engine,
+        {'media_id': 1, 'title': 'big red goblin', 'tag': 'cat'},
+        {'media_id': 2, 'title': 'red big goblin', 'user': 'chris'},
+        {'media_id': 3, 'title': 'goblins', 'description': 'big'})
+
+    assert engine.search('"big red"') == [1]
+    assert sorted(engine.search('big goblin')) == [1, 2]
+    assert sorted(engine.search('gob*')) == [1, 2, 3]
+    assert engine.search('tag:cat OR user:chris') in ([1, 2], [2, 1])
+    assert engine.search('goblin NOT tag:cat') == [2]
+    assert engine.search('title:big NOT goblin') == []
+    assert engine.search('user:chris') == [2]
+    assert engine.search('"!!!"') == []
+    assert engine.search('') == []
+
+
+def test_column_weights(test_app, tmpdir):
+    """Test that hits rank by the weight of the column they match in."""
+    engine = make_engine(tmpdir)
+    write_documents(
+        engine,
+        {'media_id': 1, 'description': 'goblin'},
+        {'media_id': 2, 'title': 'goblin'},
+        {'media_id': 3, 'tag': 'goblin'})
+
+    assert engine.search_page('goblin', 1, 10)['ids'] == [2, 3, 1]
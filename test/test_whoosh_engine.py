@@ -16,15 +16,28 @@
 from __future__ import unicode_literals
 
 import os
+import time
+import socket
 import datetime
+import threading
 import whoosh.index
 import whoosh.qparser
 import whoosh.writing
+import whoosh.collectors
 from mediagoblin.tools import pluginapi
 from mediagoblin.db.base import Session
-from mediagoblin.tests.tools import (fixture_media_entry)
+from mediagoblin.db.models import MediaEntry
+from mediagoblin.tests.tools import (fixture_media_entry,
+                                     fixture_add_comment)
+from indexedsearch.backends import ID_RANGE_SIZE, id_range_checksums
 from indexedsearch.backends.whoosh import Engine, INDEX_NAME
-from indexedsearch import get_engine
+from indexedsearch import get_engine, setup_engine
+from indexedsearch.daemon import IndexerClient, IndexerDaemon
+from indexedsearch.idsets import IdTimeTable, difference, union
+from indexedsearch.indexing import (IndexQueue, INDEX, REMOVE, MEDIA,
+                                    COMMENT)
+from indexedsearch.maintenance import MergeScheduler
+from indexedsearch.metrics import metrics
 
 
 def test_index_creation():
@@ -136,6 +149,29 @@ def test_update_index(test_app):
         assert len(searcher.search(query)) == 0
 
 
+def test_id_time_table():
+    """
+    Test that an IdTimeTable finds the ids missing from the database, added
+    to it and updated in it, and that sorted id arrays merge.
+    """
+    table = IdTimeTable()
+    for media_id, updated in [(7, 10), (2, 10), (300, 10), (5, 10)]:
+        table.add(media_id, updated)
+    assert len(table) == 4
+    assert 300 in table and 3 not in table
+    assert list(table.ids()) == [2, 5, 7, 300]
+    assert table.range_checksums(100) == {0: (3, 14), 3: (1, 300)}
+
+    missing, added, updated = table.compare(
+        [(1, 10), (2, 10), (5, 11), (7, 9), (400, 10)])
+    assert list(missing) == [300]
+    assert list(added) == [1, 400]
+    assert list(updated) == [5]
+
+    assert list(union(added, updated)) == [1, 5, 400]
+    assert list(difference(added, missing)) == [1, 400]
+
+
 def test_media_entry_change_and_delete(test_app):
     """
     Test that media entry additions/modification/deletes automatically show
@@ -169,6 +205,26 @@ def test_media_entry_change_and_delete(test_app):
     assert engine.search('mediaB') == []
 
 
+def test_media_file_change_refreshes_result_fields(test_app):
+    """
+    Test that changing the files of a media entry, as reprocessing does,
+    reindexes it so that its stored thumbnail URL stays current.
+    """
+    engine = get_engine()
+    engine.store_result_fields = True
+    media_id = fixture_media_entry(title='mediaA', state='processed').id
+
+    def stored_thumb_url():
+        document = engine.get_searcher().document(media_id=media_id)
+        return document['result']['thumb_url']
+
+    assert stored_thumb_url().endswith('a/b/c.jpg')
+    media = MediaEntry.query.get(media_id)
+    media.media_files['thumb'] = ['a', 'b', 'reprocessed.jpg']
+    Session.commit()
+    assert stored_thumb_url().endswith('a/b/reprocessed.jpg')
+
+
 def test_unprocess_media_entry(test_app):
     """
     Test that media entries that aren't marked as processed are not added to
@@ -190,3 +246,531 @@ def test_unprocess_media_entry(test_app):
         qp = whoosh.qparser.QueryParser('title', schema=ix.schema)
         query = qp.parse('mediaA')
         assert len(searcher.search(query)) == 0
+
+
+def test_engine_and_searcher_reuse(test_app):
+    """
+    Test that get_engine hands out the same engine, and that the engine's
+    searcher is reused until a writer commits a new index generation.
+    """
+    engine = get_engine()
+    assert get_engine() is engine
+
+    searcher = engine.get_searcher()
+    assert engine.get_searcher() is searcher
+    reopened = engine.stats['searcher_reopened']
+
+    with whoosh.writing.AsyncWriter(engine.index) as writer:
+        writer.update_document(media_id=1, title='Test media entry')
+
+    assert engine.get_searcher() is not searcher
+    assert engine.stats['searcher_reopened'] == reopened + 1
+    assert engine.search('Test media entry') == [1]
+
+
+def test_rebuild_index_in_batches(test_app):
+    """
+    Test that each batch of a rebuild only replaces the documents in its own
+    id range.
+    """
+    media = []
+    for title in 'mediaA', 'mediaB', 'mediaC':
+        media.append(fixture_media_entry(title=title, save=False,
+                                         expunge=False, fake_upload=False,
+                                         state='processed'))
+        Session.add(media[-1])
+    Session.commit()
+
+    engine = get_engine()
+    assert engine.rebuild_index(batch_size=1) == 3
+    for entry in media:
+        assert engine.search(entry.title) == [entry.id]
+
+
+def test_rebuild_index_with_processes(test_app):
+    """
+    Test that a rebuild with several processes, whose documents are written
+    into sub-segments merged on commit, indexes every media entry.
+    """
+    ids = {}
+    for title in 'mediaA', 'mediaB', 'mediaC':
+        media = fixture_media_entry(title=title, fake_upload=False,
+                                    state='processed')
+        ids[title] = media.id
+
+    engine = get_engine()
+    assert engine.rebuild_index(procs=2, batch_size=2) == 3
+    for title, media_id in ids.items():
+        assert engine.search(title) == [media_id]
+    assert engine.check_index() == {'added': [], 'updated': [],
+                                    'removed': []}
+
+
+def test_rebuild_index_resumes_from_checkpoint(test_app):
+    """
+    Test that a rebuild resumes after the media entry saved in its checkpoint,
+    and that the checkpoint is removed once the rebuild has finished.
+    """
+    media_a = fixture_media_entry(title='mediaA', save=False,
+                                  expunge=False, fake_upload=False,
+                                  state='processed')
+    media_b = fixture_media_entry(title='mediaB', save=False,
+                                  expunge=False, fake_upload=False,
+                                  state='processed')
+    Session.add(media_a)
+    Session.add(media_b)
+    Session.commit()
+
+    engine = get_engine()
+    engine.remove_media_entry(media_a.id)
+    engine.remove_media_entry(media_b.id)
+
+    # Pretend an earlier rebuild was interrupted after indexing media_a
+    engine.write_checkpoint(media_a.id)
+    assert engine.rebuild_index(batch_size=1) == 1
+    assert engine.search('mediaA') == []
+    assert engine.search('mediaB') == [media_b.id]
+    assert engine.read_checkpoint() is None
+
+
+def test_update_index_from_watermark(test_app):
+    """
+    Test that a sync saves a watermark, that the next sync from it still
+    removes documents of entries missing from the database, and that a
+    rebuild replaces the watermark.
+    """
+    media_a = fixture_media_entry(title='mediaA', save=False,
+                                  expunge=False, fake_upload=False,
+                                  state='processed')
+    Session.add(media_a)
+    Session.commit()
+
+    engine = get_engine()
+    engine.update_index()
+    watermark = engine.read_watermark()
+    assert watermark['max_id'] == media_a.id
+
+    with whoosh.writing.AsyncWriter(engine.index) as writer:
+        writer.update_document(media_id=29, title='fake document')
+    assert engine.update_index() == {'added': 0, 'updated': 0, 'removed': 1}
+    assert engine.search('fake') == []
+    assert engine.update_index() == {'added': 0, 'updated': 0, 'removed': 0}
+    assert engine.update_index(full=True) == {'added': 0, 'updated': 0,
+                                              'removed': 0}
+
+    engine.rebuild_index()
+    assert engine.read_watermark()['max_id'] == media_a.id
+
+
+def test_id_range_checksums(test_app):
+    """
+    Test that processed media entry ids are counted and summed per id range,
+    each range keyed by its number.
+    """
+    ids = []
+    for state in ('processed', 'processed', 'unprocessed', 'processed',
+                  'processed', 'processed'):
+        media = fixture_media_entry(save=False, expunge=False,
+                                    fake_upload=False, state=state)
+        Session.add(media)
+        Session.commit()
+        if state == 'processed':
+            ids.append(media.id)
+
+    expected = {}
+    for media_id in ids:
+        count, total = expected.get(media_id // 3, (0, 0))
+        expected[media_id // 3] = (count + 1, total + media_id)
+    assert len(expected) > 1
+    assert any(count > 1 for count, _ in expected.values())
+    assert id_range_checksums(3) == expected
+    assert id_range_checksums() == {ids[0] // ID_RANGE_SIZE: (5, sum(ids))}
+
+
+def test_rolled_back_changes_not_indexed(test_app):
+    """
+    Test that changes to media entries are only indexed once their
+    transaction commits.
+    """
+    media_a = fixture_media_entry(title='mediaA', save=False,
+                                  expunge=False, fake_upload=False,
+                                  state='processed')
+    Session.add(media_a)
+    Session.commit()
+
+    engine = get_engine()
+    assert engine.search('mediaA') == [media_a.id]
+
+    media_a.title = 'new'
+    Session.flush()
+    Session.rollback()
+
+    assert engine.search('new') == []
+    assert engine.search('mediaA') == [media_a.id]
+
+
+def test_unchanged_media_entry_not_rewritten(test_app):
+    """
+    Test that reindexing a media entry whose document hasn't changed skips
+    the writer, and that the skipped write is counted.
+    """
+    media_a = fixture_media_entry(title='mediaA', save=False,
+                                  expunge=False, fake_upload=False,
+                                  state='processed')
+    Session.add(media_a)
+    Session.commit()
+
+    engine = get_engine()
+    generation = engine.index.latest_generation()
+    unchanged = engine.stats['documents_unchanged']
+
+    assert not engine.add_media_entry(media_a)
+    assert engine.index.latest_generation() == generation
+    assert engine.stats['documents_unchanged'] == unchanged + 1
+
+    media_a.title = 'new'
+    Session.commit()
+    assert engine.search('new') == [media_a.id]
+
+
+def test_comments_indexed_separately(test_app):
+    """
+    Test that comments are indexed as documents of their own, matching the
+    media entry they are on, without rewriting the media entry's document.
+    """
+    media_a = fixture_media_entry(title='mediaA', save=False,
+                                  expunge=False, fake_upload=False,
+                                  state='processed')
+    media_b = fixture_media_entry(title='goblin', save=False,
+                                  expunge=False, fake_upload=False,
+                                  state='processed')
+    Session.add(media_a)
+    Session.add(media_b)
+    Session.commit()
+
+    engine = get_engine()
+    generation = engine.index.latest_generation()
+    comment = fixture_add_comment(author=media_a.actor, media_entry=media_a,
+                                  comment='a goblin party')
+    assert engine.index.latest_generation() == generation
+    assert engine.get_index_stats()['comment_documents'] == 1
+
+    assert engine.search('party') == [media_a.id]
+    assert sorted(engine.search('goblin')) == sorted([media_a.id,
+                                                      media_b.id])
+    assert engine.search('goblin NOT comment:party') == [media_b.id]
+    assert engine.search('mediaA comment:party') == [media_a.id]
+    assert engine.search_page('party', 1, 10)['ids'] == [media_a.id]
+
+    # A sync indexes comments the event hooks missed
+    with engine.open_writer(index=engine.comment_index) as writer:
+        writer.delete_by_term('comment_id', comment.id)
+    assert engine.search('party') == []
+    engine.update_index(full=True)
+    assert engine.search('party') == [media_a.id]
+
+    comment.content = 'a goblin dance'
+    comment.save()
+    assert engine.search('party') == []
+    assert engine.search('dance') == [media_a.id]
+
+    comment.delete()
+    assert engine.search('dance') == []
+    assert engine.get_index_stats()['comment_documents'] == 0
+    assert engine.index.latest_generation() == generation
+
+
+def test_many_comments_joined(test_app):
+    """
+    Test that a word in thousands of comments matches each media entry the
+    comments are on once, scored by its best matching comment.
+    """
+    engine = get_engine()
+    count = 2000
+    with engine.open_writer() as writer:
+        for media_id in range(1, count + 1):
+            engine.write_document({'media_id': media_id, 'title': 'entry'},
+                                  writer)
+    with engine.open_writer(index=engine.comment_index) as writer:
+        for media_id in range(1, count + 1):
+            writer.add_document(comment_id=media_id, media_id=media_id,
+                                comment='party')
+        writer.add_document(comment_id=count + 1, media_id=7,
+                            comment='party party party')
+        writer.add_document(comment_id=count + 2, media_id=7,
+                            comment='dance')
+
+    page = engine.search_page('party', 1, 10)
+    assert page['total'] == count
+    assert page['ids'][0] == 7
+    assert engine.search_page('entry party', 1, 10)['total'] == count
+    assert engine.search_page('party NOT comment:party', 1, 10)['total'] == 0
+
+    # Replaced documents are deleted, and mustn't match a second time
+    with engine.open_writer() as writer:
+        engine.write_document({'media_id': 7, 'title': 'renamed'}, writer)
+    assert engine.search_page('party', 1, 10)['total'] == count
+    assert engine.search('renamed party') == [7]
+    assert engine.search('entry dance') == []
+
+
+def test_phrase_search(test_app):
+    """
+    Test that unfielded phrases search the fields without positions (tags)
+    for all of the phrase's words, rather than failing.
+    """
+    engine = get_engine()
+    with whoosh.writing.AsyncWriter(engine.index) as writer:
+        writer.update_document(media_id=1, title='big red goblin')
+        writer.update_document(media_id=2, title='red big goblin')
+        writer.update_document(media_id=3, title='x', tag='goblin red')
+
+    assert sorted(engine.search('"red goblin"')) == [1, 3]
+    assert engine.search('title:"red goblin"') == [1]
+
+
+def test_search_results_cached_until_index_changes(test_app):
+    """
+    Test that repeated searches are answered from the query cache, and that
+    the cache is invalidated once a writer commits a new generation.
+    """
+    engine = get_engine()
+    with whoosh.writing.AsyncWriter(engine.index) as writer:
+        writer.update_document(media_id=1, title='goblin')
+
+    hits = engine.query_cache.stats['hits']
+    assert engine.search_page('goblin', 1, 10)['ids'] == [1]
+    assert engine.search_page('  goblin ', 1, 10)['ids'] == [1]
+    assert engine.query_cache.stats['hits'] == hits + 1
+
+    with whoosh.writing.AsyncWriter(engine.index) as writer:
+        writer.update_document(media_id=2, title='goblin goblin')
+
+    assert engine.search_page('goblin', 1, 10)['ids'] == [2, 1]
+    assert engine.query_cache.stats['hits'] == hits + 1
+    assert engine.get_stats()['query_cache_invalidations'] >= 1
+
+
+def test_search_page_correction(test_app):
+    """
+    Test that a search without hits suggests a corrected query, and that
+    the corrector is only rebuilt once the index changes.
+    """
+    engine = get_engine()
+    with whoosh.writing.AsyncWriter(engine.index) as writer:
+        writer.update_document(media_id=1, title='Goblin gold', tag='cat')
+
+    assert engine.search_page('goblni', 1, 10)['correction'] == 'goblin'
+    assert engine.search_page('goblin', 1, 10)['correction'] is None
+    assert engine.search_page('gold tag:cta', 1, 10)['correction'] == \
+        'gold tag:cat'
+
+    builds = engine.stats['corrector_builds']
+    assert engine.search_page('glod', 1, 10)['correction'] == 'gold'
+    assert engine.stats['corrector_builds'] == builds
+
+
+def test_optimize_and_index_stats(test_app):
+    """
+    Test that the index stats report segments and deleted documents, and
+    that an off-peak merge only optimizes an index that needs it.
+    """
+    engine = get_engine()
+    engine.optimize()
+    before = engine.get_index_stats()
+    assert before['deleted_documents'] == 0
+    for media_id in 1, 2, 1:
+        writer = whoosh.writing.AsyncWriter(engine.index)
+        writer.update_document(media_id=media_id, title='goblin')
+        writer.commit(mergetype=whoosh.writing.NO_MERGE)
+
+    stats = engine.get_index_stats()
+    assert stats['segments'] == before['segments'] + 3
+    assert stats['documents'] == before['documents'] + 2
+    assert stats['deleted_documents'] == 1
+    assert stats['size'] > before['size']
+
+    scheduler = MergeScheduler(lambda: engine, (1, 5), max_segments=2)
+    assert not scheduler.check(datetime.datetime(2016, 1, 1, 12))
+    assert scheduler.check(datetime.datetime(2016, 1, 1, 2))
+
+    stats = engine.get_index_stats()
+    assert stats['segments'] == 1
+    assert stats['deleted_documents'] == 0
+    assert not scheduler.check(datetime.datetime(2016, 1, 1, 2))
+
+
+def test_metrics(test_app):
+    """
+    Test that searches and writes are recorded, and rendered in the
+    Prometheus text format.
+    """
+    engine = get_engine()
+    searches = metrics.counters.get('searches', 0)
+    zero_result = metrics.counters.get('zero_result_searches', 0)
+    commits = metrics.histograms['commit_seconds'].count \
+        if 'commit_seconds' in metrics.histograms else 0
+
+    writer = engine.async_writer()
+    writer.update_document(media_id=1, title='goblin')
+    engine.commit(writer)
+    engine.remove_media_entry(2)
+    engine.search_page('goblin', 1, 10)
+    engine.search('missing')
+
+    assert metrics.counters['searches'] == searches + 2
+    assert metrics.counters['zero_result_searches'] == zero_result + 1
+    assert metrics.histograms['commit_seconds'].count == commits + 2
+
+    text = metrics.render()
+    assert 'indexedsearch_searches_total %d' % (searches + 2) in text
+    assert '# TYPE indexedsearch_search_seconds histogram' in text
+    assert 'indexedsearch_search_seconds_bucket{le="+Inf"}' in text
+    assert 'indexedsearch_index_segments ' in text
+
+
+class ExpiredTimeLimitCollector(whoosh.collectors.TimeLimitCollector):
+    """A time limited collector whose time has run out as it starts."""
+
+    def prepare(self, top_searcher, q, context):
+        super(ExpiredTimeLimitCollector, self).prepare(top_searcher, q,
+                                                       context)
+        self.timedout = True
+
+
+def test_search_time_limit(test_app, tmpdir, monkeypatch):
+    """
+    Test that a search running out of time returns the hits found so far,
+    flagged as partial, and that partial results aren't cached.
+    """
+    engine = Engine(INDEX_DIR=str(tmpdir.join('index')),
+                    SEARCH_TIME_LIMIT=5.0)
+    with whoosh.writing.AsyncWriter(engine.index) as writer:
+        for media_id in (1, 2, 3):
+            writer.update_document(media_id=media_id, title='goblin')
+
+    assert engine.search_page('goblin', 1, 10)['partial'] is False
+    engine.query_cache.clear()
+    monkeypatch.setattr(whoosh.collectors, 'TimeLimitCollector',
+                        ExpiredTimeLimitCollector)
+    results = engine.search_page('goblin', 1, 10)
+    assert results['partial'] is True
+    assert len(results['ids']) == 1
+    assert engine.search_hits('goblin', 10)['partial'] is True
+    assert len(engine.search('goblin')) == 1
+    assert engine.get_stats()['partial_searches'] == 3
+
+    # Searching the comments counts against the time limit too, even when
+    # none of their media entries are left to collect
+    with whoosh.writing.AsyncWriter(engine.comment_index) as writer:
+        writer.add_document(comment_id=1, media_id=4, comment='party')
+    assert engine.search_page('comment:party', 1, 10)['partial'] is True
+
+    monkeypatch.undo()
+    results = engine.search_page('goblin', 1, 10)
+    assert results['partial'] is False
+    assert sorted(results['ids']) == [1, 2, 3]
+
+
+def test_setup_engine_registers_observers_once(test_app):
+    """
+    Test that setting the app up again doesn't leave metrics observers
+    registered by the previous setup.
+    """
+    observed = []
+    metrics.add_observer(lambda *value: observed.append(value))
+    setup_engine(None)
+    metrics.inc('searches')
+    assert observed == []
+    assert 'indexedsearch_index_segments ' in metrics.render()
+
+
+class RecordingEngine(object):
+    """Records the batches of changes applied to it."""
+
+    def __init__(self):
+        self.changes = []
+
+    def apply_changes(self, *changes):
+        self.changes.append(changes)
+
+
+def wait_for(condition, timeout=5.0):
+    """Wait for a background thread to make condition() true."""
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_index_queue():
+    """
+    Test that the index queue keeps the latest change of each object, and
+    that its thread applies changes in batches as soon as a batch is full,
+    or after the flush interval.
+    """
+    engine = RecordingEngine()
+    queue = IndexQueue(lambda: engine, batch_size=2, flush_interval=60)
+    queue.put({(MEDIA, 1): INDEX})
+    queue.put({(MEDIA, 1): REMOVE})
+    assert len(queue) == 1
+    assert queue.stats['deduplicated'] == 1
+    assert engine.changes == []
+
+    queue.put({(MEDIA, 2): INDEX, (COMMENT, 3): INDEX})
+    assert wait_for(lambda: len(engine.changes) == 2)
+    assert [len(sum(batch, [])) for batch in engine.changes] == [2, 1]
+    media_index, media_remove, comment_index, comment_remove = (
+        sum(lists, []) for lists in zip(*engine.changes))
+    assert (media_index, media_remove, comment_index, comment_remove) == \
+        ([2], [1], [3], [])
+
+    engine = RecordingEngine()
+    queue = IndexQueue(lambda: engine, batch_size=100, flush_interval=0.1)
+    queue.put({(MEDIA, 4): INDEX})
+    assert wait_for(lambda: engine.changes)
+    assert engine.changes == [([4], [], [], [])]
+    assert queue.stats['batches'] == 1
+
+
+def test_indexer_daemon(tmpdir):
+    """
+    Test that queued changes are sent to the indexer daemon, and applied in
+    the worker process while the daemon isn't running.
+    """
+    path = str(tmpdir.join('indexer.sock'))
+    daemon_engine = RecordingEngine()
+    worker_engine = RecordingEngine()
+    client = IndexerClient(path, retry_interval=0)
+    queue = IndexQueue(lambda: worker_engine, flush_interval=0,
+                       indexer=client)
+
+    queue.put({(MEDIA, 1): INDEX})
+    queue.flush()
+    assert worker_engine.changes == [([1], [], [], [])]
+    assert client.stats['unavailable'] == 1
+
+    # A socket left behind by a daemon that died is replaced
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    indexer = IndexerDaemon(lambda: daemon_engine, path, flush_interval=0)
+    indexer.bind()
+    thread = threading.Thread(target=indexer.serve_forever)
+    thread.start()
+    try:
+        assert client.ping()
+        queue.put({(MEDIA, 2): INDEX, (COMMENT, 3): REMOVE})
+        queue.flush()
+        assert daemon_engine.changes == [([2], [], [], [3])]
+        assert queue.stats['sent_batches'] == 1
+        assert 'error' in client.request({'changes': [['user', 4, INDEX]]})
+        assert client.flush()
+    finally:
+        indexer.shutdown()
+        thread.join()
+
+    assert not os.path.exists(path)
+    queue.put({(MEDIA, 4): REMOVE})
+    queue.flush()
+    assert worker_engine.changes[-1] == ([], [4], [], [])